@@ -0,0 +1,103 @@
+import functools
+import io
+import os
+import tarfile
+import zipfile
+
+from InputFiles import matches_patterns
+
+# File names ending in any of these are treated as archives, rather than as PXBI files
+archive_extensions = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+def is_archive(filepath):
+    return filepath.lower().endswith(archive_extensions) and os.path.isfile(filepath)
+
+
+@functools.lru_cache(maxsize=8)
+def open_zip(filepath, pid):
+    """
+    Keeps recently used zip files open, so that their directories are not re-read for every member. 'pid' is part of
+    the cache key so that worker processes forked from a process with open zip files do not share their file handles.
+    """
+    return zipfile.ZipFile(filepath)
+
+
+class ArchiveMember:
+    """
+    A file inside a zip or tar archive. Only the archive's path and the member's name and position are stored, so
+    members can be passed to worker processes and opened there.
+
+    Inputs
+    ------
+    archive -- the path of the archive
+    name -- the path of the member within the archive, with '/' as the separator
+    size -- the uncompressed size of the member
+    mtime_ns -- the modification time of the archive, which stands in for that of the member
+    offset -- for members of uncompressed tar files, the position of the member's data within the archive, so that
+              it can be read without searching through the archive
+    """
+    def __init__(self, archive, name, size, mtime_ns, offset=None):
+        self.archive = archive
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.offset = offset
+
+    def __str__(self):
+        return f"{self.archive}::{self.name}"
+
+    def key(self):
+        return f"{os.path.normcase(os.path.abspath(self.archive))}::{self.name}"
+
+    def read(self):
+        if zipfile.is_zipfile(self.archive):
+            return open_zip(self.archive, os.getpid()).read(self.name)
+        if self.offset is not None:
+            with open(self.archive, 'rb') as F:
+                F.seek(self.offset)
+                return F.read(self.size)
+        # Compressed tar files have to be decompressed from the start to reach each member
+        with tarfile.open(self.archive) as archive:
+            with archive.extractfile(self.name) as F:
+                return F.read()
+
+    def open(self):
+        """
+        Returns the member as an io.BytesIO, named after the member so that its outputs are too.
+        """
+        stream = io.BytesIO(self.read())
+        stream.name = self.name
+        return stream
+
+
+def find_archive_members(filepath, include=(), exclude=()):
+    """
+    Lists the '.bin' files in a zip or tar archive without extracting anything. 'include' and 'exclude' are glob
+    patterns matched against both the name and the path of each member, as for InputFiles.find_bin_files.
+
+    Returns
+    ------
+    A list of (ArchiveMember, path within the archive, size) tuples.
+    """
+    mtime_ns = os.stat(filepath).st_mtime_ns
+    if zipfile.is_zipfile(filepath):
+        entries = [(info.filename, info.file_size, None) for info in open_zip(filepath, os.getpid()).infolist()
+                   if not info.is_dir()]
+    else:
+        with tarfile.open(filepath) as archive:
+            compressed = not isinstance(archive.fileobj, io.BufferedReader)
+            entries = [(info.name, info.size, None if compressed else info.offset_data)
+                       for info in archive.getmembers() if info.isfile()]
+
+    found = []
+    for name, size, offset in entries:
+        basename = name.rsplit('/', 1)[-1]
+        if os.path.splitext(basename)[-1] != '.bin':
+            continue
+        if len(include) and not matches_patterns(include, basename, name):
+            continue
+        if matches_patterns(exclude, basename, name):
+            continue
+        found.append((ArchiveMember(filepath, name, size, mtime_ns, offset), name, size))
+    return found
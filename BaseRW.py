@@ -1,27 +1,240 @@
-import struct
+import functools
 import io
+import mmap
+import operator
+import os
+import re
+import struct
+
+import ParseTrace
 
 
 class ViolatedAssumptionError(Exception):
     pass
 
 
+# How thoroughly files are checked as they are read. 'strict' checks every assumption about the layout of the file,
+# 'fast' only checks that counts and pointers stay within the file, so that a corrupt file cannot make a read allocate
+# more than the file holds, and 'off' checks nothing.
+validation_levels = ('strict', 'fast', 'off')
+
+
+@functools.lru_cache(maxsize=256)
+def compile_struct(fmt):
+    return struct.Struct(fmt)
+
+
+class RecordSchema:
+    """
+    A fixed-size record layout, declared once and compiled to a single struct.Struct.
+
+    Inputs
+    ------
+    fields -- a sequence of (name, dtype) or (name, dtype, expected_value) tuples. 'dtype' is a character known to the
+              struct package, optionally preceded by a repeat count, e.g. 'I', '8f' or '4s'. Repeated fields are read
+              as tuples and 's' fields are read as ASCII strings. Fields with an expected value are checked on every
+              read.
+    endianness -- whether to use little-endian (<) or big-endian (>) endianness. Default: big-endian.
+    """
+    dtype_pattern = re.compile(r"^(\d*)([xcbB?hHiIlLqQefds])$")
+
+    def __init__(self, fields, endianness='>'):
+        self.names = []
+        self.formats = []
+        self.offsets = []
+        self.groups = []
+        self.check_names = []
+        check_indices = []
+        expected_values = []
+        formats = []
+        position = 0
+        for name, dtype, *expected in fields:
+            count, code = self.dtype_pattern.match(dtype).groups()
+            count = int(count) if count else 1
+            self.names.append(name)
+            self.offsets.append(struct.calcsize(endianness + ''.join(formats)))
+            formats.append(dtype)
+            if code == 's':
+                self.groups.append((position, position + 1, 'ascii'))
+                position += 1
+            elif count > 1:
+                self.groups.append((position, position + count, 'tuple'))
+                position += count
+            else:
+                self.groups.append((position, position + 1, None))
+                if len(expected):
+                    self.check_names.append(name)
+                    check_indices.append(position)
+                    expected_values.append(expected[0])
+                position += 1
+        self.formats = formats
+        self.struct = struct.Struct(endianness + ''.join(formats))
+        self.size = self.struct.size
+        self.is_flat = all(kind is None for _, _, kind in self.groups)
+
+        self.expected_values = tuple(expected_values)
+        if len(check_indices) > 1:
+            self.get_checked = operator.itemgetter(*check_indices)
+        elif len(check_indices) == 1:
+            check_index = check_indices[0]
+            self.get_checked = lambda values: (values[check_index],)
+        else:
+            self.get_checked = lambda values: ()
+
+    def unpack(self, data, check=True):
+        return self.interpret(self.struct.unpack(data), check)
+
+    def unpack_from(self, buffer, offset=0, check=True):
+        return self.interpret(self.struct.unpack_from(buffer, offset), check)
+
+    def interpret(self, values, check=True):
+        """
+        Checks every expected value in one comparison, unless 'check' is unset, then groups the raw values
+        field-by-field.
+        """
+        if check and self.get_checked(values) != self.expected_values:
+            for name, actual, value in zip(self.check_names, self.get_checked(values), self.expected_values):
+                if actual != value:
+                    raise ViolatedAssumptionError(f"Violation of data structure assumption '{name} == {value}, "
+                                                  f"value is {actual}'.")
+        if self.is_flat:
+            return values
+        result = []
+        for start, stop, kind in self.groups:
+            if kind is None:
+                result.append(values[start])
+            elif kind == 'ascii':
+                result.append(values[start].decode('ascii'))
+            else:
+                result.append(values[start:stop])
+        return result
+
+    def offset_of(self, name):
+        """
+        Returns the position of the field called 'name' from the start of the record.
+        """
+        return self.offsets[self.names.index(name)]
+
+    def pack_into(self, buffer, offset, values):
+        flat_values = []
+        for value, (_, _, kind) in zip(values, self.groups):
+            if kind is None:
+                flat_values.append(value)
+            elif kind == 'ascii':
+                flat_values.append(value.encode('ascii'))
+            else:
+                flat_values.extend(value)
+        self.struct.pack_into(buffer, offset, *flat_values)
+
+
+class MappedReader:
+    """
+    A read-only, file-like view over a memory-mapped file (or any other buffer). Reads hand out memoryview slices of
+    the underlying buffer rather than copying the requested bytes into new bytes objects.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.position = 0
+
+    @classmethod
+    def from_file(cls, F):
+        """
+        Maps the whole of a file opened in 'read-binary' (rb) mode into memory. The map stays valid after the file
+        object itself is closed.
+        """
+        return cls(mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_stream(cls, stream):
+        """
+        Wraps the contents of any readable binary stream, from its current position to its end. The buffer of an
+        io.BytesIO is used without copying it and files on disk are mapped into memory; anything else, such as a
+        member of a zip file, is read into memory once.
+        """
+        if isinstance(stream, io.BytesIO):
+            return cls(stream.getbuffer()[stream.tell():])
+        if isinstance(stream, io.BufferedReader) and stream.tell() == 0:
+            try:
+                return cls.from_file(stream)
+            except (OSError, ValueError):
+                # Not a regular file, e.g. a pipe
+                pass
+        return cls(stream.read())
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + size, len(self.buffer))
+        self.position = end
+        return self.buffer[start:end]
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = len(self.buffer) + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return True
+
+
+def stream_size(bytestream):
+    """
+    Returns the size of the file behind a bytestream that BaseRW can read from.
+    """
+    if type(bytestream) == MappedReader:
+        return len(bytestream.buffer)
+    try:
+        return os.fstat(bytestream.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        position = bytestream.tell()
+        size = bytestream.seek(0, io.SEEK_END)
+        bytestream.seek(position)
+        return size
+
+
 class BaseRW:
     """
     This is a base class for bytestream parsing, intended to be able to read/write (RW) these bytestreams to/from files.
+
+    Every value read can be logged, along with its name and offset, by making a ParseTrace the current trace. Offsets
+    are logged relative to the start of the bytestream plus 'trace_offset', which readers of data embedded in a larger
+    file set to the position of that data in the file. If 'retain_header' is set, every value read is also kept in
+    'header'; this keeps the raw data alive for as long as the reader, so is off by default.
     """
+    retain_header = False
 
     def __init__(self, io_object=None):
         """
         Inputs
         ------
-        A filestream opened with 'read-binary' (rb) or 'write-binary' (wb) permissions.
+        A filestream opened with 'read-binary' (rb) or 'write-binary' (wb) permissions, any other seekable binary
+        stream, or a MappedReader.
         """
         self.bytestream = None
         self.subreaders = []
         self.set_file_rw(io_object)
         self.header = []
         self.endianness = '<'
+        # One of 'validation_levels'
+        self.validation = 'strict'
+        # Added to the offsets reported to the trace
+        self.trace_offset = 0
 
         self.pad_byte = b'\x00'
 
@@ -45,9 +258,11 @@ class BaseRW:
         }
 
     def set_file_rw(self, io_object):
-        assert (type(io_object) == io.BufferedReader) or (type(io_object) == io.BufferedWriter), \
-            f"Read-write object was instantiated with a {type(io_object)}, not a {io.BufferedReader} or " \
-            f"{io.BufferedWriter}. Ensure you are instantiating this object with a file opened in 'rb' or 'wb' mode."
+        assert type(io_object) == MappedReader or (isinstance(io_object, io.IOBase) and io_object.seekable()
+                                                   and not isinstance(io_object, io.TextIOBase)), \
+            f"Read-write object was instantiated with a {type(io_object)}, not a seekable binary stream or a " \
+            f"{MappedReader}. Ensure you are instantiating this object with a file opened in 'rb' or 'wb' mode, or " \
+            f"another binary stream such as an io.BytesIO or a member of a zip file."
         self.bytestream = io_object
         for lst in self.subreaders:
             for subreader in lst:
@@ -65,8 +280,8 @@ class BaseRW:
         required to store them, then reads this number of bytes from the bytestream and interprets them as those
         data.
 
-        Returns a single value if a single-element dtype is specified, else returns a tuple. Also appends the result to
-        the BaseRW 'header' for easy printing of all unpacked variables.
+        Returns a single value if a single-element dtype is specified, else returns a tuple. If 'retain_header' is set,
+        also appends the result to the BaseRW 'header' for easy printing of all unpacked variables.
 
         Arguments
         ------
@@ -81,27 +296,59 @@ class BaseRW:
         if endianness is None:
             endianness = self.endianness
 
-        buf = sum([self.type_buffers[dt] for dt in dtype])
-        result = struct.unpack(endianness + dtype, self.bytestream.read(buf))
+        compiled = compile_struct(endianness + dtype)
+        result = compiled.unpack(self.bytestream.read(compiled.size))
 
         if len(result) == 1 and not force_1d:
             result = result[0]
 
-        self.header.append(result)
+        if self.retain_header:
+            self.header.append(result)
         return result
 
     def read_buffer(self, variable, dtype, endianness=None, force_1d=False):
+        trace = ParseTrace.current
+        position = None if trace is None else self.bytestream.tell() + self.trace_offset
         val = self.unpack(dtype, endianness, force_1d)
+        if trace is not None:
+            trace.record(type(self).__name__, variable, position, dtype, val)
         setattr(self, variable, val)
 
+    def read_record(self, schema):
+        """
+        Reads every field of a RecordSchema with a single unpack and sets each field as an attribute.
+        """
+        position = self.bytestream.tell()
+        check = self.validation == 'strict'
+        if type(self.bytestream) == MappedReader:
+            values = schema.unpack_from(self.bytestream.buffer, position, check)
+            self.bytestream.seek(position + schema.size)
+        else:
+            values = schema.unpack(self.bytestream.read(schema.size), check)
+        if self.retain_header:
+            self.header.extend(values)
+        trace = ParseTrace.current
+        if trace is not None:
+            for name, dtype, offset, value in zip(schema.names, schema.formats, schema.offsets, values):
+                trace.record(type(self).__name__, name, self.trace_offset + position + offset, dtype, value)
+        self.__dict__.update(zip(schema.names, values))
+
     def read_ascii(self, variable, num_bytes=None):
         bytes_to_read = [] if num_bytes is None else [num_bytes]
-        val = self.bytestream.read(*bytes_to_read).decode('ascii')
+        trace = ParseTrace.current
+        position = None if trace is None else self.bytestream.tell() + self.trace_offset
+        val = str(self.bytestream.read(*bytes_to_read), 'ascii')
+        if trace is not None:
+            trace.record(type(self).__name__, variable, position, 'ascii', val)
         setattr(self, variable, val)
 
     def read_raw(self, variable, num_bytes=None):
         bytes_to_read = [] if num_bytes is None else [num_bytes]
+        trace = ParseTrace.current
+        position = None if trace is None else self.bytestream.tell() + self.trace_offset
         val = self.bytestream.read(*bytes_to_read)
+        if trace is not None:
+            trace.record(type(self).__name__, variable, position, 'raw', val)
         setattr(self, variable, val)
 
     def pack(self, value, dtype, endianness=None):
@@ -117,6 +364,11 @@ class BaseRW:
         to_write = self.pack(val, dtype, endianness)
         self.bytestream.write(to_write)
 
+    def write_record(self, schema):
+        buffer = bytearray(schema.size)
+        schema.pack_into(buffer, 0, [getattr(self, name) for name in schema.names])
+        self.bytestream.write(buffer)
+
     def write_ascii(self, variable, num_bytes=None):
         val = getattr(self, variable)
         if num_bytes is not None:
@@ -223,15 +475,30 @@ class BaseRW:
 
     # Stream validation functions
     # Should add a context arg to these
+    # The layout checks are only made when 'validation' is 'strict', and are written out rather than passed to
+    # 'check_assertion_now' as lambdas, since they run for every field
     def assert_file_pointer_now_at(self, location):
-        self.check_assertion_now(lambda location: self.bytestream.tell() == location,
-                                 lambda location: f"File pointer at {self.bytestream.tell()}, not at {location}.",
-                                 location)
+        if self.validation == 'strict' and self.bytestream.tell() != location:
+            raise ViolatedAssumptionError(f"Violation of data structure assumption "
+                                          f"'File pointer at {self.bytestream.tell()}, not at {location}.'.")
 
     def assert_equal(self, varname, value):
-        self.make_assertion(lambda varname, value: getattr(self, varname) == value,
-                            lambda varname, value: f"{varname} == {value}, value is {getattr(self, varname)}",
-                            varname, value)
+        if self.validation == 'strict' and getattr(self, varname) != value:
+            raise ViolatedAssumptionError(f"Violation of data structure assumption "
+                                          f"'{varname} == {value}, value is {getattr(self, varname)}'.")
+
+    def assert_fits_in_file(self, varname, count, item_size):
+        """
+        Checks that 'count' items of 'item_size' bytes fit between the current position and the end of the file, so
+        that a corrupt count or pointer cannot make a read allocate more than the file holds. Made unless 'validation'
+        is 'off'.
+        """
+        if self.validation == 'off':
+            return
+        remaining = stream_size(self.bytestream) - self.bytestream.tell()
+        if count < 0 or count * item_size > remaining:
+            raise ViolatedAssumptionError(f"Violation of data structure assumption '{varname} ({count}) items of "
+                                          f"{item_size} bytes fit in the {max(remaining, 0)} bytes left in the file'.")
 
     def assert_is_zero(self, varname):
         self.assert_equal(varname, 0)
@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from BaseRW import MappedReader, validation_levels
+from ColladaConvert import PXBItoCollada, build_collada_document
+from GLBConvert import PXBItoGLB
+from PXBIInterface import PXBIInterface, convert_gtf_to_dds
+from PXBIReader import PXBIReadWriter
+from SyntheticPXBI import corpus_presets, generate_corpus
+from VertexCache import optimize_vertex_cache, optimize_vertex_fetch, reorder_columns
+from VertexLayout import check_vertex_columns, decode_vertex_columns
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Corpus:
+    """
+    The files a benchmark runs over, along with a scratch folder for the stages to write to and the validation level
+    to read them with.
+    """
+    def __init__(self, filepaths, scratch_directory, validation='strict'):
+        self.filepaths = filepaths
+        self.scratch_directory = scratch_directory
+        self.validation = validation
+        self.total_size = sum(os.path.getsize(filepath) for filepath in filepaths)
+
+    def scratch_path(self, filepath, extension):
+        return os.path.join(self.scratch_directory, os.path.splitext(os.path.split(filepath)[-1])[0] + extension)
+
+
+def read_files(corpus):
+    for filepath in corpus.filepaths:
+        with open(filepath, 'rb') as F:
+            PXBIReadWriter(MappedReader.from_file(F)).read(validation=corpus.validation)
+    return corpus.total_size
+
+
+def load_files(corpus):
+    for filepath in corpus.filepaths:
+        PXBIInterface.from_file(filepath, validation=corpus.validation)
+    return corpus.total_size
+
+
+def load_textures(corpus):
+    return [PXBIInterface.from_file(filepath, sections=('textures',), validation=corpus.validation).texture_data_raw for filepath in corpus.filepaths]
+
+
+def convert_textures(textures):
+    processed = 0
+    for texture_data in textures:
+        for data in texture_data:
+            convert_gtf_to_dds(data)
+            processed += len(data)
+    return processed
+
+
+def load_models(corpus):
+    return corpus, [PXBIInterface.from_file(filepath, validation=corpus.validation) for filepath in corpus.filepaths]
+
+
+def build_documents(state):
+    corpus, models = state
+    for pi in models:
+        build_collada_document(pi, [texture_name for file_id, texture_name in pi.texture_names])
+    return corpus.total_size
+
+
+def build_all_documents(corpus):
+    corpus, models = load_models(corpus)
+    return corpus, [build_collada_document(pi, [texture_name for file_id, texture_name in pi.texture_names])
+                    for pi in models]
+
+
+def write_documents(state):
+    corpus, documents = state
+    processed = 0
+    for filepath, document in zip(corpus.filepaths, documents):
+        model_filepath = corpus.scratch_path(filepath, '.dae')
+        document.write(model_filepath)
+        processed += os.path.getsize(model_filepath)
+    return processed
+
+
+def load_readers(corpus):
+    readers = []
+    for filepath in corpus.filepaths:
+        with open(filepath, 'rb') as F:
+            reader = PXBIReadWriter(MappedReader.from_file(F))
+            reader.read(validation=corpus.validation)
+            readers.append((filepath, reader))
+    return readers
+
+
+def write_files(readers):
+    """
+    Packs each file that was read, and checks that the result is byte-for-byte the same as the file.
+    """
+    processed = 0
+    for filepath, reader in readers:
+        data = reader.pack()
+        with open(filepath, 'rb') as F:
+            if F.read() != data:
+                raise ValueError(f"Writing {filepath} back out did not reproduce the file.")
+        processed += len(data)
+    return processed
+
+
+def load_vertex_data(corpus):
+    """
+    Reads the raw vertex data of every mesh, and checks that the NumPy and pure-Python decoders agree on it.
+    """
+    vertex_data = []
+    for _, reader in load_readers(corpus):
+        for mesh in reader.meshes:
+            check_vertex_columns(mesh.raw_vertex_data, mesh.bytes_per_vertex, mesh.vertex_count)
+            vertex_data.append((mesh.raw_vertex_data, mesh.bytes_per_vertex, mesh.vertex_count))
+    return vertex_data
+
+
+def decode_vertex_data(vertex_data):
+    processed = 0
+    for data, bytes_per_vertex, vertex_count in vertex_data:
+        decode_vertex_columns(data, bytes_per_vertex, vertex_count)
+        processed += vertex_count * bytes_per_vertex
+    return processed
+
+
+def load_meshes(corpus):
+    _, models = load_models(corpus)
+    return [(mesh.triangle_indices, mesh.vertex_count, mesh.vertices, mesh.vertex_attribute_sizes)
+            for pi in models for mesh in pi.meshes]
+
+
+def optimize_meshes(meshes):
+    processed = 0
+    for indices, vertex_count, vertices, attribute_sizes in meshes:
+        indices = optimize_vertex_cache(indices, vertex_count)
+        indices, order = optimize_vertex_fetch(indices, vertex_count)
+        reorder_columns(vertices, attribute_sizes, order)
+        processed += len(indices) * indices.itemsize
+    return processed
+
+
+def convert_to(converter):
+    def convert(corpus):
+        for filepath in corpus.filepaths:
+            output_directory = os.path.join(corpus.scratch_directory, os.path.splitext(os.path.split(filepath)[-1])[0])
+            os.makedirs(output_directory, exist_ok=True)
+            converter(filepath, output_directory, validation=corpus.validation)
+        return corpus.total_size
+    return convert
+
+
+# Stage name, description, setup function and timed function. The setup function is called with the Corpus, and is not
+# timed; the timed function is called with whatever it returns, and returns the number of bytes it processed.
+benchmark_stages = (('read', "PXBIReadWriter.read", None, read_files),
+                    ('from_file', "PXBIInterface.from_file", None, load_files),
+                    ('write', "PXBIReadWriter.pack, round-trip", load_readers, write_files),
+                    ('vertex_decode', "decode_vertex_columns", load_vertex_data, decode_vertex_data),
+                    ('optimize_meshes', "optimize_vertex_cache and optimize_vertex_fetch", load_meshes,
+                     optimize_meshes),
+                    ('gtf_to_dds', "convert_gtf_to_dds", load_textures, convert_textures),
+                    ('collada_build', "build_collada_document", load_models, build_documents),
+                    ('collada_write', "ColladaDocument.write", build_all_documents, write_documents),
+                    ('convert_dae', "PXBItoCollada", None, convert_to(PXBItoCollada)),
+                    ('convert_glb', "PXBItoGLB", None, convert_to(PXBItoGLB)))
+
+
+def run_stage(setup, function, corpus, repeats):
+    """
+    Times 'function' over 'corpus', then runs it once more with tracemalloc to find its peak memory use.
+
+    Returns
+    ------
+    A dict of the best time in seconds, the bytes processed, the throughput in bytes per second, and the peak memory
+    in bytes allocated through Python. Memory-mapped files are not counted.
+    """
+    state = corpus if setup is None else setup(corpus)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        processed = function(state)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function(state)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    seconds = min(times)
+    return {"seconds": seconds,
+            "bytes": processed,
+            "bytes_per_second": processed / seconds if seconds else 0.,
+            "peak_memory": peak_memory}
+
+
+def run_benchmarks(corpus, stages, repeats, corpus_description):
+    results = {"corpus": corpus_description,
+               "python": platform.python_version(),
+               "numpy": np is not None,
+               "validation": corpus.validation,
+               "stages": {}}
+    for name, description, setup, function in benchmark_stages:
+        if name in stages:
+            results["stages"][name] = run_stage(setup, function, corpus, repeats)
+            print_result(name, description, results["stages"][name])
+    return results
+
+
+def print_result(name, description, result):
+    print(f"{name:<14} {result['seconds'] * 1000:>10.1f} ms {result['bytes_per_second'] / 2**20:>10.2f} MiB/s "
+          f"{result['peak_memory'] / 2**20:>10.2f} MiB peak  ({description})")
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Prints the change in time and peak memory of each stage relative to 'baseline'.
+
+    Returns
+    ------
+    A list of the names of the stages that are slower than the baseline by more than the fraction 'tolerance'.
+    """
+    if results["corpus"] != baseline["corpus"]:
+        print("Warning: the baseline was measured on a different corpus, so the comparison may not be meaningful.")
+    regressions = []
+    print()
+    print(f"{'stage':<14} {'time':>10} {'memory':>10}")
+    for name, result in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        base = baseline["stages"][name]
+        time_ratio = result["seconds"] / base["seconds"] if base["seconds"] else 1.
+        memory_ratio = result["peak_memory"] / base["peak_memory"] if base["peak_memory"] else 1.
+        regressed = time_ratio > 1. + tolerance
+        print(f"{name:<14} {time_ratio - 1.:>+10.1%} {memory_ratio - 1.:>+10.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Time each stage of reading and converting PXBI files.")
+    parser.add_argument("--corpus", metavar="FOLDER",
+                        help="benchmark the .bin files in this folder, rather than generated ones")
+    parser.add_argument("--preset", choices=sorted(corpus_presets), default='medium',
+                        help="the size of the generated models (default: medium)")
+    parser.add_argument("-n", "--count", type=int, default=5, help="the number of models to generate (default: 5)")
+    parser.add_argument("--repeats", type=int, default=3, help="time each stage this many times (default: 3)")
+    parser.add_argument("--stages", nargs='+', choices=[stage[0] for stage in benchmark_stages],
+                        default=[stage[0] for stage in benchmark_stages], help="the stages to run (default: all)")
+    parser.add_argument("--validation", choices=validation_levels, default='strict',
+                        help="how thoroughly to check the files as they are read (default: strict)")
+    parser.add_argument("--save", metavar="JSON", help="write the results to this file, to use as a baseline later")
+    parser.add_argument("--baseline", metavar="JSON", help="compare the results against a file written by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the fraction by which a stage may be slower than the baseline before it counts as a "
+                             "regression (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    scratch_directory = tempfile.mkdtemp(prefix="pxbi_benchmark_")
+    try:
+        if args.corpus is None:
+            filepaths = generate_corpus(os.path.join(scratch_directory, "corpus"), args.count, args.preset)
+            corpus_description = {"preset": args.preset, "count": args.count}
+        else:
+            filepaths = sorted(os.path.join(args.corpus, filename) for filename in os.listdir(args.corpus)
+                               if os.path.splitext(filename)[-1] == '.bin')
+            corpus_description = {"folder": os.path.abspath(args.corpus), "count": len(filepaths)}
+        output_directory = os.path.join(scratch_directory, "output")
+        os.makedirs(output_directory)
+        corpus = Corpus(filepaths, output_directory, args.validation)
+        print(f"Benchmarking {len(filepaths)} files, {corpus.total_size / 2**20:.2f} MiB in total.")
+
+        results = run_benchmarks(corpus, args.stages, args.repeats, corpus_description)
+    finally:
+        shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    if args.save is not None:
+        with open(args.save, 'w') as F:
+            json.dump(results, F, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as F:
+            baseline = json.load(F)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if len(regressions):
+            print(f"{len(regressions)} stages are slower than the baseline: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,180 +1,365 @@
 import os
 import struct 
 import sys
+import warnings
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
+import Profiling
+import VertexCache
 from ManualCollada import *
-from PXBIInterface import PXBIInterface    
-
-"""
-Borrowed from https://github.com/ThomIves/MatrixInverse,
-following from this answer https://stackoverflow.com/a/62940942
-"""
-def invert_matrix(AM, IM):
-    for fd in range(len(AM)):
-        fdScaler = 1.0 / AM[fd][fd]
-        for j in range(len(AM)):
-            AM[fd][j] *= fdScaler
-            IM[fd][j] *= fdScaler
-        for i in list(range(len(AM)))[0:fd] + list(range(len(AM)))[fd+1:]:
-            crScaler = AM[i][fd]
-            for j in range(len(AM)):
-                AM[i][j] = AM[i][j] - crScaler * AM[fd][j]
-                IM[i][j] = IM[i][j] - crScaler * IM[fd][j]
-    return IM
+from MatrixInverse import invert_matrices
+from PXBIInterface import PXBIInterface, convert_gtf_to_dds, source_name
+from TextureStore import TextureStore, write_atomically
+from VertexLayout import flatten_column
+
+# Vertex attribute name, COLLADA input semantic, accessor parameter names
+vertex_semantics = (('Position', 'VERTEX', ('X', 'Y', 'Z')),
+                    ('Normal', 'NORMAL', ('X', 'Y', 'Z')),
+                    ('UV', 'TEXCOORD', ('S', 'T')),
+                    ('Tangent', 'TANGENT', ('X', 'Y', 'Z')),
+                    ('Binormal', 'BINORMAL', ('X', 'Y', 'Z')),
+                    ('Color', 'COLOR', ('X', 'Y', 'Z')))
+
+class BindPoseWarning(UserWarning):
+    """
+    Issued when a bone matrix cannot be inverted accurately, so that the bone's bind pose is the identity or may be
+    inaccurate.
+    """
+
 
 def flatten_list(lst):
     return [subitem for item in lst for subitem in item]
 
 
-def PXBItoCollada(file, output_directory):
-    pi = PXBIInterface.from_file(file)
+def repeat_indices(indices, count):
+    """
+    Returns an array('H') holding each index of the array('H') 'indices' 'count' times in a row.
+    """
+    repeated = array('H', [0]) * (len(indices) * count)
+    for i in range(count):
+        repeated[i::count] = indices
+    return repeated
+
+
+class TextureDumpError(Exception):
+    """
+    Raised once every texture has been attempted, if any of them could not be written. 'errors' holds a
+    (filepath, exception) tuple for each failure.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} texture files could not be written:\n" +
+                         "\n".join(f"{filepath}: {error}" for filepath, error in errors))
+
+
+def write_dds_texture(filepath, gtf_data):
+    write_atomically(filepath, convert_gtf_to_dds(gtf_data))
+
+
+class TextureDump:
+    """
+    Writes the textures of a PXBIInterface to 'output_directory', at the paths given by their texture names, on a pool
+    of at most 'max_workers' background threads. If a TextureStore is given, the textures are added to the store
+    instead, and are made available to the model according to the link mode of the store.
+
+    The writes start as soon as the instance is created, so other work can be done while they run. 'sources' holds the
+    path each texture should be referenced by from the model, and is available immediately. 'finish' waits for the
+    writes to complete.
+    """
+    def __init__(self, pi, output_directory, texture_store=None, max_workers=4):
+        self.sources = []
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.jobs = []
+        try:
+            self.start(pi, output_directory, texture_store)
+        except BaseException:
+            self.cancel()
+            raise
+
+    def start(self, pi, output_directory, texture_store):
+        # The texture binaries are all fetched here, as the file they are read from must only be used from one thread
+        gtf_data = [pi.texture_data_raw[idx] for idx in range(len(pi.texture_names))]
+        gtf_filepaths = []
+        dds_filepaths = []
+        for file_id, texture_name in pi.texture_names:
+            dds_filepath = os.path.normpath(os.path.join(output_directory, texture_name[2:]))
+            gtf_filepaths.append(os.path.splitext(dds_filepath)[0] + '.gtf')
+            dds_filepaths.append(dds_filepath)
+
+        if texture_store is None or texture_store.link_mode != 'relative':
+            for directory in set(os.path.split(filepath)[0] for filepath in gtf_filepaths + dds_filepaths):
+                os.makedirs(directory, exist_ok=True)
+
+        # Files are replaced rather than overwritten, so that a link left by an earlier run using a TextureStore is never
+        # written through
+        if texture_store is None:
+            self.sources.extend(texture_name for file_id, texture_name in pi.texture_names)
+            # First to GTF, in case anybody wants to convert those manually
+            for filepath, data in zip(gtf_filepaths, gtf_data):
+                self.submit([filepath], write_atomically, filepath, data)
+            # Next do DDS
+            for filepath, data in zip(dds_filepaths, gtf_data):
+                self.submit([filepath], write_dds_texture, filepath, data)
+        elif texture_store.link_mode == 'relative':
+            for data in gtf_data:
+                digest = texture_store.hash(data)
+                filepaths = texture_store.stored_paths(digest)
+                self.sources.append(os.path.relpath(filepaths[1], output_directory).replace(os.sep, '/'))
+                self.submit(filepaths, texture_store.store, data, digest)
+        else:
+            self.sources.extend(texture_name for file_id, texture_name in pi.texture_names)
+            for data, gtf_filepath, dds_filepath in zip(gtf_data, gtf_filepaths, dds_filepaths):
+                self.submit([gtf_filepath, dds_filepath], texture_store.place, data, gtf_filepath, dds_filepath)
+
+    def submit(self, filepaths, function, *args):
+        self.jobs.append((filepaths, self.executor.submit(function, *args)))
+
+    def finish(self):
+        """
+        Waits for every texture to be written.
+
+        Returns
+        ------
+        A list of the paths of the files written or depended upon.
+
+        Raises
+        ------
+        TextureDumpError if any file could not be written.
+        """
+        self.executor.shutdown()
+        written = []
+        errors = []
+        for filepaths, job in self.jobs:
+            error = job.exception()
+            if error is None:
+                written.extend(filepaths)
+            else:
+                errors.append((filepaths[-1], error))
+        if len(errors):
+            raise TextureDumpError(errors)
+        return written
+
+    def cancel(self):
+        """
+        Cancels the writes that have not started yet and waits for the rest, so that nothing is written once it returns.
+        Used when the conversion fails before 'finish' is reached; does nothing after 'finish'.
+        """
+        # Cancelled one by one, since Executor.shutdown only takes 'cancel_futures' from Python 3.9
+        for _, job in self.jobs:
+            job.cancel()
+        self.executor.shutdown()
+
+
+def dump_textures(pi, output_directory, texture_store=None):
+    """
+    Writes the textures of a PXBIInterface as described in TextureDump, and waits for them to be written.
+
+    Returns
+    ------
+    A list of the paths of the files written or depended upon, and a list of the path each texture should be referenced
+    by from the model.
+    """
+    texture_dump = TextureDump(pi, output_directory, texture_store)
+    return texture_dump.finish(), texture_dump.sources
+
+
+def build_bone_hierarchy(pi):
+    """
+    Returns a dict mapping each bone index of a PXBIInterface to a list of the indices of its child bones. The root
+    bones are listed as the children of -1.
+    """
+    bone_to_joint = {bone_idx: bone_data[1] for bone_idx, bone_data in enumerate(pi.bone_data)}
+    joint_to_bone = {bone_data[1]: bone_idx for bone_idx, bone_data in enumerate(pi.bone_data)}
+    bone_parents = {bone_idx: joint_to_bone.get(pi.joint_data[idx][3], -1) for bone_idx, idx in bone_to_joint.items()}
+    
+    parents = {i: [] for i in range(-1, len(bone_parents))}
+    for child, parent in bone_parents.items():
+        parents[parent].append(child)
+    return parents
+
+
+def invert_bone_matrices(pi):
+    """
+    Returns the inverse of each bone matrix of a PXBIInterface, i.e. the bind pose of each bone, issuing a
+    BindPoseWarning for any bone whose matrix cannot be inverted accurately.
+    """
+    inverses, problems = invert_matrices([transform for name, joint, transform in pi.bone_data])
+    for idx, quality in problems:
+        if quality == 0.:
+            warnings.warn(f"Bone '{pi.bone_data[idx][0]}' has a singular matrix; its bind pose has been set to the "
+                          f"identity.", BindPoseWarning)
+        else:
+            warnings.warn(f"Bone '{pi.bone_data[idx][0]}' has an ill-conditioned matrix (conditioning {quality:.1e}); "
+                          f"its bind pose may be inaccurate.", BindPoseWarning)
+    return inverses
+
+
+def PXBItoCollada(file, output_directory, minify=False, precision=None, texture_store=None, texture_link='relative',
+                  shared_indices=False, optimize_meshes=False, validation='strict'):
+    """
+    Converts the PXBI file 'file' to a .dae file and its textures, written to 'output_directory'. 'file' may be a path
+    or a binary stream; see PXBIInterface.from_file.
+
+    'precision' maps vertex attribute names ('Position', 'UV', etc.), 'Weights' and 'Matrix' to the number of
+    significant digits to write those values with. Anything else is written exactly.
+
+    If 'texture_store' is the path of a folder, the textures are written to a TextureStore there, using 'texture_link'
+    as its link mode.
+
+    If 'shared_indices' is set, every input of a mesh's triangles reads from the same index, rather than each index
+    being repeated once per input. This makes the triangles several times smaller.
+
+    If 'optimize_meshes' is set, the triangles and vertices of each mesh are reordered for the vertex cache before
+    they are written (see VertexCache.optimize_meshes). The cache misses before and after are added to the current
+    profile's counters.
+
+    'validation' is passed on to PXBIInterface.from_file.
+
+    Returns
+    ------
+    A list of the paths of the files written.
+    """
+    pi = PXBIInterface.from_file(file, lazy=True, validation=validation)
+    base_filename = os.path.splitext(source_name(file))[0]
+    texture_store = None if texture_store is None else TextureStore(texture_store, texture_link)
+    # The textures are written in the background while the rest of the model is built and written
+    with Profiling.stage('textures.start'):
+        texture_dump = TextureDump(pi, output_directory, texture_store)
+    try:
+        if optimize_meshes:
+            VertexCache.optimize_meshes(pi)
+        model = build_collada_document(pi, texture_dump.sources, precision, shared_indices)
+
+        model_filepath = f'{os.path.join(output_directory, base_filename)}.dae'
+        with Profiling.stage('write.dae'):
+            model.write(model_filepath, minify)
+        with Profiling.stage('textures.wait'):
+            written = texture_dump.finish()
+    finally:
+        texture_dump.cancel()
+    written.append(model_filepath)
+    return written
+
+
+def build_collada_document(pi, image_sources, precision=None, shared_indices=False):
+    """
+    Builds a ColladaDocument from a PXBIInterface. 'image_sources' holds the path each texture is referenced by, and
+    the remaining arguments are as for PXBItoCollada.
+    """
+    precision = {} if precision is None else precision
     model = ColladaDocument()
     
     ####################
     #### START DUMP ####
     ####################
-    textures = []
-    effect_inputs = []
-    images = []
-    # Dump the textures
-    # First to GTF, in case anybody wants to convert those manually
-    for (file_id, texture_name), texture in zip(pi.texture_names, pi.texture_data_raw):
-        texture_filepath = os.path.normpath(os.path.join(output_directory, os.path.splitext(texture_name[2:])[0] + '.gtf'))
-        os.makedirs(os.path.split(texture_filepath)[0], exist_ok=True)
-        with open(texture_filepath, 'wb') as F:
-            F.write(texture)
-    
-    # Next do DDS
-    for (file_id, texture_name), texture in zip(pi.texture_names, pi.texture_data):
-        texture_filepath = os.path.normpath(os.path.join(output_directory, texture_name[2:]))
-        os.makedirs(os.path.split(texture_filepath)[0], exist_ok=True)
-        with open(texture_filepath, 'wb') as F:
-            F.write(texture)
-            
-        use_name = os.path.split(texture_name)[-1]
-        splitname = os.path.splitext(use_name)
-        img_name = "_".join((splitname[0], splitname[1][1:]))
-        surf_name = img_name + "-surf"
-        sampler_name = img_name + "-sampler"
-        map_name = img_name + "-map"
-        
-        image = ColladaImage(img_name, texture_name)
-        surface = ColladaSurface(surf_name, image)
-        sampler = ColladaSampler(sampler_name, surface)
-        texmap = ColladaMap(map_name, sampler, "UV0")
-        
-        model.images.append(image)
-        effect_inputs.append((surface, sampler))
-        textures.append(texmap)
+    with Profiling.stage('build.textures'):
+        textures = []
+        effect_inputs = []
+        images = []
+        for (file_id, texture_name), image_source in zip(pi.texture_names, image_sources):
+            use_name = os.path.split(texture_name)[-1]
+            splitname = os.path.splitext(use_name)
+            img_name = "_".join((splitname[0], splitname[1][1:]))
+            surf_name = img_name + "-surf"
+            sampler_name = img_name + "-sampler"
+            map_name = img_name + "-map"
+        
+            image = ColladaImage(img_name, image_source)
+            surface = ColladaSurface(surf_name, image)
+            sampler = ColladaSampler(sampler_name, surface)
+            texmap = ColladaMap(map_name, sampler, "UV0")
+        
+            model.images.append(image)
+            effect_inputs.append((surface, sampler))
+            textures.append(texmap)
     
     
-    materials = []
-    mat_nodes = []
-    for as_material in pi.materials:
-        maps = {}
-        local_samplers = []
-        for texture_data in as_material.assigned_textures:
-            role = texture_data.role
-            idx = texture_data.tex_idx
+    with Profiling.stage('build.materials'):
+        materials = []
+        mat_nodes = []
+        for as_material in pi.materials:
+            maps = {}
+            local_samplers = []
+            for texture_data in as_material.assigned_textures:
+                role = texture_data.role
+                idx = texture_data.tex_idx
             
-            maps[role] = textures[idx]
-            local_samplers.extend(effect_inputs[idx])
+                maps[role] = textures[idx]
+                local_samplers.extend(effect_inputs[idx])
         
-        effect = ColladaEffect(f"{as_material.name}_eff", local_samplers, "lambert", maps)
-        mat = ColladaMaterial(f"{as_material.name}_ID", f"{as_material.name}", effect)
-        model.effects.append(effect)
-        model.materials.append(mat)   
+            effect = ColladaEffect(f"{as_material.name}_eff", local_samplers, "lambert", maps)
+            mat = ColladaMaterial(f"{as_material.name}_ID", f"{as_material.name}", effect)
+            model.effects.append(effect)
+            model.materials.append(mat)   
         
-        materials.append(mat)
+            materials.append(mat)
         
-        #matnode = scene.MaterialNode(f"{as_material.name}", mat, inputs=[])
-        #materials.append(matnode)
+            #matnode = scene.MaterialNode(f"{as_material.name}", mat, inputs=[])
+            #materials.append(matnode)
     
-    armature = None
-    if len(pi.bone_data):
-        pi.bone_data[0][0] = "root"
-        armature = ColladaArmatureNode("armature", [[1., 0., 0., 0.],
-                                                    [0., 1., 0., 0.],
-                                                    [0., 0., 1., 0.],
-                                                    [0., 0., 0., 1.]])
-        bone_to_joint = {bone_idx: bone_data[1] for bone_idx, bone_data in enumerate(pi.bone_data)}
-        joint_to_bone = {bone_data[1]: bone_idx for bone_idx, bone_data in enumerate(pi.bone_data)}
-        bone_parents = {bone_idx: joint_to_bone.get(pi.joint_data[idx][3], -1) for bone_idx, idx in bone_to_joint.items()}
-        n_accounted = 0
-        
-        parents = {i: [] for i in range(-1, len(bone_parents))}
-        for child, parent in bone_parents.items():
-            parents[parent].append(child)
-        
-        
-        bonenodes = []
-        for name, joint, transform in pi.bone_data:
-            bone_node = ColladaBoneNode(name, armature, invert_matrix([list(item) for item in transform], 
-                                                                      [[1., 0., 0., 0.],
-                                                                       [0., 1., 0., 0.],
-                                                                       [0., 0., 1., 0.],
-                                                                       [0., 0., 0., 1.]]))
-            bonenodes.append(bone_node)
-        
-        for idx, children in parents.items():
-            if idx == -1:
-                continue
-            for child in children:
-                bonenodes[idx].child_nodes.append(bonenodes[child])
-        
-        armature.child_nodes.extend([bonenodes[i] for i in parents[-1]])
+    with Profiling.stage('build.skeleton'):
+        armature = None
+        if len(pi.bone_data):
+            pi.bone_data[0][0] = "root"
+            armature = ColladaArmatureNode("armature", [[1., 0., 0., 0.],
+                                                        [0., 1., 0., 0.],
+                                                        [0., 0., 1., 0.],
+                                                        [0., 0., 0., 1.]], precision.get('Matrix'))
+            parents = build_bone_hierarchy(pi)
+        
+            bonenodes = []
+            for (name, joint, transform), bind_pose in zip(pi.bone_data, invert_bone_matrices(pi)):
+                bone_node = ColladaBoneNode(name, armature, bind_pose, precision.get('Matrix'))
+                bonenodes.append(bone_node)
+        
+            for idx, children in parents.items():
+                if idx == -1:
+                    continue
+                for child in children:
+                    bonenodes[idx].child_nodes.append(bonenodes[child])
+        
+            armature.child_nodes.extend([bonenodes[i] for i in parents[-1]])
     
         
     
     
-    geom_nodes = []
-    for i, mesh in enumerate(pi.meshes):
-        input_list = ColladaInputList()
-        sources = []
-        if 'Position' in mesh.vertices[0]:
-            vert_src = ColladaFloatSource(f"{mesh.name}-{i}-Position", [vert['Position'] for vert in mesh.vertices], ('X', 'Y', 'Z'))  
-            input_list.add_input(len(input_list.inputs), 'VERTEX', vert_src)
-            sources.append(vert_src)
-        if 'Normal' in mesh.vertices[0]:
-            normal_src = ColladaFloatSource(f"{mesh.name}-{i}-Normal", [vert['Normal'] for vert in mesh.vertices], ('X', 'Y', 'Z'))
-            input_list.add_input(len(input_list.inputs), 'NORMAL', normal_src)
-            sources.append(normal_src)
-        if 'UV' in mesh.vertices[0]:
-            uv_src = ColladaFloatSource(f"{mesh.name}-{i}-UV", [vert['UV'] for vert in mesh.vertices], ('S', 'T'))
-            input_list.add_input(len(input_list.inputs), 'TEXCOORD', uv_src)
-            sources.append(uv_src)
-        if 'Tangent' in mesh.vertices[0]:
-            tangent_src = ColladaFloatSource(f"{mesh.name}-{i}-Tangent", [vert['Tangent'] for vert in mesh.vertices], ('X', 'Y', 'Z'))
-            input_list.add_input(len(input_list.inputs), 'TANGENT', tangent_src)
-            sources.append(tangent_src)
-        if 'Binormal' in mesh.vertices[0]:
-            binormal_src = ColladaFloatSource(f"{mesh.name}-{i}-Binormal", [vert['Binormal'] for vert in mesh.vertices], ('X', 'Y', 'Z'))   
-            input_list.add_input(len(input_list.inputs), 'BINORMAL', binormal_src)
-            sources.append(binormal_src)
-        if 'Color' in mesh.vertices[0]:
-            color_src = ColladaFloatSource(f"{mesh.name}-{i}-Color", [vert['Color'] for vert in mesh.vertices], ('X', 'Y', 'Z'))   
-            input_list.add_input(len(input_list.inputs), 'COLOR', color_src)
-            sources.append(color_src)
-        
-        
-        mat = materials[mesh.material_index]
-        indices = flatten_list([[item for _ in input_list.inputs] for item in flatten_list(mesh.triangles)])
-        triangle_set = ColladaTriangleSet(indices, input_list, mat)
-
-        geom = ColladaGeometry(f"{mesh.name}-{i}" + "-ID", f"{mesh.name}-{i}" + "-mesh", sources, triangle_set)
-        model.geometries.append(geom)
-        
-        if 'Weights' in mesh.vertices[0] and 'BoneIndices' in mesh.vertices[0]:
-            skin_controller = ColladaSkinController("armature", geom, [bone[0] for bone in pi.bone_data],
-                                                    [bone[-1] for bone in pi.bone_data],
-                                                    [v['Weights'] for v in mesh.vertices],
-                                                    [v['BoneIndices'] for v in mesh.vertices])
+    with Profiling.stage('build.geometry'):
+        geom_nodes = []
+        for i, mesh in enumerate(pi.meshes):
+            input_list = ColladaInputList()
+            sources = []
+            for attribute, semantic, param_names in vertex_semantics:
+                if attribute in mesh.vertices:
+                    src = ColladaFloatSource(f"{mesh.name}-{i}-{attribute}", flatten_column(mesh.vertices[attribute]),
+                                             mesh.vertex_attribute_sizes[attribute], param_names, precision.get(attribute))
+                    input_list.add_input(len(input_list.inputs), semantic, src)
+                    sources.append(src)
+        
+        
+            mat = materials[mesh.material_index]
+            if shared_indices:
+                indices = mesh.triangle_indices
+            else:
+                indices = repeat_indices(mesh.triangle_indices, len(input_list.inputs))
+            triangle_set = ColladaTriangleSet(indices, input_list, mat, shared_indices)
+
+            geom = ColladaGeometry(f"{mesh.name}-{i}" + "-ID", f"{mesh.name}-{i}" + "-mesh", sources, triangle_set)
+            model.geometries.append(geom)
+        
+            if 'Weights' in mesh.vertices and 'BoneIndices' in mesh.vertices:
+                skin_controller = ColladaSkinController("armature", geom, [bone[0] for bone in pi.bone_data],
+                                                        [bone[-1] for bone in pi.bone_data],
+                                                        flatten_column(mesh.vertices['Weights']),
+                                                        flatten_column(mesh.vertices['BoneIndices']),
+                                                        mesh.vertex_attribute_sizes['Weights'],
+                                                        precision.get('Matrix'), precision.get('Weights'))
             
-            model.controllers.append(skin_controller)
+                model.controllers.append(skin_controller)
         
-            geom_nodes.append(ColladaSkinnedGeometryNode(mesh.name, mesh.name, geom, mat, armature, skin_controller))
-        else:
-            geom_nodes.append(ColladaUnskinnedGeometryNode(mesh.name, mesh.name, geom, mat))
+                geom_nodes.append(ColladaSkinnedGeometryNode(mesh.name, mesh.name, geom, mat, armature, skin_controller))
+            else:
+                geom_nodes.append(ColladaUnskinnedGeometryNode(mesh.name, mesh.name, geom, mat))
         
         
     
@@ -188,8 +373,5 @@ def PXBItoCollada(file, output_directory):
         armature.child_nodes.extend(geom_nodes)
         scene.child_nodes.append(armature)
     model.scenes.append(scene)
-    
-    base_filename = os.path.splitext(os.path.split(file)[-1])[0]
-    
-    model.write(f'{os.path.join(output_directory, base_filename)}.dae')
+    return model
     
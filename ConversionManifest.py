@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+
+# Increment whenever a change to the converters alters the files they write, so that existing outputs are regenerated
+CONVERTER_VERSION = 3
+
+MANIFEST_FILENAME = "conversion_manifest.json"
+# Increment whenever the layout of the manifest changes; manifests with a different layout are discarded
+MANIFEST_VERSION = 2
+
+
+def hash_file(filepath, chunksize=1 << 20):
+    """
+    Returns the SHA-256 of a file, given its path or an ArchiveSource.ArchiveMember.
+    """
+    if not isinstance(filepath, str):
+        return hashlib.sha256(filepath.read()).hexdigest()
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as F:
+        for chunk in iter(lambda: F.read(chunksize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_stat(filepath):
+    """
+    Returns the size and modification time of a file, given its path or an ArchiveSource.ArchiveMember.
+    """
+    if not isinstance(filepath, str):
+        return filepath.size, filepath.mtime_ns
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ConversionManifest:
+    """
+    Records, for every converted input and output format, the input's size, modification time and content hash, the
+    converter version and export options used, and the files written. Used to skip inputs whose outputs are already up
+    to date. Each output format is recorded separately, so that converting the same inputs to several formats in the
+    same output directory does not invalidate the others.
+
+    The manifest is stored as JSON in the root output directory. Output paths are stored relative to that directory.
+    Inputs can be paths or members of archives (see ArchiveSource.ArchiveMember).
+    """
+    def __init__(self, output_root):
+        self.output_root = output_root
+        self.path = os.path.join(output_root, MANIFEST_FILENAME)
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as F:
+                contents = json.load(F)
+            if contents.get("manifest_version") == MANIFEST_VERSION:
+                self.entries = contents.get("entries", {})
+
+    @staticmethod
+    def key(filepath):
+        if not isinstance(filepath, str):
+            return filepath.key()
+        return os.path.normcase(os.path.abspath(filepath))
+
+    def check(self, filepath, output_format, options, verify=False):
+        """
+        Determines whether the outputs recorded for converting 'filepath' to 'output_format' are up to date.
+
+        The content hash is only computed if the size or modification time of the input have changed, unless 'verify'
+        is set, in which case it is always computed and the recorded output sizes are checked too.
+
+        Returns
+        ------
+        None if the outputs are up to date, otherwise a short description of why they are not.
+        """
+        entry = self.entries.get(self.key(filepath), {}).get(output_format)
+        if entry is None:
+            return "new input"
+        if entry["converter_version"] != CONVERTER_VERSION or entry["options"] != options:
+            return "converter or options changed"
+
+        for output, size in entry["outputs"].items():
+            output_path = os.path.join(self.output_root, output)
+            if not os.path.isfile(output_path):
+                return f"missing output {output}"
+            if verify and os.path.getsize(output_path) != size:
+                return f"modified output {output}"
+
+        size, mtime_ns = source_stat(filepath)
+        if not verify and size == entry["size"] and mtime_ns == entry["mtime_ns"]:
+            return None
+        if hash_file(filepath) != entry["sha256"]:
+            return "input changed"
+        # Touched but not modified; remember the new timestamp so the hash is not needed next time
+        entry["size"] = size
+        entry["mtime_ns"] = mtime_ns
+        return None
+
+    def record(self, filepath, sha256, output_format, options, outputs):
+        size, mtime_ns = source_stat(filepath)
+        formats = self.entries.setdefault(self.key(filepath), {})
+        formats[output_format] = {"size": size,
+                                  "mtime_ns": mtime_ns,
+                                  "sha256": sha256,
+                                  "converter_version": CONVERTER_VERSION,
+                                  "options": options,
+                                  "outputs": {os.path.relpath(output, self.output_root): os.path.getsize(output)
+                                              for output in outputs}}
+
+    def forget(self, filepath, output_format):
+        """
+        Removes the record of converting 'filepath' to 'output_format', leaving those of any other formats.
+        """
+        formats = self.entries.get(self.key(filepath), {})
+        formats.pop(output_format, None)
+        if not len(formats):
+            self.entries.pop(self.key(filepath), None)
+
+    def save(self):
+        os.makedirs(self.output_root, exist_ok=True)
+        # Write to a temporary file first, so an interrupted run cannot leave a truncated manifest behind
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as F:
+            json.dump({"manifest_version": MANIFEST_VERSION, "converter_version": CONVERTER_VERSION,
+                       "entries": self.entries}, F, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
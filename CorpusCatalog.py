@@ -0,0 +1,284 @@
+import argparse
+import os
+import sqlite3
+import struct
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from BaseRW import MappedReader
+from InputFiles import find_bin_files
+from PXBIReader import PXBIReadWriter
+
+# Increment whenever the tables or what is scanned into them change, so that existing catalogs are rescanned
+CATALOG_VERSION = 1
+
+CATALOG_FILENAME = "catalog.sqlite"
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY,
+                                  path TEXT UNIQUE NOT NULL,
+                                  name TEXT NOT NULL,
+                                  size INTEGER NOT NULL,
+                                  mtime_ns INTEGER NOT NULL,
+                                  scanned_at REAL NOT NULL,
+                                  error TEXT,
+                                  mesh_count INTEGER,
+                                  material_count INTEGER,
+                                  texture_count INTEGER,
+                                  bone_count INTEGER,
+                                  joint_count INTEGER,
+                                  vertex_count INTEGER,
+                                  triangle_count INTEGER,
+                                  texture_bytes INTEGER);
+CREATE TABLE IF NOT EXISTS meshes (file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                                   idx INTEGER NOT NULL,
+                                   name TEXT,
+                                   bytes_per_vertex INTEGER,
+                                   vertex_count INTEGER,
+                                   triangle_count INTEGER,
+                                   material_index INTEGER,
+                                   PRIMARY KEY (file_id, idx));
+CREATE TABLE IF NOT EXISTS materials (file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                                      idx INTEGER NOT NULL,
+                                      name TEXT,
+                                      texture_count INTEGER,
+                                      PRIMARY KEY (file_id, idx));
+CREATE TABLE IF NOT EXISTS material_textures (file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                                              material_idx INTEGER NOT NULL,
+                                              role_id INTEGER,
+                                              role TEXT,
+                                              texture_idx INTEGER);
+CREATE TABLE IF NOT EXISTS textures (file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                                     idx INTEGER NOT NULL,
+                                     file_name TEXT,
+                                     texture_name TEXT,
+                                     size INTEGER,
+                                     codec INTEGER,
+                                     mipmap_count INTEGER,
+                                     width INTEGER,
+                                     height INTEGER,
+                                     PRIMARY KEY (file_id, idx));
+CREATE INDEX IF NOT EXISTS meshes_by_stride ON meshes (bytes_per_vertex);
+CREATE INDEX IF NOT EXISTS textures_by_codec ON textures (codec);
+CREATE INDEX IF NOT EXISTS material_textures_by_file ON material_textures (file_id);
+"""
+
+
+def scan_file(filepath):
+    """
+    Reads the metadata of a PXBI file: its header, the mesh headers, the materials, the texture tables and the header
+    of each texture, and the names in the string table. Vertices, triangles, bones and texture data are skipped. This
+    runs in the worker processes, so must not raise.
+
+    Returns
+    ------
+    A dict of the rows to store for the file, or of the formatted traceback under "error" if it could not be read.
+    """
+    # If the file cannot even be found, it is recorded with a size that never matches, so it is rescanned if it returns
+    result = {"path": filepath, "size": -1, "mtime_ns": -1}
+    try:
+        stat = os.stat(filepath)
+        result.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        with open(filepath, 'rb') as F:
+            rdr = PXBIReadWriter(MappedReader.from_file(F))
+            rdr.read(sections=('meshes', 'materials', 'textures'), lazy=True)
+        result["meshes"] = [(idx, mesh.name, mesh.bytes_per_vertex, mesh.vertex_count, mesh.triangle_count // 3,
+                             mesh.some_id) for idx, mesh in enumerate(rdr.meshes)]
+        result["materials"] = [(idx, material.name, material.texture_count) for idx, material in enumerate(rdr.materials)]
+        result["material_textures"] = [(idx, texture.role_id, texture.role, texture.tex_idx)
+                                       for idx, material in enumerate(rdr.materials)
+                                       for texture in material.assigned_textures]
+        textures = []
+        for idx, (file_name, texture_name) in enumerate(rdr.texture_names):
+            # Only the page holding the GTF header is touched, since the texture is a view of the mapped file
+            gtf_data = rdr.read_texture(idx)
+            codec, mipmap_count = struct.unpack_from('>BB', gtf_data, 24)
+            width, height = struct.unpack_from('>HH', gtf_data, 32)
+            textures.append((idx, file_name, texture_name, len(gtf_data), codec, mipmap_count, width, height))
+        result["textures"] = textures
+        result["bone_count"] = rdr.bone_count
+        result["joint_count"] = rdr.joint_count
+    except Exception:
+        result["error"] = traceback.format_exc()
+    return result
+
+
+class CorpusCatalog:
+    """
+    An SQLite index of the metadata of a collection of PXBI files, which can be queried without reading the files
+    again. See 'catalog_schema' for the tables.
+
+    Each file is keyed by its absolute path, and is only rescanned when its size or modification time changes.
+    """
+    def __init__(self, path=CATALOG_FILENAME):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(catalog_schema)
+        version = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or int(version[0]) != CATALOG_VERSION:
+            # Everything is rescanned on the next refresh
+            with self.connection:
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CATALOG_VERSION),))
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def key(filepath):
+        return os.path.normcase(os.path.abspath(filepath))
+
+    def stale_files(self, filepaths):
+        """
+        Returns the paths in 'filepaths' that are not in the catalog, or whose size or modification time have changed.
+        """
+        recorded = {path: (size, mtime_ns) for path, size, mtime_ns
+                    in self.connection.execute("SELECT path, size, mtime_ns FROM files")}
+        stale = []
+        for filepath in filepaths:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                # Gone since it was found; scanning it records the error
+                stale.append(filepath)
+                continue
+            if recorded.get(self.key(filepath)) != (stat.st_size, stat.st_mtime_ns):
+                stale.append(filepath)
+        return stale
+
+    def refresh(self, root, include=(), exclude=(), n_workers=1):
+        """
+        Brings the catalog up to date with the .bin files below 'root': new and changed files are scanned, and files
+        that no longer exist are removed. 'include' and 'exclude' are as for InputFiles.find_bin_files.
+
+        Returns
+        ------
+        The number of files scanned, the number removed, and a list of (path, traceback) tuples for the files that
+        could not be read. Unreadable files are still recorded, with their error, so they are not rescanned until they
+        change.
+        """
+        filepaths = [filepath for filepath, _, _ in find_bin_files(root, include, exclude)]
+        stale = self.stale_files(filepaths)
+        if n_workers == 1:
+            return self.store_results(root, filepaths, stale, map(scan_file, stale))
+        with ProcessPoolExecutor(n_workers) as executor:
+            return self.store_results(root, filepaths, stale, executor.map(scan_file, stale, chunksize=16))
+
+    def store_results(self, root, filepaths, stale, results):
+        """
+        Stores the results of scanning the 'stale' files, and removes the files below 'root' that are not in
+        'filepaths', in a single transaction. Returns the same as 'refresh'.
+        """
+        failures = []
+        with self.connection:
+            for result in results:
+                self.store(result)
+                if "error" in result:
+                    failures.append((result["path"], result["error"]))
+
+            # Remove anything under 'root' that was not found, unless it was filtered out
+            prefix = os.path.join(self.key(root), '')
+            found = {self.key(filepath) for filepath in filepaths}
+            removed = [(path,) for path, in self.connection.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?",
+                                                                    (len(prefix), prefix))
+                       if path not in found and not os.path.isfile(path)]
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        return len(stale), len(removed), failures
+
+    def store(self, result):
+        path = self.key(result["path"])
+        self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        if "error" in result:
+            self.connection.execute("INSERT INTO files (path, name, size, mtime_ns, scanned_at, error) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    (path, os.path.split(path)[-1], result["size"], result["mtime_ns"], time.time(),
+                                     result["error"]))
+            return
+
+        meshes = result["meshes"]
+        cursor = self.connection.execute(
+            "INSERT INTO files (path, name, size, mtime_ns, scanned_at, mesh_count, material_count, texture_count, "
+            "bone_count, joint_count, vertex_count, triangle_count, texture_bytes) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, os.path.split(path)[-1], result["size"], result["mtime_ns"], time.time(), len(meshes),
+             len(result["materials"]), len(result["textures"]), result["bone_count"], result["joint_count"],
+             sum(mesh[3] for mesh in meshes), sum(mesh[4] for mesh in meshes),
+             sum(texture[3] for texture in result["textures"])))
+        file_id = cursor.lastrowid
+        self.connection.executemany("INSERT INTO meshes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    [(file_id, *mesh) for mesh in meshes])
+        self.connection.executemany("INSERT INTO materials VALUES (?, ?, ?, ?)",
+                                    [(file_id, *material) for material in result["materials"]])
+        self.connection.executemany("INSERT INTO material_textures VALUES (?, ?, ?, ?, ?)",
+                                    [(file_id, *assignment) for assignment in result["material_textures"]])
+        self.connection.executemany("INSERT INTO textures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(file_id, *texture) for texture in result["textures"]])
+
+    def query(self, sql, parameters=()):
+        """
+        Runs an SQL query against the catalog.
+
+        Returns
+        ------
+        A list of the column names and a list of the rows.
+        """
+        cursor = self.connection.execute(sql, parameters)
+        return [column[0] for column in cursor.description or ()], cursor.fetchall()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Index the metadata of PXBI (.bin) files in an SQLite catalog, and "
+                                                 "query it.")
+    parser.add_argument("--catalog", default=CATALOG_FILENAME,
+                        help=f"the catalog file to use (default: {CATALOG_FILENAME})")
+    subparsers = parser.add_subparsers(dest="command")
+    scan_parser = subparsers.add_parser("scan", help="add the .bin files in a folder to the catalog, rescanning only "
+                                                     "the files that have changed")
+    scan_parser.add_argument("folder", help="the folder to search recursively for .bin files")
+    scan_parser.add_argument("-j", "--jobs", type=int, default=1,
+                             help="number of files to scan in parallel; 0 uses every CPU (default: 1)")
+    scan_parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                             help="only scan files whose name or relative path matches this pattern (repeatable)")
+    scan_parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                             help="skip files whose name or relative path matches this pattern (repeatable)")
+    query_parser = subparsers.add_parser("query", help="run an SQL query against the catalog")
+    query_parser.add_argument("sql", help="the query, e.g. \"SELECT name FROM files WHERE bone_count > 120\"")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    catalog = CorpusCatalog(args.catalog)
+    try:
+        if args.command == "scan":
+            if not os.path.isdir(args.folder):
+                print(f"'{args.folder}' was not recognised as a directory.")
+                return 1
+            start = time.perf_counter()
+            n_workers = args.jobs if args.jobs > 0 else os.cpu_count()
+            scanned, removed, failures = catalog.refresh(args.folder, args.include, args.exclude, n_workers)
+            print(f"Scanned {scanned} files and removed {removed} in {time.perf_counter() - start:.2f} s.")
+            if len(failures):
+                print(f"{len(failures)} files could not be read:")
+                for filepath, error in failures:
+                    print()
+                    print(f"{filepath}:")
+                    print(error)
+                return 1
+        else:
+            columns, rows = catalog.query(args.sql)
+            if len(columns):
+                print('\t'.join(columns))
+            for row in rows:
+                print('\t'.join(str(value) for value in row))
+    finally:
+        catalog.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
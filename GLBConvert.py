@@ -0,0 +1,275 @@
+import json
+import os
+import struct
+import sys
+from array import array
+
+import Profiling
+import VertexCache
+from ColladaConvert import TextureDump, build_bone_hierarchy, flatten_list, invert_bone_matrices
+from PXBIInterface import PXBIInterface, source_name
+from TextureStore import TextureStore
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# glTF accessor component types
+GL_UNSIGNED_SHORT = 5123
+GL_FLOAT = 5126
+
+# glTF buffer view targets
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+
+# Vertex attribute name, glTF attribute name, glTF accessor type
+vertex_semantics = (('Position', 'POSITION', 'VEC3'),
+                    ('Normal', 'NORMAL', 'VEC3'),
+                    ('UV', 'TEXCOORD_0', 'VEC2'),
+                    ('Color', 'COLOR_0', 'VEC4'),
+                    ('Weights', 'WEIGHTS_0', 'VEC4'))
+
+
+def multiply_matrices(A, B):
+    return [[sum(A[i][k] * B[k][j] for k in range(4)) for j in range(4)] for i in range(4)]
+
+
+def column_major(matrix):
+    """
+    glTF stores matrices column-by-column, whereas the bone matrices are stored row-by-row.
+    """
+    return [float(matrix[row][col]) for col in range(4) for row in range(4)]
+
+
+def pack_floats(column):
+    """
+    Returns a vertex column (or any sequence of floats) as little-endian float32 bytes, byteswapping in bulk.
+    """
+    if np is not None and isinstance(column, np.ndarray):
+        return np.ascontiguousarray(column, dtype='<f4').tobytes()
+    if type(column) != array or column.typecode != 'f' or sys.byteorder == 'big':
+        column = array('f', column)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def pack_ushorts(values):
+    """
+    Returns a sequence of integers as little-endian uint16 bytes. Float vertex columns holding whole numbers, such as
+    'BoneIndices', are converted in bulk.
+    """
+    if np is not None and isinstance(values, np.ndarray):
+        return np.asarray(values, dtype='<u2').tobytes()
+    if isinstance(values, array) and values.typecode == 'f':
+        values = map(int, values)
+    data = array('H', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+class GLBBuffer:
+    """
+    Accumulates the binary chunk of a .glb file along with the buffer views and accessors that describe it.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.byte_length = 0
+        self.buffer_views = []
+        self.accessors = []
+
+    def add_buffer_view(self, data, target=None):
+        padding = (4 - self.byte_length % 4) % 4
+        if padding:
+            self.chunks.append(b'\x00' * padding)
+            self.byte_length += padding
+        buffer_view = {"buffer": 0, "byteOffset": self.byte_length, "byteLength": len(data)}
+        if target is not None:
+            buffer_view["target"] = target
+        self.chunks.append(data)
+        self.byte_length += len(data)
+        self.buffer_views.append(buffer_view)
+        return len(self.buffer_views) - 1
+
+    def add_accessor(self, data, component_type, count, accessor_type, target=None, minimum=None, maximum=None):
+        accessor = {"bufferView": self.add_buffer_view(data, target),
+                    "componentType": component_type,
+                    "count": count,
+                    "type": accessor_type}
+        if minimum is not None:
+            accessor["min"] = minimum
+            accessor["max"] = maximum
+        self.accessors.append(accessor)
+        return len(self.accessors) - 1
+
+    def to_bytes(self):
+        padding = (4 - self.byte_length % 4) % 4
+        return b''.join(self.chunks) + b'\x00' * padding
+
+
+def write_glb(path, document, binary):
+    json_chunk = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * ((4 - len(json_chunk) % 4) % 4)
+    total_length = 12 + 8 + len(json_chunk) + 8 + len(binary)
+    with open(path, 'wb') as F:
+        F.write(b''.join([struct.pack('<4sII', b'glTF', 2, total_length),
+                          struct.pack('<I4s', len(json_chunk), b'JSON'), json_chunk,
+                          struct.pack('<I4s', len(binary), b'BIN\x00'), binary]))
+
+
+def PXBItoGLB(file, output_directory, texture_store=None, texture_link='relative', optimize_meshes=False,
+              validation='strict'):
+    """
+    Converts the PXBI file 'file' to a binary glTF (.glb) file and its textures, written to 'output_directory'. 'file'
+    may be a path or a binary stream; see PXBIInterface.from_file.
+
+    The textures are written in the same way as by ColladaConvert.PXBItoCollada, including the use of 'texture_store'
+    and 'texture_link', and are referenced from the .glb as DDS images through the MSFT_texture_dds extension.
+    'optimize_meshes' is as for PXBItoCollada, and 'validation' is passed on to PXBIInterface.from_file.
+
+    Returns
+    ------
+    A list of the paths of the files written.
+    """
+    pi = PXBIInterface.from_file(file, lazy=True, validation=validation)
+    base_filename = os.path.splitext(source_name(file))[0]
+    texture_store = None if texture_store is None else TextureStore(texture_store, texture_link)
+    # The textures are written in the background while the rest of the model is built and written
+    with Profiling.stage('textures.start'):
+        texture_dump = TextureDump(pi, output_directory, texture_store)
+    try:
+        if optimize_meshes:
+            VertexCache.optimize_meshes(pi)
+        document, binary = build_glb_document(pi, texture_dump.sources)
+
+        model_filepath = f'{os.path.join(output_directory, base_filename)}.glb'
+        with Profiling.stage('write.glb'):
+            write_glb(model_filepath, document, binary)
+        with Profiling.stage('textures.wait'):
+            written = texture_dump.finish()
+    finally:
+        texture_dump.cancel()
+    written.append(model_filepath)
+    return written
+
+
+def build_glb_document(pi, image_sources):
+    """
+    Builds the glTF document of a PXBIInterface, referencing the textures by the paths in 'image_sources'.
+
+    Returns
+    ------
+    The glTF JSON as a dict, and the contents of its binary chunk.
+    """
+    buffer = GLBBuffer()
+    nodes = []
+    scene_nodes = []
+
+    images = []
+    for image_source in image_sources:
+        uri = image_source.replace('\\', '/')
+        if uri.startswith('./'):
+            uri = uri[2:]
+        images.append({"uri": uri, "mimeType": "image/vnd-ms.dds"})
+    textures = [{"extensions": {"MSFT_texture_dds": {"source": i}}} for i in range(len(images))]
+
+    with Profiling.stage('build.materials'):
+        materials = []
+        for as_material in pi.materials:
+            material = {"name": as_material.name, "pbrMetallicRoughness": {"metallicFactor": 0.}}
+            for texture_data in as_material.assigned_textures:
+                if texture_data.role == 'diffuse':
+                    material["pbrMetallicRoughness"]["baseColorTexture"] = {"index": texture_data.tex_idx}
+                elif texture_data.role == 'bumpmap':
+                    material["normalTexture"] = {"index": texture_data.tex_idx}
+            materials.append(material)
+
+    with Profiling.stage('build.skeleton'):
+        skin = None
+        if len(pi.bone_data):
+            pi.bone_data[0][0] = "root"
+            parents = build_bone_hierarchy(pi)
+            # The bone matrices are inverse bind matrices; glTF nodes need transforms relative to their parent bone
+            world_matrices = invert_bone_matrices(pi)
+            local_matrices = list(world_matrices)
+            for parent, children in parents.items():
+                if parent == -1:
+                    continue
+                for child in children:
+                    local_matrices[child] = multiply_matrices([list(row) for row in pi.bone_data[parent][2]],
+                                                              world_matrices[child])
+
+            for (name, joint, transform), local_matrix in zip(pi.bone_data, local_matrices):
+                nodes.append({"name": name, "matrix": column_major(local_matrix)})
+            for parent, children in parents.items():
+                if parent != -1 and len(children):
+                    nodes[parent]["children"] = children
+            nodes.append({"name": "armature", "children": parents[-1]})
+            armature_idx = len(nodes) - 1
+            scene_nodes.append(armature_idx)
+
+            inverse_bind_matrices = flatten_list([column_major(transform) for name, joint, transform in pi.bone_data])
+            skin = {"joints": list(range(len(pi.bone_data))),
+                    "skeleton": armature_idx,
+                    "inverseBindMatrices": buffer.add_accessor(pack_floats(inverse_bind_matrices), GL_FLOAT,
+                                                               len(pi.bone_data), "MAT4")}
+
+    with Profiling.stage('build.geometry'):
+        meshes = []
+        for i, mesh in enumerate(pi.meshes):
+            # glTF accessors cannot be empty, so meshes with nothing to draw are left out
+            if mesh.vertex_count == 0 or len(mesh.triangle_indices) == 0:
+                continue
+            skinned = skin is not None and 'Weights' in mesh.vertices and 'BoneIndices' in mesh.vertices
+            attributes = {}
+            for attribute, gltf_attribute, accessor_type in vertex_semantics:
+                if attribute not in mesh.vertices or (attribute == 'Weights' and not skinned):
+                    continue
+                column = mesh.vertices[attribute]
+                minimum = maximum = None
+                if attribute == 'Position':
+                    size = mesh.vertex_attribute_sizes[attribute]
+                    if np is not None and isinstance(column, np.ndarray):
+                        minimum, maximum = column.min(axis=0).tolist(), column.max(axis=0).tolist()
+                    else:
+                        minimum = [min(column[c::size]) for c in range(size)]
+                        maximum = [max(column[c::size]) for c in range(size)]
+                attributes[gltf_attribute] = buffer.add_accessor(pack_floats(column), GL_FLOAT, mesh.vertex_count,
+                                                                 accessor_type, GL_ARRAY_BUFFER, minimum, maximum)
+            if skinned:
+                bone_indices = pack_ushorts(mesh.vertices['BoneIndices'])
+                attributes['JOINTS_0'] = buffer.add_accessor(bone_indices, GL_UNSIGNED_SHORT, mesh.vertex_count, 'VEC4',
+                                                             GL_ARRAY_BUFFER)
+
+            indices = mesh.triangle_indices
+            primitive = {"attributes": attributes,
+                         "indices": buffer.add_accessor(pack_ushorts(indices), GL_UNSIGNED_SHORT, len(indices), 'SCALAR',
+                                                        GL_ELEMENT_ARRAY_BUFFER),
+                         "material": mesh.material_index}
+            meshes.append({"name": f"{mesh.name}-{i}", "primitives": [primitive]})
+
+            node = {"name": mesh.name, "mesh": len(meshes) - 1}
+            if skinned:
+                node["skin"] = 0
+            nodes.append(node)
+            scene_nodes.append(len(nodes) - 1)
+
+    binary = buffer.to_bytes()
+    document = {"asset": {"version": "2.0", "generator": "AllStarRumbleModelTool"},
+                "scene": 0,
+                "scenes": [{"name": "Scene", "nodes": scene_nodes}],
+                "nodes": nodes,
+                "meshes": meshes,
+                "materials": materials,
+                "accessors": buffer.accessors,
+                "bufferViews": buffer.buffer_views,
+                "buffers": [{"byteLength": len(binary)}]}
+    if skin is not None:
+        document["skins"] = [skin]
+    if len(images):
+        document["extensionsUsed"] = ["MSFT_texture_dds"]
+        document["images"] = images
+        document["textures"] = textures
+    return document, binary
@@ -0,0 +1,333 @@
+import functools
+import operator
+import warnings
+from array import array
+
+from BaseRW import BaseRW, MappedReader, RecordSchema, ViolatedAssumptionError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Bits of the GTF format byte that are not part of the texture format itself
+LINEAR_FLAG = 0x20  # Texels are stored row-by-row rather than swizzled
+UNNORMALIZED_FLAG = 0x40  # Texture coordinates are in texels rather than [0, 1]
+
+# Maps the format byte, without the flags above, to the format name, the bytes per block and the width and height of
+# each block in texels. Uncompressed formats have 1x1 blocks and are stored big-endian.
+texture_formats = {0x81: ('B8', 1, 1),
+                   0x82: ('A1R5G5B5', 2, 1),
+                   0x83: ('A4R4G4B4', 2, 1),
+                   0x84: ('R5G6B5', 2, 1),
+                   0x85: ('A8R8G8B8', 4, 1),
+                   0x86: ('DXT1', 8, 4),
+                   0x87: ('DXT3', 16, 4),
+                   0x88: ('DXT5', 16, 4)}
+
+# The faces of a cube map are each padded to a multiple of this many bytes
+CUBE_FACE_ALIGNMENT = 128
+
+
+class SwizzleWarning(UserWarning):
+    """
+    Issued when a swizzled texture cannot be unswizzled, and its texels are returned in their swizzled order. Callers
+    that would rather fail can turn it into an error with the 'warnings' module.
+    """
+
+
+def align(position, alignment):
+    return (position + alignment - 1) // alignment * alignment
+
+
+def is_power_of_two(value):
+    return value > 0 and value & (value - 1) == 0
+
+
+class GTFReadWriter(BaseRW):
+    """
+    Reads the header of a GTF file, the texture format of the PS3, and the attributes of each texture in it. The
+    texture data itself is left in the file; see 'GTFTextureReadWrite.surfaces' and 'read_texture_data'.
+    """
+    header_schema = RecordSchema((("version", "I"),
+                                  ("contents_size", "I"),
+                                  ("texture_count", "I")), endianness='>')
+
+    def __init__(self, bytestream):
+        super().__init__(bytestream)
+        self.endianness = '>'
+
+        self.version = None
+        self.contents_size = None
+        self.texture_count = None
+        self.textures = []
+        self.subreaders = [self.textures]
+
+    def read(self, validation='strict'):
+        self.validation = validation
+        self.read_write(self.read_record, "read", self.prepare_read_operation)
+
+    def read_write(self, rw_record_operator, rw_method_name, preparation_operator):
+        rw_record_operator(self.header_schema)
+        preparation_operator()
+        for texture in self.textures:
+            getattr(texture, rw_method_name)()
+
+    def prepare_read_operation(self):
+        self.assert_fits_in_file("texture_count", self.texture_count, GTFTextureReadWrite.schema.size)
+        for _ in range(self.texture_count):
+            texture = GTFTextureReadWrite(self.bytestream)
+            texture.validation = self.validation
+            texture.trace_offset = self.trace_offset
+            self.textures.append(texture)
+
+
+class GTFTextureReadWrite(BaseRW):
+    """
+    The attributes of one texture in a GTF file: an id, the position and size of its data, followed by the texture
+    description the GPU is given.
+    """
+    schema = RecordSchema((("id", "I"),
+                           ("data_offset", "I"),  # From the start of the GTF file
+                           ("data_size", "I"),
+                           ("format", "B"),
+                           ("mipmap_count", "B"),
+                           ("dimension", "B"),  # 1, 2 or 3
+                           ("cubemap", "B"),
+                           ("remap", "I"),  # How the colour channels are rearranged when sampled
+                           ("width", "H"),
+                           ("height", "H"),
+                           ("depth", "H"),
+                           ("location", "B"),
+                           ("padding_0x27", "B", 0),
+                           ("pitch", "I"),  # Bytes per row of linear textures; ignored for swizzled ones
+                           ("offset", "I")), endianness='>')
+
+    def __init__(self, bytestream):
+        super().__init__(bytestream)
+        self.endianness = '>'
+
+        self.id = None
+        self.data_offset = None
+        self.data_size = None
+        self.format = None
+        self.mipmap_count = None
+        self.dimension = None
+        self.cubemap = None
+        self.remap = None
+        self.width = None
+        self.height = None
+        self.depth = None
+        self.location = None
+        self.padding_0x27 = None
+        self.pitch = None
+        self.offset = None
+
+    def read(self):
+        self.read_write(self.read_record)
+
+    def read_write(self, rw_record_operator):
+        rw_record_operator(self.schema)
+
+    @property
+    def format_name(self):
+        return self.format_info[0]
+
+    @property
+    def format_info(self):
+        base_format = self.format & ~(LINEAR_FLAG | UNNORMALIZED_FLAG)
+        if base_format not in texture_formats:
+            raise ViolatedAssumptionError(f"Unknown GTF texture format 0x{self.format:02X}.")
+        return texture_formats[base_format]
+
+    @property
+    def is_compressed(self):
+        return self.format_info[2] > 1
+
+    @property
+    def is_linear(self):
+        return bool(self.format & LINEAR_FLAG)
+
+    @property
+    def is_swizzled(self):
+        # Compressed textures are stored block-by-block whether or not the linear flag is set
+        return not self.is_linear and not self.is_compressed
+
+    @property
+    def face_count(self):
+        return 6 if self.cubemap else 1
+
+    def surfaces(self):
+        """
+        Works out where each mipmap level of each face is stored.
+
+        Returns
+        ------
+        A list of (offset, size, width, height, depth, row pitch) tuples, one per face and level, with the levels of
+        each face in sequence from the largest. 'offset' is from the start of the texture data and 'row pitch' is the
+        number of bytes from one row of texels, or blocks of texels, to the next.
+        """
+        _, block_bytes, block_size = self.format_info
+        surfaces = []
+        offset = 0
+        for _ in range(self.face_count):
+            face_start = offset
+            for level in range(max(self.mipmap_count, 1)):
+                width = max(self.width >> level, 1)
+                height = max(self.height >> level, 1)
+                depth = max(self.depth >> level, 1)
+                rows = (height + block_size - 1) // block_size
+                row_pitch = (width + block_size - 1) // block_size * block_bytes
+                if self.is_linear and not self.is_compressed and self.pitch:
+                    # Every level of a linear texture shares the pitch of the largest one
+                    row_pitch = self.pitch
+                size = row_pitch * rows * depth
+                surfaces.append((offset, size, width, height, depth, row_pitch))
+                offset += size
+            if self.cubemap:
+                offset = face_start + align(offset - face_start, CUBE_FACE_ALIGNMENT)
+        return surfaces
+
+    def read_texture_data(self, data):
+        """
+        Extracts the texels of every face and level from the texture data, in the order 'surfaces' lists them, ready
+        to be written to a DDS file. See 'read_surface'.
+
+        Inputs
+        ------
+        data -- a bytes-like object holding the GTF file
+
+        Returns
+        ------
+        A list of bytes-like objects, one per face and level.
+        """
+        return [self.read_surface(data, surface) for surface in self.surfaces()]
+
+    def read_surface(self, data, surface):
+        """
+        Extracts the texels of one face and level, as listed by 'surfaces': swizzled textures are put in row-by-row
+        order, padding at the end of rows is removed, and uncompressed texels are made little-endian, so that A8R8G8B8
+        texels become BGRA bytes. Compressed blocks are returned as they are.
+
+        Inputs
+        ------
+        data -- a bytes-like object holding the GTF file
+        surface -- an item of the list returned by 'surfaces'
+        """
+        _, block_bytes, block_size = self.format_info
+        offset, size, width, height, depth, row_pitch = surface
+        start = self.data_offset + offset
+        if start + size > len(data):
+            raise ViolatedAssumptionError(f"Violation of data structure assumption 'texture surface at {start} of "
+                                          f"{size} bytes fits in the {len(data)}-byte file'.")
+        texels = memoryview(data)[start:start + size]
+        packed_pitch = (width + block_size - 1) // block_size * block_bytes
+        if row_pitch != packed_pitch:
+            texels = strip_row_padding(texels, row_pitch, packed_pitch)
+        if self.is_swizzled:
+            texels = unswizzle(texels, width, height, depth, block_bytes)
+        elif not self.is_compressed and block_bytes > 1:
+            texels = swap_endianness(texels, block_bytes)
+        return texels
+
+
+def strip_row_padding(surface, row_pitch, packed_pitch):
+    return b''.join(surface[start:start + packed_pitch] for start in range(0, len(surface), row_pitch))
+
+
+# Unsigned integer types holding one texel of each size, for NumPy and for the array module
+numpy_texel_types = {1: '>u1', 2: '>u2', 4: '>u4'}
+array_texel_types = {1: 'B', 2: 'H', 4: 'I' if array('I').itemsize == 4 else 'L'}
+
+
+@functools.lru_cache(maxsize=32)
+def morton_tables(width, height, depth=1):
+    """
+    Returns, for each axis, the bits that each coordinate along it contributes to the position of a texel in a
+    swizzled texture. Swizzled textures interleave the bits of the x, y and z coordinates, starting with the lowest
+    bit of x, until an axis runs out of bits, after which the remaining axes carry on interleaving.
+    """
+    sizes = (width, height, depth)
+    tables = [[0] * size for size in sizes]
+    axis_bits = [0, 0, 0]
+    bit = 0
+    while any((1 << axis_bit) < size for axis_bit, size in zip(axis_bits, sizes)):
+        for axis, size in enumerate(sizes):
+            if (1 << axis_bits[axis]) < size:
+                table = tables[axis]
+                for coordinate in range(size):
+                    if coordinate >> axis_bits[axis] & 1:
+                        table[coordinate] |= 1 << bit
+                axis_bits[axis] += 1
+                bit += 1
+    return tables
+
+
+@functools.lru_cache(maxsize=32)
+def unswizzle_order(width, height, depth=1):
+    """
+    Returns the position in a swizzled texture of each texel of the texture in row-by-row order, built from the
+    'morton_tables' of each axis. The result is a NumPy array if NumPy is available, otherwise a list.
+    """
+    x_table, y_table, z_table = morton_tables(width, height, depth)
+    if np is not None:
+        order = (np.array(z_table, dtype=np.intp)[:, None, None] |
+                 np.array(y_table, dtype=np.intp)[None, :, None] |
+                 np.array(x_table, dtype=np.intp)[None, None, :])
+        return order.ravel()
+    return [z | y | x for z in z_table for y in y_table for x in x_table]
+
+
+def unswizzle(surface, width, height, depth, texel_bytes):
+    """
+    Puts the texels of a swizzled, uncompressed surface in row-by-row order, and makes them little-endian. Only
+    surfaces with power-of-two dimensions can be unswizzled; any other surface is only made little-endian, and a
+    SwizzleWarning is issued.
+    """
+    if not (is_power_of_two(width) and is_power_of_two(height) and is_power_of_two(depth)):
+        warnings.warn(f"Swizzled texture has non-power-of-two dimensions {width}x{height}x{depth}; leaving it "
+                      f"swizzled.", SwizzleWarning)
+        return swap_endianness(surface, texel_bytes)
+
+    order = unswizzle_order(width, height, depth)
+    if np is not None:
+        texels = np.frombuffer(surface, dtype=numpy_texel_types[texel_bytes], count=width * height * depth)
+        return texels[order].astype(numpy_texel_types[texel_bytes].replace('>', '<')).tobytes()
+
+    texels = array(array_texel_types[texel_bytes], bytes(surface[:width * height * depth * texel_bytes]))
+    if len(order) == 1:
+        result = array(texels.typecode, [texels[0]])
+    else:
+        result = array(texels.typecode, operator.itemgetter(*order)(texels))
+    # The texels were read in big-endian order, so swapping each one's bytes makes them little-endian on any machine
+    if texel_bytes > 1:
+        result.byteswap()
+    return result.tobytes()
+
+
+def swap_endianness(surface, texel_bytes):
+    if texel_bytes == 1:
+        return surface
+    if np is not None:
+        return np.frombuffer(surface, dtype=numpy_texel_types[texel_bytes]).byteswap().tobytes()
+    texels = array(array_texel_types[texel_bytes], bytes(surface))
+    texels.byteswap()
+    return texels.tobytes()
+
+
+def read_gtf(gtf_data, validation='strict', file_offset=0):
+    """
+    Reads the header of a GTF file held in a bytes-like object. If the GTF file was taken from a larger file, such as
+    a PXBI file, 'file_offset' is its position in that file, so that a ParseTrace logs offsets in that file.
+
+    Returns
+    ------
+    The GTFReadWriter, with a GTFTextureReadWrite for each texture in the file.
+    """
+    rdr = GTFReadWriter(MappedReader(gtf_data))
+    rdr.trace_offset = file_offset
+    rdr.read(validation)
+    if not len(rdr.textures):
+        raise ViolatedAssumptionError("GTF file holds no textures.")
+    return rdr
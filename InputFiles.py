@@ -0,0 +1,41 @@
+import fnmatch
+import os
+
+
+def matches_patterns(patterns, name, relpath):
+    """
+    Returns whether a file's name or its path relative to the folder being searched (with '/' as the separator)
+    matches any of the glob patterns in 'patterns'.
+    """
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern) for pattern in patterns)
+
+
+def find_bin_files(root, include=(), exclude=()):
+    """
+    Recursively collects the '.bin' files below 'root'.
+
+    Glob patterns in 'include' and 'exclude' are matched against both the file name and the path relative to 'root'
+    (with '/' as the separator). If any include patterns are given, a file must match at least one of them.
+
+    Returns
+    ------
+    A list of (filepath, relative path, file size) tuples.
+    """
+    found = []
+    directories = [root]
+    while len(directories):
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                    continue
+                if not entry.is_file() or os.path.splitext(entry.name)[-1] != '.bin':
+                    continue
+                relpath = os.path.relpath(entry.path, root)
+                match_path = relpath.replace(os.sep, '/')
+                if len(include) and not matches_patterns(include, entry.name, match_path):
+                    continue
+                if matches_patterns(exclude, entry.name, match_path):
+                    continue
+                found.append((entry.path, relpath, entry.stat().st_size))
+    return found
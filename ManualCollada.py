@@ -1,5 +1,92 @@
+import itertools
 import os
 
+
+def format_ints(chunk):
+    return " ".join(map(str, chunk))
+
+
+index_strings = []
+
+
+def format_indices(chunk):
+    """
+    As 'format_ints', but for non-negative integers only, which are looked up in a table of their text rather than
+    converted one-by-one. The table grows to cover the largest value seen so far.
+    """
+    largest = max(chunk, default=-1)
+    if largest >= len(index_strings):
+        index_strings.extend(map(str, range(len(index_strings), largest + 1)))
+    return " ".join(map(index_strings.__getitem__, chunk))
+
+
+class FloatFormatter:
+    """
+    Formats chunks of floats as space-separated text.
+
+    If a 'precision' is given, every value is written with that many significant digits by a single %-format call per
+    chunk. Otherwise, the shortest string that round-trips each value is written, as 'str(float(value))' would.
+    """
+    def __init__(self, precision=None):
+        self.precision = precision
+        self.templates = {}
+
+    def __call__(self, chunk):
+        # Converts array('f') and NumPy chunks to Python floats in a single call
+        if hasattr(chunk, 'tolist'):
+            chunk = chunk.tolist()
+        if self.precision is None:
+            return " ".join(map(repr, map(float, chunk)))
+        template = self.templates.get(len(chunk))
+        if template is None:
+            template = " ".join([f"%.{self.precision}g"] * len(chunk))
+            self.templates[len(chunk)] = template
+        return template % tuple(chunk)
+
+
+class ColladaWriter:
+    """
+    Writes the lines of a COLLADA document to a file. Used as the 'writefunc' of every element's 'write' method.
+
+    Large arrays should be written with 'write_array', which streams the values to the file in fixed-size chunks
+    rather than building the text of the whole array in memory. In minified mode, indentation and newlines are
+    dropped.
+    """
+    def __init__(self, F, minify=False, chunksize=4096):
+        self.F = F
+        self.minify = minify
+        self.chunksize = chunksize
+        self.newline = '' if minify else '\n'
+
+    def __call__(self, line):
+        if self.minify:
+            line = line.lstrip(' ')
+        self.F.write(line)
+        self.F.write(self.newline)
+
+    def write_array(self, opening, values, closing, format_chunk=format_ints):
+        """
+        Writes 'opening', followed by the items in 'values' separated by spaces, followed by 'closing'.
+
+        'format_chunk' is called with successive slices of 'values' (or lists, if 'values' cannot be sliced), and
+        should return their space-separated text.
+        """
+        write = self.F.write
+        write(opening.lstrip(' ') if self.minify else opening)
+        if hasattr(values, '__getitem__') and hasattr(values, '__len__'):
+            chunks = (values[i:i + self.chunksize] for i in range(0, len(values), self.chunksize))
+        else:
+            values = iter(values)
+            chunks = iter(lambda: list(itertools.islice(values, self.chunksize)), [])
+        separator = ''
+        for chunk in chunks:
+            write(separator)
+            write(format_chunk(chunk))
+            separator = ' '
+        write(closing)
+        write(self.newline)
+
+
 class ColladaImage:
     def __init__(self, sid, src):
         self.sid = sid
@@ -96,17 +183,22 @@ class ColladaMaterial:
         
         
 class ColladaFloatSource:
-    def __init__(self, sid, contents, param_names):
+    def __init__(self, sid, contents, stride, param_names, precision=None):
+        """
+        'contents' is a flat sequence of floats, with 'stride' consecutive values per accessed element. 'precision' is
+        the number of significant digits to write, or None to write every value exactly.
+        """
         self.sid = sid
         self.contents = contents
+        self.stride = stride
         self.param_names = param_names
+        self.format_floats = FloatFormatter(precision)
         
     def write(self, writefunc, indent):
-        flat_contents = [subitem for item in self.contents for subitem in item]
         writefunc(indent + f"""<source id="{self.sid}">""")
-        writefunc(indent + f"""  <float_array id="{self.sid}-array" count="{len(flat_contents)}">{" ".join([str(float(item)) for item in flat_contents])}</float_array>""")
+        writefunc.write_array(indent + f"""  <float_array id="{self.sid}-array" count="{len(self.contents)}">""", self.contents, "</float_array>", self.format_floats)
         writefunc(indent + f"""  <technique_common>""")
-        writefunc(indent + f"""    <accessor source="#{self.sid}-array" count="{len(self.contents)}" stride="{len(self.contents[0])}">""")
+        writefunc(indent + f"""    <accessor source="#{self.sid}-array" count="{len(self.contents)//self.stride}" stride="{self.stride}">""")
         for param_name in self.param_names:
             writefunc(indent + f"""      <param name="{param_name}" type="float"/>""")
         writefunc(indent + f"""    </accessor>""")          
@@ -130,23 +222,32 @@ class ColladaInputList:
 
 
 class ColladaTriangleSet:
-    def __init__(self, triangle_indices, input_list, material):
+    """
+    By default, 'triangle_indices' holds one index per input for each triangle corner, and each input reads from its
+    own offset. If 'shared_offset' is set, every input reads from offset 0 and 'triangle_indices' holds one index per
+    corner, which suits inputs that are all indexed in the same way.
+    """
+    def __init__(self, triangle_indices, input_list, material, shared_offset=False):
         self.triangle_indices = triangle_indices
         self.input_list = input_list
         self.material = material
+        self.shared_offset = shared_offset
         
     def write(self, writefunc, indent):
         writefunc(indent + f"""<vertices id="{self.input_list.position[1]}-vertices">""")
         writefunc(indent + f"""  <input semantic="POSITION" source="#{self.input_list.position[1]}"/>""")
         writefunc(indent + f"""</vertices>""")
-        writefunc(indent + f"""<triangles material="{self.material.name}" count="{len(self.triangle_indices)//(3*len(self.input_list.inputs))}">""")
+        indices_per_corner = 1 if self.shared_offset else len(self.input_list.inputs)
+        writefunc(indent + f"""<triangles material="{self.material.name}" count="{len(self.triangle_indices)//(3*indices_per_corner)}">""")
         for i, input_set in enumerate(self.input_list.inputs):
+            if self.shared_offset:
+                i = 0
             if input_set[0] == 'VERTEX':
                 writefunc(indent + f"""  <input semantic="{input_set[0]}" source="#{input_set[1]}-vertices" offset="{i}"/>""")
             else:
                 kwarg_list = " ".join([f"{key}=\"{value}\"" for key, value in input_set[2].items()])
                 writefunc(indent + f"""  <input semantic="{input_set[0]}" source="#{input_set[1]}" offset="{i}" {kwarg_list}/>""")
-        writefunc(indent + f"""  <p>{" ".join([str(item) for item in self.triangle_indices])}</p>""")  
+        writefunc.write_array(indent + f"""  <p>""", self.triangle_indices, "</p>", format_indices)
         writefunc(indent + f"""</triangles>""")  
         
         
@@ -171,15 +272,19 @@ class ColladaGeometry:
             
 
 class ColladaSkinController:
-    def __init__(self, name, collada_geom, bone_names, ibps, weights, weighted_joints):
+    def __init__(self, name, collada_geom, bone_names, ibps, weights, weighted_joints, influences_per_vertex,
+                 matrix_precision=None, weight_precision=None):
         self.collada_geom = collada_geom
         self.name = f"{name}_{self.collada_geom.name}_skin"
         self.sid = f"{name}_{self.collada_geom.sid}_skin"
         self.bone_names = bone_names
         self.ibps = ibps
-        # Weights and weighted_joints should have the same shapes
+        # Weights and weighted_joints are flat, with 'influences_per_vertex' consecutive values per vertex
         self.weights = weights
         self.weighted_joints = weighted_joints
+        self.influences_per_vertex = influences_per_vertex
+        self.format_matrices = FloatFormatter(matrix_precision)
+        self.format_weights = FloatFormatter(weight_precision)
         
     def write(self, writefunc, indent):
         bind_shape_matrix = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
@@ -201,7 +306,7 @@ class ColladaSkinController:
         flat_ibps = [subitem for item in self.ibps for subitem in item]
         flat_ibps = [subitem for item in flat_ibps for subitem in item]
         writefunc(indent + f"""    <source id="{self.sid}-bind_poses">""")
-        writefunc(indent + f"""      <float_array id="{self.sid}-bind_poses-array" count="{len(self.ibps*16)}">{" ".join([str(float(item)) for item in flat_ibps])}</float_array>""")
+        writefunc.write_array(indent + f"""      <float_array id="{self.sid}-bind_poses-array" count="{len(self.ibps*16)}">""", flat_ibps, "</float_array>", self.format_matrices)
         
         writefunc(indent + f"""      <technique_common>""")
         writefunc(indent + f"""        <accessor source="#{self.sid}-bind_poses-array" count="{len(self.ibps)}" stride="16">""")         
@@ -210,11 +315,10 @@ class ColladaSkinController:
         writefunc(indent + f"""      </technique_common>""")
         writefunc(indent + f"""    </source>""")
         
-        flat_weights = [subitem for item in self.weights for subitem in item]
         writefunc(indent + f"""    <source id="{self.sid}-weights">""")
-        writefunc(indent + f"""      <float_array id="{self.sid}-weights-array" count="{len(flat_weights)}">{" ".join([str(float(item)) for item in flat_weights])}</float_array>""")
+        writefunc.write_array(indent + f"""      <float_array id="{self.sid}-weights-array" count="{len(self.weights)}">""", self.weights, "</float_array>", self.format_weights)
         writefunc(indent + f"""      <technique_common>""")
-        writefunc(indent + f"""        <accessor source="#{self.sid}-weights-array" count="{len(flat_weights)}" stride="1">""")
+        writefunc(indent + f"""        <accessor source="#{self.sid}-weights-array" count="{len(self.weights)}" stride="1">""")
         writefunc(indent + f"""          <param name="WEIGHT" type="float"/>""")
         writefunc(indent + f"""        </accessor>""")
         writefunc(indent + f"""      </technique_common>""")
@@ -226,12 +330,13 @@ class ColladaSkinController:
         writefunc(indent + f"""      <input semantic="INV_BIND_MATRIX" source="#{self.sid}-bind_poses"/>""")
         writefunc(indent + f"""    </joints>""")
         
-        flat_weighted_joints = [int(subitem) for item in self.weighted_joints for subitem in item]
-        writefunc(indent + f"""    <vertex_weights count="{len(self.weights)}">""")
+        vertex_count = len(self.weights)//self.influences_per_vertex
+        writefunc(indent + f"""    <vertex_weights count="{vertex_count}">""")
         writefunc(indent + f"""      <input semantic="JOINT" source="#{self.sid}-joints" offset="0"/>""")
         writefunc(indent + f"""      <input semantic="WEIGHT" source="#{self.sid}-weights" offset="1"/>""")
-        writefunc(indent + f"""      <vcount>{" ".join([str(len(item)) for item in self.weighted_joints])}</vcount>""")
-        writefunc(indent + f"""      <v>{" ".join([str(item) + " " + str(i) for i, item in enumerate(flat_weighted_joints)])}</v>""")
+        writefunc.write_array(indent + f"""      <vcount>""", itertools.repeat(self.influences_per_vertex, vertex_count), "</vcount>")
+        writefunc.write_array(indent + f"""      <v>""", enumerate(self.weighted_joints), "</v>",
+                              lambda chunk: " ".join([f"{int(joint)} {i}" for i, joint in chunk]))
         writefunc(indent + f"""    </vertex_weights>""")
         writefunc(indent + f"""  </skin>""")
         writefunc(indent + f"""</controller>""")
@@ -239,31 +344,33 @@ class ColladaSkinController:
         
             
 class ColladaArmatureNode:
-    def __init__(self, name, transform):
+    def __init__(self, name, transform, precision=None):
         self.name = name
         self.transform = transform
         self.child_nodes = []
+        self.format_transform = FloatFormatter(precision)
         
     def write(self, writefunc, indent):
         flat_transform = [subitem for item in self.transform for subitem in item]
         writefunc(indent + f"""<node id="{self.name}" name="{self.name}" type="NODE">""")
-        writefunc(indent + f"""  <matrix sid="transform">{' '.join([str(float(item)) for item in flat_transform])}</matrix>""")
+        writefunc(indent + f"""  <matrix sid="transform">{self.format_transform(flat_transform)}</matrix>""")
         for child_node in self.child_nodes:
             child_node.write(writefunc, indent + "  ")
         writefunc(indent + f"""</node>""")
 
 class ColladaBoneNode:
-    def __init__(self, name, armature, transform):
+    def __init__(self, name, armature, transform, precision=None):
         self.name = name
         self.armature = armature
         self.transform = transform
         self.child_nodes = []
+        self.format_transform = FloatFormatter(precision)
         
     def write(self, writefunc, indent):
         id_name = self.armature.name + "_" + self.name
         flat_transform = [subitem for item in self.transform for subitem in item]
         writefunc(indent + f"""<node id="{id_name}" name="{self.name}" sid="{self.name}" type="JOINT">""")
-        writefunc(indent + f"""  <matrix sid="transform">{' '.join([str(float(item)) for item in flat_transform])}</matrix>""")
+        writefunc(indent + f"""  <matrix sid="transform">{self.format_transform(flat_transform)}</matrix>""")
         for child_node in self.child_nodes:
             child_node.write(writefunc, indent + "  ")
         writefunc(indent + f"""</node>""")    
@@ -339,10 +446,9 @@ class ColladaDocument:
         
         self.scenes = []
         
-    def write(self, path):
-        with open(path, 'w') as F:
-            def write_func(line):
-                F.write(line + '\n')
+    def write(self, path, minify=False):
+        with open(path, 'w', buffering=1 << 16) as F:
+            write_func = ColladaWriter(F, minify)
         
             write_func(r"""<?xml version="1.0" encoding="utf-8"?>""")
             write_func(r"""<COLLADA xmlns="http://www.collada.org/2005/11/COLLADASchema" version="1.4.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">""")
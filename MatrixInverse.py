@@ -0,0 +1,156 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# The rotation part of a matrix is treated as orthonormal if R.R^T differs from the identity by no more than this
+rigid_tolerance = 1e-6
+# Matrices whose conditioning (see 'conditioning') falls below this are reported as ill-conditioned
+min_conditioning = 1e-6
+
+
+def conditioning(determinant, rows):
+    """
+    Returns |det(M)| divided by the product of the lengths of the rows of M. This is 1 for a matrix with orthogonal rows
+    and falls to 0 as the matrix approaches being singular, regardless of its scale.
+    """
+    product = 1.
+    for row in rows:
+        product *= sum(value * value for value in row) ** 0.5
+    return abs(determinant) / product if product else 0.
+
+
+def is_affine(matrix):
+    return tuple(matrix[3]) == (0., 0., 0., 1.)
+
+
+def is_rigid(matrix):
+    rows = [matrix[i][:3] for i in range(3)]
+    for i in range(3):
+        for j in range(i, 3):
+            dot = rows[i][0] * rows[j][0] + rows[i][1] * rows[j][1] + rows[i][2] * rows[j][2]
+            if abs(dot - (i == j)) > rigid_tolerance:
+                return False
+    return True
+
+
+def invert_rigid(matrix):
+    """
+    Inverts a matrix made of a rotation and a translation: the rotation is transposed, and the translation is rotated
+    by the transposed rotation and negated.
+    """
+    (r00, r01, r02, t0), (r10, r11, r12, t1), (r20, r21, r22, t2) = matrix[:3]
+    return [[r00, r10, r20, -(r00 * t0 + r10 * t1 + r20 * t2)],
+            [r01, r11, r21, -(r01 * t0 + r11 * t1 + r21 * t2)],
+            [r02, r12, r22, -(r02 * t0 + r12 * t1 + r22 * t2)],
+            [0., 0., 0., 1.]]
+
+
+def invert_affine(matrix):
+    """
+    Inverts a matrix whose final row is (0, 0, 0, 1), by inverting its upper 3x3 block from its cofactors.
+
+    Returns
+    ------
+    The inverse, or None if the matrix is singular, and the conditioning of the matrix.
+    """
+    (a, b, c, t0), (d, e, f, t1), (g, h, i, t2) = matrix[:3]
+    cofactors = [[e * i - f * h, c * h - b * i, b * f - c * e],
+                 [f * g - d * i, a * i - c * g, c * d - a * f],
+                 [d * h - e * g, b * g - a * h, a * e - b * d]]
+    determinant = a * cofactors[0][0] + b * cofactors[1][0] + c * cofactors[2][0]
+    quality = conditioning(determinant, [(a, b, c), (d, e, f), (g, h, i)])
+    if determinant == 0.:
+        return None, quality
+    inverse = [[value / determinant for value in row] for row in cofactors]
+    for row in inverse:
+        row.append(-(row[0] * t0 + row[1] * t1 + row[2] * t2))
+    inverse.append([0., 0., 0., 1.])
+    return inverse, quality
+
+
+def invert_general(matrix):
+    """
+    Inverts any 4x4 matrix by Gauss-Jordan elimination with partial pivoting.
+
+    Returns
+    ------
+    The inverse, or None if the matrix is singular, and the conditioning of the matrix.
+    """
+    rows = [list(row) + [float(i == j) for j in range(4)] for i, row in enumerate(matrix)]
+    determinant = 1.
+    for column in range(4):
+        pivot_row = max(range(column, 4), key=lambda r: abs(rows[r][column]))
+        if pivot_row != column:
+            rows[column], rows[pivot_row] = rows[pivot_row], rows[column]
+            determinant = -determinant
+        pivot = rows[column][column]
+        determinant *= pivot
+        if pivot == 0.:
+            return None, 0.
+        rows[column] = [value / pivot for value in rows[column]]
+        for r in range(4):
+            if r != column and rows[r][column] != 0.:
+                scale = rows[r][column]
+                rows[r] = [value - scale * pivot_value for value, pivot_value in zip(rows[r], rows[column])]
+    return [row[4:] for row in rows], conditioning(determinant, matrix)
+
+
+def invert_general_batch(matrices):
+    """
+    As 'invert_general', for a list of matrices at once using NumPy.
+    """
+    stack = np.array(matrices, dtype=np.float64)
+    determinants = np.linalg.det(stack)
+    norms = np.prod(np.linalg.norm(stack, axis=2), axis=1)
+    qualities = np.divide(np.abs(determinants), norms, out=np.zeros_like(norms), where=norms != 0)
+    invertible = determinants != 0
+    inverses = [None] * len(matrices)
+    if np.any(invertible):
+        for idx, inverse in zip(np.flatnonzero(invertible), np.linalg.inv(stack[invertible]).tolist()):
+            inverses[idx] = inverse
+    return list(zip(inverses, qualities.tolist()))
+
+
+def invert_matrices(matrices):
+    """
+    Inverts a batch of row-major 4x4 matrices, such as the inverse bind matrices of a skeleton.
+
+    Rigid transforms (a rotation and a translation) and other affine transforms are inverted directly. Anything else is
+    inverted by elimination with partial pivoting, with all such matrices inverted together if NumPy is available.
+
+    Returns
+    ------
+    A list of the inverses, as lists of rows, and a list of (index, conditioning) tuples for the matrices that are
+    singular or ill-conditioned (see 'conditioning'). Singular matrices have a conditioning of 0, and are given the
+    identity matrix as their inverse. The inverses never contain -0.0.
+    """
+    results = [None] * len(matrices)
+    general = []
+    for idx, matrix in enumerate(matrices):
+        matrix = [[float(value) for value in row] for row in matrix]
+        if is_affine(matrix):
+            results[idx] = (invert_rigid(matrix), 1.) if is_rigid(matrix) else invert_affine(matrix)
+        else:
+            general.append((idx, matrix))
+
+    if len(general):
+        if np is not None:
+            general_results = invert_general_batch([matrix for idx, matrix in general])
+        else:
+            general_results = [invert_general(matrix) for idx, matrix in general]
+        for (idx, matrix), result in zip(general, general_results):
+            results[idx] = result
+
+    inverses = []
+    problems = []
+    for idx, (inverse, quality) in enumerate(results):
+        if inverse is None:
+            inverse = [[float(i == j) for j in range(4)] for i in range(4)]
+            quality = 0.
+        if quality < min_conditioning:
+            problems.append((idx, quality))
+        # Adding zero turns any -0.0 from negating a zero translation into 0.0, so that it is not written out as '-0'
+        inverses.append([[value + 0. for value in row] for row in inverse])
+    return inverses, problems
@@ -0,0 +1,346 @@
+import json
+import os
+import struct
+import sys
+from array import array
+
+from BaseRW import MappedReader
+from ConversionManifest import hash_file
+from PXBIInterface import LazySequence, PXBIInterface, convert_gtf_to_dds
+from TextureStore import write_atomically
+from VertexLayout import flatten_column
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Increment whenever the layout of the cache files or what is stored in them changes, so that old entries are rebuilt
+CACHE_VERSION = 1
+
+CACHE_MAGIC = b'PXBC'
+CACHE_EXTENSION = '.pxbc'
+# The cache is trimmed back to this many bytes, least recently used entries first, whenever an entry is added
+DEFAULT_MAX_BYTES = 1 << 30
+# Arrays in a cache file start on a multiple of this many bytes, so that they can be used without copying
+ARRAY_ALIGNMENT = 16
+
+# Each joint is stored as it is in the PXBI file
+joint_struct = struct.Struct('>hhhhhhhhhhIIfffffffff')
+
+
+def default_cache_directory():
+    """
+    Returns the folder given by the PXBI_CACHE_DIR environment variable, or else a folder in the user's cache folder.
+    """
+    if "PXBI_CACHE_DIR" in os.environ:
+        return os.environ["PXBI_CACHE_DIR"]
+    cache_root = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_root, "AllStarRumbleModelTool")
+
+
+class AssignedTexture:
+    """
+    The texture assignment of a cached material; has the same attributes as PXBIReader.TextureReadWrite uses once it
+    has been read.
+    """
+    def __init__(self, role, role_id, tex_idx):
+        self.role = role
+        self.role_id = role_id
+        self.tex_idx = tex_idx
+
+
+class CachedMaterial:
+    def __init__(self, name, assigned_textures):
+        self.name = name
+        self.assigned_textures = assigned_textures
+
+
+class CachedMesh:
+    """
+    A mesh loaded from the cache, with the same attributes as PXBIInterface.MeshInterface.
+    """
+    def __init__(self, name, vertex_count, vertex_attribute_sizes, material_index, vertices, triangle_indices):
+        self.name = name
+        self.vertex_count = vertex_count
+        self.vertex_attribute_sizes = vertex_attribute_sizes
+        self.material_index = material_index
+        self.vertices = vertices
+        self.triangle_indices = triangle_indices
+
+    @property
+    def triangles(self):
+        indices = iter(self.triangle_indices)
+        return list(zip(indices, indices, indices))
+
+
+class CacheWriter:
+    """
+    Collects the arrays of a cache file, each aligned to ARRAY_ALIGNMENT bytes from the start of the data section.
+    """
+    def __init__(self):
+        self.blocks = []
+        self.size = 0
+
+    def add(self, data):
+        """
+        Adds a bytes-like object and returns its (offset, size) in the data section.
+        """
+        data = memoryview(data).cast('B')
+        padding = -self.size % ARRAY_ALIGNMENT
+        if padding:
+            self.blocks.append(b'\x00' * padding)
+            self.size += padding
+        offset = self.size
+        self.blocks.append(data)
+        self.size += len(data)
+        return offset, len(data)
+
+
+def little_endian_floats(column):
+    """
+    Returns the components of every vertex in a column as contiguous little-endian float32 bytes.
+    """
+    if np is not None and isinstance(column, np.ndarray):
+        return np.ascontiguousarray(column, dtype='<f4').tobytes()
+    values = array('f', flatten_column(column))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def little_endian_indices(indices):
+    values = array('H', indices)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_model(pi, source_digest, source_size):
+    """
+    Serializes a PXBIInterface read with every section. The result is a short header, a JSON description of the model
+    and then the vertex columns, triangle indices and bone matrices as little-endian arrays. The GTF data of the
+    textures is not stored; only its position in the source file is.
+    """
+    writer = CacheWriter()
+    meshes = []
+    for mesh in pi.meshes:
+        columns = {name: writer.add(little_endian_floats(column)) for name, column in mesh.vertices.items()}
+        meshes.append({"name": mesh.name,
+                       "vertex_count": mesh.vertex_count,
+                       "attribute_sizes": mesh.vertex_attribute_sizes,
+                       "material_index": mesh.material_index,
+                       "columns": columns,
+                       "triangles": writer.add(little_endian_indices(mesh.triangle_indices))})
+    materials = [{"name": material.name,
+                  "textures": [(texture.role, texture.role_id, texture.tex_idx)
+                               for texture in material.assigned_textures]}
+                 for material in pi.materials]
+    bone_matrices = array('f', [value for _, _, matrix in pi.bone_data for row in matrix for value in row])
+    if sys.byteorder == 'big':
+        bone_matrices.byteswap()
+    joints = b''.join(joint_struct.pack(*joint) for joint in pi.joint_data)
+    description = {"source": {"sha256": source_digest, "size": source_size},
+                   "meshes": meshes,
+                   "materials": materials,
+                   "bones": {"names": [name for name, _, _ in pi.bone_data],
+                             "joints": [joint for _, joint, _ in pi.bone_data],
+                             "matrices": writer.add(bone_matrices.tobytes())},
+                   "joints": {"names": pi.joint_names,
+                              "data": writer.add(joints)},
+                   "textures": {"names": pi.texture_names,
+                                "locations": pi.texture_locations}}
+
+    description = json.dumps(description, separators=(',', ':')).encode('utf-8')
+    header = struct.pack('<4sII', CACHE_MAGIC, CACHE_VERSION, len(description))
+    data_start = len(header) + len(description)
+    padding = b'\x00' * (-data_start % ARRAY_ALIGNMENT)
+    return b''.join([header, description, padding, *writer.blocks])
+
+
+def decode_model(data, source):
+    """
+    Rebuilds a PXBIInterface from the contents of a cache file, made by 'encode_model'. With NumPy the vertex columns
+    are read-only views of 'data'; without it they are copied out of it with a single copy per column.
+
+    Inputs
+    ------
+    data -- a bytes-like object holding the cache file
+    source -- the path of the PXBI file the cache file was made from, which the textures are read from when they are
+              accessed
+
+    Returns
+    ------
+    The PXBIInterface, and the description of the model from the cache file.
+    """
+    magic, version, description_size = struct.unpack_from('<4sII', data, 0)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        raise ValueError(f"Not a version {CACHE_VERSION} model cache file.")
+    header_size = struct.calcsize('<4sII')
+    description = json.loads(bytes(data[header_size:header_size + description_size]).decode('utf-8'))
+    data_start = header_size + description_size
+    data_start += -data_start % ARRAY_ALIGNMENT
+    data = memoryview(data)
+
+    def block(location):
+        offset, size = location
+        return data[data_start + offset:data_start + offset + size]
+
+    def floats(location, width):
+        if np is not None:
+            return np.frombuffer(block(location), dtype='<f4').reshape(-1, width)
+        values = array('f')
+        values.frombytes(block(location))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    pi = PXBIInterface()
+    pi.meshes = []
+    for mesh in description["meshes"]:
+        sizes = mesh["attribute_sizes"]
+        vertices = {name: floats(location, sizes[name]) for name, location in mesh["columns"].items()}
+        triangle_indices = array('H')
+        triangle_indices.frombytes(block(mesh["triangles"]))
+        if sys.byteorder == 'big':
+            triangle_indices.byteswap()
+        pi.meshes.append(CachedMesh(mesh["name"], mesh["vertex_count"], sizes, mesh["material_index"], vertices,
+                                    triangle_indices))
+    pi.materials = [CachedMaterial(material["name"], [AssignedTexture(*texture) for texture in material["textures"]])
+                    for material in description["materials"]]
+
+    bones = description["bones"]
+    matrices = array('f')
+    matrices.frombytes(block(bones["matrices"]))
+    if sys.byteorder == 'big':
+        matrices.byteswap()
+    rows = list(zip(*[iter(matrices)] * 4))
+    pi.bone_data = [[name, joint, rows[start:start + 4]]
+                    for name, joint, start in zip(bones["names"], bones["joints"], range(0, len(rows), 4))]
+    pi.joint_data = list(joint_struct.iter_unpack(block(description["joints"]["data"])))
+    pi.joint_names = description["joints"]["names"]
+
+    pi.texture_names = [tuple(names) for names in description["textures"]["names"]]
+    pi.texture_locations = [tuple(location) for location in description["textures"]["locations"]]
+    source_data = []
+
+    def read_texture(idx):
+        # The source is only mapped once a texture is needed
+        if not len(source_data):
+            with open(source, 'rb') as F:
+                source_data.append(MappedReader.from_file(F).buffer)
+        offset, size = pi.texture_locations[idx]
+        return source_data[0][offset:offset + size]
+
+    pi.texture_data_raw = LazySequence(len(pi.texture_names), read_texture)
+    pi.texture_data = LazySequence(len(pi.texture_names),
+                                   lambda idx: convert_gtf_to_dds(read_texture(idx), pi.texture_locations[idx][0]))
+    return pi, description
+
+
+class ModelCache:
+    """
+    A folder of decoded models, each stored under the SHA-256 of the PXBI file it was read from, so that the same
+    model can be loaded again without parsing it. Loading a cached model maps a single file into memory and at most
+    copies its arrays; the textures are still read from the source file, when they are accessed.
+
+    The least recently used entries are deleted whenever the folder grows past 'max_bytes'. The same folder may be
+    shared between processes, since entries are only added by moving complete files into place.
+
+    Inputs
+    ------
+    directory -- the folder to keep the cache in. Default: see 'default_cache_directory'.
+    max_bytes -- the largest total size of the cache files. Default: DEFAULT_MAX_BYTES.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = default_cache_directory() if directory is None else directory
+        self.max_bytes = max_bytes
+        # Maps (path, size, modification time) to the hash of the file, so that files are hashed once per process
+        self.known_hashes = {}
+
+    def entry_path(self, digest):
+        return os.path.join(self.directory, digest + CACHE_EXTENSION)
+
+    def source_hash(self, filepath):
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        if key not in self.known_hashes:
+            self.known_hashes[key] = hash_file(filepath)
+        return self.known_hashes[key], stat.st_size
+
+    def load(self, filepath, validation='strict'):
+        """
+        Returns the PXBIInterface of a PXBI file, from the cache if it holds the file, or else by reading the file
+        and adding it to the cache.
+        """
+        digest, size = self.source_hash(filepath)
+        pi = self.get(filepath, digest, size)
+        if pi is None:
+            pi = PXBIInterface.from_file(filepath, lazy=True, validation=validation)
+            self.put(pi, digest, size)
+        return pi
+
+    def get(self, filepath, digest, size):
+        """
+        Returns the cached PXBIInterface of the file with the SHA-256 'digest', or None if it is not cached or its
+        entry cannot be used.
+        """
+        entry_path = self.entry_path(digest)
+        try:
+            # The arrays of the model are views of the mapped file, so nothing but the description is copied
+            with open(entry_path, 'rb') as F:
+                data = MappedReader.from_file(F).buffer
+            pi, description = decode_model(data, filepath)
+        except (OSError, ValueError, KeyError, struct.error):
+            return None
+        if description["source"] != {"sha256": digest, "size": size}:
+            return None
+        try:
+            # The modification time of an entry records when it was last used
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return pi
+
+    def put(self, pi, digest, size):
+        """
+        Adds a PXBIInterface read with every section to the cache, then trims the cache to 'max_bytes'.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomically(self.entry_path(digest), encode_model(pi, digest, size))
+        self.evict()
+
+    def entries(self):
+        """
+        Returns the (last used time, size, path) of every file in the cache, least recently used first.
+        """
+        found = []
+        try:
+            with os.scandir(self.directory) as scanned:
+                for entry in scanned:
+                    if entry.is_file() and entry.name.endswith(CACHE_EXTENSION):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return sorted(found)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
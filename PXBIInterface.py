@@ -1,5 +1,12 @@
+import os
 import struct
+from array import array
+
+import Profiling
+from BaseRW import MappedReader
+from GTFReader import read_gtf
 from PXBIReader import PXBIReadWriter
+from VertexLayout import attribute_sizes
 
 
 class PXBIInterface:
@@ -14,29 +21,153 @@ class PXBIInterface:
         self.meshes = None
     
     @classmethod
-    def from_file(cls, file):
+    def from_file(cls, file, sections=None, lazy=False, validation='strict'):
+        """
+        Inputs
+        ------
+        file -- the path of the PXBI file to read, or a binary stream holding it, such as an io.BytesIO or a member of
+                a zip file opened with zipfile.ZipFile.open. The stream is read from its current position.
+        sections -- the parts of the file to read, from PXBIReader.all_sections ('meshes', 'materials', 'skeleton' and
+                    'textures'). Defaults to every section. Anything not read is left empty, except for the texture
+                    names, which are always read.
+        lazy -- if set, only the names and sizes of the meshes are read up front. The vertices and triangles of each
+                mesh are read the first time they are accessed, and each texture is read and converted every time it
+                is accessed, so that the converted textures are not all held in memory at once.
+        validation -- how thoroughly to check the file as it is read: 'strict', 'fast' or 'off'. See
+                      PXBIReader.PXBIReadWriter.read.
+        """
         instance = cls()
-        with open(file, 'rb') as F:
-            rdr = PXBIReadWriter(F)
-            rdr.read()
+        if isinstance(file, (str, os.PathLike)):
+            # The map outlives the file handle, so the texture views below remain valid after the file is closed
+            with open(file, 'rb') as F:
+                with Profiling.stage('read.open'):
+                    stream = MappedReader.from_file(F)
+        else:
+            with Profiling.stage('read.open'):
+                stream = MappedReader.from_stream(file)
+        rdr = PXBIReadWriter(stream)
+        rdr.read(sections, lazy, validation)
+        Profiling.count('bytes_read', len(stream.buffer))
             
         instance.meshes = [MeshInterface(mesh) for mesh in rdr.meshes]
         instance.materials = [MaterialInterface(material) for material in rdr.materials]
         instance.texture_names = rdr.texture_names
-        instance.texture_data = [convert_gtf_to_dds(data) for data in rdr.texture_binary]
-        instance.texture_data_raw = [data for data in rdr.texture_binary]
+        # The position and size of each texture's GTF data in the file, so that it can be read again later
+        instance.texture_locations = [(rel_ptr + rdr.textures_pointer, size) for size, rel_ptr
+                                      in zip(rdr.textures_header[0::2], rdr.textures_header[1::2])]
+        if lazy and 'textures' in rdr.sections:
+            instance.texture_data = LazySequence(rdr.texture_count, lambda idx: convert_gtf_to_dds(
+                rdr.read_texture(idx), instance.texture_locations[idx][0]))
+            instance.texture_data_raw = LazySequence(rdr.texture_count, rdr.read_texture)
+        else:
+            instance.texture_data = [convert_gtf_to_dds(data, offset)
+                                     for data, (offset, _) in zip(rdr.texture_binary, instance.texture_locations)]
+            instance.texture_data_raw = [data for data in rdr.texture_binary]
         instance.bone_data = rdr.bone_data
         instance.joint_data = rdr.joint_data
         instance.joint_names = rdr.joint_names
         
         return instance
-        
+
+    def get_mesh(self, key):
+        """
+        Returns the mesh at index 'key', or the first mesh named 'key'.
+        """
+        if isinstance(key, int):
+            return self.meshes[key]
+        for mesh in self.meshes:
+            if mesh.name == key:
+                return mesh
+        raise KeyError(f"No mesh named '{key}'.")
+
+    def get_texture(self, key, raw=False):
+        """
+        Returns the DDS data of the texture at index 'key', or of the texture whose file ID or texture name is 'key'.
+        If 'raw' is set, the GTF data is returned instead.
+        """
+        if not isinstance(key, int):
+            matches = [idx for idx, names in enumerate(self.texture_names) if key in names]
+            if not len(matches):
+                raise KeyError(f"No texture named '{key}'.")
+            key = matches[0]
+        return self.texture_data_raw[key] if raw else self.texture_data[key]
+
+
+def source_name(file):
+    """
+    Returns the file name of a PXBI file given to PXBIInterface.from_file, for naming its outputs after. Streams are
+    named after their 'name' attribute if they have one.
+    """
+    if not isinstance(file, (str, os.PathLike)):
+        file = getattr(file, 'name', None)
+        if not isinstance(file, (str, os.PathLike)):
+            return "model"
+    return os.path.split(os.fspath(file))[-1]
+
+
+class LazySequence:
+    """
+    A read-only sequence whose items are produced by calling 'loader' with their index whenever they are accessed.
+    """
+    def __init__(self, length, loader):
+        self.length = length
+        self.loader = loader
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.length))]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError("LazySequence index out of range")
+        return self.loader(idx)
+
+
 class MeshInterface:
+    """
+    'vertices' maps each attribute name to a column holding that attribute for every vertex; see
+    VertexLayout.decode_vertex_columns. 'vertex_attribute_sizes' gives the number of components per vertex in each column.
+    With NumPy each column is a (vertex_count, size) array, and without it a flat array('f') of vertex_count * size
+    components; VertexLayout.flatten_column gives the flat components of either.
+    'triangle_indices' is a flat array('H') holding three vertex indices per triangle; 'triangles' gives the same
+    indices grouped into a tuple per triangle.
+
+    If the mesh was read lazily, 'vertices' and 'triangle_indices' are read from the file the first time either is
+    accessed.
+    """
     def __init__(self, mesh):
         self.name = mesh.name
-        self.vertices = mesh.vertex_data
-        self.triangles = mesh.triangles
+        self.vertex_count = mesh.vertex_count
+        self.vertex_attribute_sizes = attribute_sizes(mesh.bytes_per_vertex)
         self.material_index = mesh.some_id
+        if mesh.payload_loaded:
+            self.vertices = mesh.vertex_data
+            self.triangle_indices = mesh.triangles
+        else:
+            self.reader = mesh
+
+    @property
+    def triangles(self):
+        indices = iter(self.triangle_indices)
+        return list(zip(indices, indices, indices))
+
+    @triangles.setter
+    def triangles(self, triangles):
+        self.triangle_indices = array('H', [idx for triangle in triangles for idx in triangle])
+
+    def __getattr__(self, name):
+        # Only called for attributes that have not been set yet
+        reader = self.__dict__.get('reader')
+        if name not in ('vertices', 'triangle_indices') or reader is None:
+            raise AttributeError(f"'MeshInterface' object has no attribute '{name}'")
+        reader.read_payload()
+        self.vertices = reader.vertex_data
+        self.triangle_indices = reader.triangles
+        del self.reader
+        return getattr(self, name)
         
 class MaterialInterface:
     def __init__(self, material):
@@ -44,53 +175,78 @@ class MaterialInterface:
         self.assigned_textures = material.assigned_textures
         
         
-def build_dds_header(height, width, size, depth, nmipmaps, dds_codec, flag):
-                  #<-------- MAGIC VALUE --------->#  #<----- HEADER SIZE (124) ------>#  #<--------- DDS FLAGS ---------->#
-    dds_header = [b'\x44', b'\x44', b'\x53', b'\x20', b'\x7c', b'\x00', b'\x00', b'\x00', b'\x07', b'\x10', b'\x00', b'\x00']
-    dds_header.append(struct.pack('I', height))
-    dds_header.append(struct.pack('I', width))
-    dds_header.append(struct.pack('I', size))
-    dds_header.append(struct.pack('I', depth))
-    dds_header.append(struct.pack('I', nmipmaps))
-
-                       #<--------------------------------------------------------------- RESERVED ----------------------------------------------------------------->#
-    dds_header.extend([b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00',
-                       b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00',
-                       b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', 
-              
-                      ################
-                      # PIXEL FORMAT #
-                      ################
-                      # STRUCTURE SIZE
-                      b'\x20', b'\x00', b'\x00', b'\x00',
-                      #<-------- PXF FLAGS -------->#  #< COMPRESSION FORMAT >#   #<-------- RGB BITCOUNT -------->#
-                      flag, b'\x00', b'\x00', b'\x00', dds_codec,                 b'\x20', b'\x00', b'\x00', b'\x00', 
-                      #<-------- RED BITMASK --------->#  #<------- GREEN BITMASK -------->#  #<------- BLUE BITMASK --------->#  #<------- ALPHA BITMASK -------->#
-                      b'\x00', b'\x00', b'\xff', b'\x00', b'\x00', b'\xff', b'\x00', b'\x00', b'\xff', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\xff', 
-                      #<----------- CAPS 1 ----------->#  #<----------- CAPS 2 ----------->#  #<----------- CAPS 3 ----------->#  #<----------- CAPS 4 ----------->#
-                      b'\x00', b'\x10', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00',
-                      #<---------- RESERVED ---------->#
-                      b'\x00', b'\x00', b'\x00', b'\x00'])
-
-    return b''.join(dds_header)
-
-dds_codices = {166: 'DXT1'.encode('ascii'),
-               133: b''.join([b'\x00', b'\x00', b'\x00', b'\x00']),
-               134: 'DXT1'.encode('ascii'),
-               136: 'DXT5'.encode('ascii')}
-
-pxf_flags = {166: b'\x04',
-             133: b'\x41',
-             134: b'\x04',
-             136: b'\x04'}
-
-def convert_gtf_to_dds(gtf_data):
-    codec = gtf_data[24]
-    w = struct.unpack('>H', gtf_data[32:34])[0]
-    h = struct.unpack('>H', gtf_data[34:36])[0]
-    depth = struct.unpack('>H', gtf_data[36:38])[0]
-    
-    dds_codec = dds_codices[codec]
-    flag = pxf_flags[codec]
-    
-    return build_dds_header(h, w, h*w, depth, 4, dds_codec, flag) + gtf_data[128:]
\ No newline at end of file
+# DDS header flags
+DDSD_CAPS = 0x1
+DDSD_HEIGHT = 0x2
+DDSD_WIDTH = 0x4
+DDSD_PITCH = 0x8
+DDSD_PIXELFORMAT = 0x1000
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDSD_DEPTH = 0x800000
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_TEXTURE = 0x1000
+DDSCAPS_MIPMAP = 0x400000
+DDSCAPS2_CUBEMAP_ALL_FACES = 0xFE00
+DDSCAPS2_VOLUME = 0x200000
+
+# Maps the GTF format names in GTFReader.texture_formats to the DDS pixel format of the same texels: the pixel format
+# flags, the FourCC code, the bits per texel and the red, green, blue and alpha bitmasks
+dds_pixel_formats = {'B8':       (0x20000, b'\x00\x00\x00\x00', 8,  0xFF,     0,      0,    0),
+                     'A1R5G5B5': (0x41,    b'\x00\x00\x00\x00', 16, 0x7C00,   0x3E0,  0x1F, 0x8000),
+                     'A4R4G4B4': (0x41,    b'\x00\x00\x00\x00', 16, 0xF00,    0xF0,   0xF,  0xF000),
+                     'R5G6B5':   (0x40,    b'\x00\x00\x00\x00', 16, 0xF800,   0x7E0,  0x1F, 0),
+                     'A8R8G8B8': (0x41,    b'\x00\x00\x00\x00', 32, 0xFF0000, 0xFF00, 0xFF, 0xFF000000),
+                     'DXT1':     (0x4,     b'DXT1',             0,  0,        0,      0,    0),
+                     'DXT3':     (0x4,     b'DXT3',             0,  0,        0,      0,    0),
+                     'DXT5':     (0x4,     b'DXT5',             0,  0,        0,      0,    0)}
+
+
+def build_dds_header(texture):
+    """
+    Builds the 128-byte DDS header describing a texture read by GTFReader, including its mipmaps and, if it is a cube
+    map or volume texture, its faces or depth.
+    """
+    pixel_format = dds_pixel_formats[texture.format_name]
+    _, block_bytes, block_size = texture.format_info
+    flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_MIPMAPCOUNT
+    caps, caps2 = DDSCAPS_TEXTURE, 0
+    if texture.is_compressed:
+        flags |= DDSD_LINEARSIZE
+        pitch_or_linear_size = ((texture.width + 3) // 4) * ((texture.height + 3) // 4) * block_bytes
+    else:
+        flags |= DDSD_PITCH
+        pitch_or_linear_size = texture.width * block_bytes
+    mipmap_count = max(texture.mipmap_count, 1)
+    if mipmap_count > 1:
+        caps |= DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+    if texture.cubemap:
+        caps |= DDSCAPS_COMPLEX
+        caps2 |= DDSCAPS2_CUBEMAP_ALL_FACES
+    depth = 0
+    if texture.dimension == 3:
+        flags |= DDSD_DEPTH
+        caps |= DDSCAPS_COMPLEX
+        caps2 |= DDSCAPS2_VOLUME
+        depth = texture.depth
+
+    return b''.join([b'DDS ',
+                     struct.pack('<7I', 124, flags, texture.height, texture.width, pitch_or_linear_size, depth,
+                                 mipmap_count),
+                     b'\x00' * 44,
+                     struct.pack('<2I', 32, pixel_format[0]),
+                     pixel_format[1],
+                     struct.pack('<5I', *pixel_format[2:]),
+                     struct.pack('<5I', caps, caps2, 0, 0, 0)])
+
+
+def convert_gtf_to_dds(gtf_data, file_offset=0):
+    """
+    Converts a GTF file to a DDS file holding the same texture: every mipmap level and cube map face is kept,
+    swizzled textures are put in row-by-row order, and uncompressed texels are converted to the byte order DDS uses.
+    Only the first texture of a GTF file holding several is converted. 'file_offset' is as for GTFReader.read_gtf.
+    """
+    with Profiling.stage('dds_conversion'):
+        Profiling.count('textures_converted')
+        texture = read_gtf(gtf_data, file_offset=file_offset).textures[0]
+        return b''.join([build_dds_header(texture), *texture.read_texture_data(gtf_data)])
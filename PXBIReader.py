@@ -1,7 +1,69 @@
-from BaseRW import BaseRW
+import Profiling
+from BaseRW import BaseRW, RecordSchema, validation_levels
+from VertexLayout import vertex_layouts, decode_vertex_columns, encode_vertex_columns, decode_indices, encode_indices, \
+    flatten_column
 import struct
 
+# The texture region, which holds the GTF files, starts on a multiple of this many bytes from the start of the file
+TEXTURE_ALIGNMENT = 128
+
+# The parts of a PXBI file that can be selected for reading; see PXBIReadWriter.read
+all_sections = ('meshes', 'materials', 'skeleton', 'textures')
+
 class PXBIReadWriter(BaseRW):
+    header_schema = RecordSchema((("filetype", "4s"),
+                                  ("contents_size", "I"),  # (?) Mising 64 bytes from total file size
+                                  ("unknown_0x08", "I"),  # Number of subreaders?
+                                  ("next_filetype", "4s"),
+
+                                  ("always_64", "I", 64),  # File pointer offset?
+                                  ("file_mesh_names_pointer", "I"),
+                                  ("materials_bones_names_pointer", "I"),
+                                  ("unknown_bytecount_2", "I"),  ############
+
+                                  ("pointer_list_pointer", "I"),
+                                  ("pointer_list_size", "I"),
+                                  ("textures_pointer", "I"),
+                                  ("end_of_file_pointer", "I"),
+
+                                  ("padding_0x30", "I", 0),
+                                  ("padding_0x34", "I", 0),
+                                  ("padding_0x38", "I", 0),
+                                  ("padding_0x3C", "I", 0),
+
+                                  ("always_3", "I", 3),  ############
+                                  ("always_52", "I", 52),  # Pointer to mesh header pointer....?
+                                  ("padding_0x48", "I", 0),
+                                  ("padding_pointer", "I"),
+
+                                  ("texture_count", "I"),
+                                  ("texture_pointers_pointer", "I"),
+                                  ("unknown_pointer_9", "I"),  #############
+                                  ("padding_0x5C", "I", 0),
+
+                                  ("padding_0x60", "I", 0),
+                                  ("padding_0x64", "I", 0),
+                                  ("padding_0x68", "I", 0),
+                                  ("padding_0x6C", "I", 0),
+
+                                  ("padding_0x70", "I", 0),
+                                  ("always_68", "I", 68),  # Mesh header pointer? If it's always 68, it might be a pointer to the mesh header...
+                                  ("material_count", "I"),
+                                  ("material_pointers_pointer", "I"),
+
+                                  ("bone_pointers_pointer", "I"),
+                                  ("mesh_count", "I"),  # nmeshes
+                                  ("mesh_pointers_pointer", "I")), endianness='>')  # Missing 64 bytes
+
+    # The fields of the header that point somewhere relative to 'offset', and so may be in the pointer list
+    header_pointer_fields = ("always_52", "padding_pointer", "texture_pointers_pointer", "unknown_pointer_9",
+                             "always_68", "material_pointers_pointer", "bone_pointers_pointer", "mesh_pointers_pointer")
+
+    bone_matrix_pointers_schema = RecordSchema((("skeleton_name_pointer", "I"),
+                                                ("bone_count", "I"),
+                                                ("bone_matrices_pointer", "I"),
+                                                ("joint_count", "I")), endianness='>')
+
     def __init__(self, F):
         super().__init__(F)
         self.offset = 64
@@ -9,101 +71,96 @@ class PXBIReadWriter(BaseRW):
         self.meshes = None
         self.materials = None
         self.bone_data = []
+        self.bone_name_pointers = []
+        self.joint_data = []
         self.joint_names = []
         self.texture_names = []
         self.texture_binary = []
+        self.strings = {}
+        self.sections = all_sections
+        self.lazy = False
+        self.read_pointer_fields = None
+        self.relocated_pointers = None
     
-    def read(self):
-        self.read_write(self.read_buffer, self.read_raw, self.read_ascii, "read", self.cleanup_ragged_chunk_read, self.prepare_read_operation)
+    def read(self, sections=None, lazy=False, validation='strict'):
+        """
+        Reads the file. The header, pointer tables, string region, texture names, and bone and joint counts are always
+        read. The names of the meshes, materials, bones and joints are only read along with their sections.
+
+        Inputs
+        ------
+        sections -- the parts of 'all_sections' to read; anything else is skipped over. Defaults to every section.
+        lazy -- if set, only the mesh headers are read rather than the whole meshes, and the texture binaries are not
+                read. These can be read later with 'MeshReadWrite.read_payload' and 'read_texture'.
+        validation -- how thoroughly to check the file, from BaseRW.validation_levels. 'strict' checks every assumption
+                      made about the layout, 'fast' only checks that the counts and pointers stay within the file, and
+                      'off' checks nothing. Default: 'strict'.
+        """
+        assert validation in validation_levels, f"Unknown validation level '{validation}'."
+        self.sections = all_sections if sections is None else tuple(sections)
+        self.lazy = lazy
+        self.validation = validation
+        self.read_write(self.read_buffer, self.read_raw, self.read_record, "read", self.cleanup_ragged_chunk_read, self.prepare_read_operation)
         self.interpret_data()
+        if self.sections == all_sections:
+            self.read_pointer_fields = self.pointer_fields()
+            self.relocated_pointers = self.relocated_pointer_kinds(self.read_pointer_fields)
     
-    def read_write(self, rw_operator, rw_operator_raw, rw_ascii_operator, rw_method_name, chunk_cleanup_operator, preparation_operator):
-        self.rw_header(rw_operator, rw_ascii_operator)
-        preparation_operator()
-        self.rw_mesh_pointers(rw_operator)
-        self.rw_meshes(rw_method_name, chunk_cleanup_operator)
-        self.rw_material_pointers(rw_operator)
-        self.rw_materials(rw_method_name)
-        self.rw_bone_matrix_pointers(rw_operator)
-        self.rw_bone_matrices(rw_operator)
-        self.rw_joints(rw_operator)
-        self.rw_texture_pointers(rw_operator)
-        self.rw_strings(rw_operator)
-        self.rw_pointer_list(rw_operator)
-        self.rw_textures_header(rw_operator)
-        self.rw_textures(rw_operator_raw)
-        self.check_eof()
-        
-    def rw_header(self, rw_operator, rw_ascii_operator):
-        rw_ascii_operator("filetype", 4)
-        rw_operator("contents_size", "I", endianness=">")  # (?) Mising 64 bytes from total file size
-        rw_operator("unknown_0x08", "I", endianness=">")  # Number of subreaders?
-        rw_ascii_operator("next_filetype", 4)
-        
-        rw_operator("always_64", "I", endianness=">") # File pointer offset?
-        rw_operator("file_mesh_names_pointer", "I", endianness=">")
-        rw_operator("materials_bones_names_pointer", "I", endianness=">")
-        rw_operator("unknown_bytecount_2", "I", endianness=">")  ############
-        self.assert_equal("always_64", 64)
-        
-        rw_operator("pointer_list_pointer", "I", endianness=">")
-        rw_operator("pointer_list_size", "I", endianness=">")
-        rw_operator("textures_pointer", "I", endianness=">")
-        rw_operator("end_of_file_pointer", "I", endianness=">")
-        
-        rw_operator("padding_0x30", "I", endianness=">")
-        rw_operator("padding_0x34", "I", endianness=">")
-        rw_operator("padding_0x38", "I", endianness=">")
-        rw_operator("padding_0x3C", "I", endianness=">")
-        self.assert_is_zero("padding_0x30")
-        self.assert_is_zero("padding_0x34")
-        self.assert_is_zero("padding_0x38")
-        self.assert_is_zero("padding_0x3C")
-        
-        rw_operator("always_3", "I", endianness=">")  ############
-        rw_operator("always_52", "I", endianness=">")  # Pointer to mesh header pointer....?
-        rw_operator("padding_0x48", "I", endianness=">")
-        rw_operator("padding_pointer", "I", endianness=">")
-        self.assert_equal("always_3", 3)
-        self.assert_equal("always_52", 52)
-        self.assert_is_zero("padding_0x48")
-        
-        rw_operator("texture_count", "I", endianness=">")
-        rw_operator("texture_pointers_pointer", "I", endianness=">")
-        rw_operator("unknown_pointer_9", "I", endianness=">")  #############
-        rw_operator("padding_0x5C", "I", endianness=">")
-        self.assert_is_zero("padding_0x5C")
-        
-        rw_operator("padding_0x60", "I", endianness=">")
-        rw_operator("padding_0x64", "I", endianness=">")
-        rw_operator("padding_0x68", "I", endianness=">")
-        rw_operator("padding_0x6C", "I", endianness=">")
-        self.assert_is_zero("padding_0x60")
-        self.assert_is_zero("padding_0x64")
-        self.assert_is_zero("padding_0x68")
-        self.assert_is_zero("padding_0x6C")
-        
-        rw_operator("padding_0x70", "I", endianness=">")
-        rw_operator("always_68", "I", endianness=">")  # Mesh header pointer?
-        rw_operator("material_count", "I", endianness=">")
-        rw_operator("material_pointers_pointer", "I", endianness=">")
-        self.assert_is_zero("padding_0x70")
-        self.assert_equal("always_68", 68)  # If it's always 68, it might be a pointer to the mesh header...
-        
-        rw_operator("bone_pointers_pointer", "I", endianness=">")
-        rw_operator("mesh_count", "I", endianness=">") # nmeshes
-        rw_operator("mesh_pointers_pointer", "I", endianness=">") # Missing 64 bytes
+    def read_write(self, rw_operator, rw_operator_raw, rw_record_operator, rw_method_name, chunk_cleanup_operator, preparation_operator):
+        with Profiling.stage('read.header'):
+            self.rw_header(rw_record_operator)
+            preparation_operator()
+        with Profiling.stage('read.meshes'):
+            self.rw_mesh_pointers(rw_operator)
+            self.rw_meshes(rw_method_name, chunk_cleanup_operator)
+        with Profiling.stage('read.materials'):
+            self.rw_material_pointers(rw_operator)
+            self.rw_materials(rw_method_name)
+        with Profiling.stage('read.skeleton'):
+            if 'skeleton' in self.sections:
+                self.rw_bone_matrix_pointers(rw_record_operator)
+                self.rw_bone_matrices(rw_operator)
+                self.rw_joints(rw_operator)
+            else:
+                # The bone and joint counts are read even when the bones themselves are skipped
+                self.rw_bone_matrix_pointers(rw_record_operator)
+                self.bytestream.seek(self.padding_pointer + self.offset)
+        with Profiling.stage('read.strings'):
+            self.rw_texture_pointers(rw_operator)
+            self.rw_strings(rw_operator_raw)
+            self.rw_pointer_list(rw_operator)
+        with Profiling.stage('read.textures'):
+            self.rw_textures_header(rw_operator)
+            if 'textures' in self.sections and not self.lazy:
+                self.rw_textures(rw_operator_raw)
+            else:
+                self.bytestream.seek(self.end_of_file_pointer + self.textures_pointer)
+            self.check_eof()
+        
+    def rw_header(self, rw_record_operator):
+        rw_record_operator(self.header_schema)
         
         
     def prepare_read_operation(self):
-        self.meshes = [MeshReadWrite(self.bytestream) for _ in range(self.mesh_count)]
-        self.materials = [MaterialReadWrite(self.bytestream) for _ in range(self.material_count)]
+        self.assert_fits_in_file("mesh_count", self.mesh_count, 4 + MeshReadWrite.header_schema.size)
+        self.assert_fits_in_file("material_count", self.material_count, 4 + MaterialReadWrite.schema.size)
+        self.meshes = [MeshReadWrite(self.bytestream) for _ in range(self.mesh_count if 'meshes' in self.sections else 0)]
+        self.materials = [MaterialReadWrite(self.bytestream) for _ in range(self.material_count if 'materials' in self.sections else 0)]
+        for subreader in self.meshes + self.materials:
+            subreader.validation = self.validation
         
     def rw_mesh_pointers(self, rw_operator):
         self.assert_file_pointer_now_at(self.mesh_pointers_pointer + self.offset)
-        rw_operator("mesh_pointers", "I"*self.mesh_count, endianness='>')
+        rw_operator("mesh_pointers", "I"*self.mesh_count, endianness='>', force_1d=True)
         
     def rw_meshes(self, rw_method_name, chunk_cleanup_operator):
+        if 'meshes' not in self.sections or self.lazy:
+            for rdr, ptr in zip(self.meshes, self.mesh_pointers):
+                self.bytestream.seek(ptr + self.offset)
+                rdr.read_header()
+            self.bytestream.seek(self.material_pointers_pointer + self.offset)
+            return
+
         for rdr, ptr in zip(self.meshes, self.mesh_pointers):
             self.assert_file_pointer_now_at(ptr + self.offset)
             getattr(rdr, rw_method_name)()
@@ -111,7 +168,7 @@ class PXBIReadWriter(BaseRW):
         
     def rw_material_pointers(self, rw_operator):
         self.assert_file_pointer_now_at(self.material_pointers_pointer + self.offset)
-        rw_operator("material_pointers", "I"*self.material_count, endianness='>')
+        rw_operator("material_pointers", "I"*self.material_count, endianness='>', force_1d=True)
         
     def rw_materials(self, rw_method_name):
         for material, ptr in zip(self.materials, self.material_pointers):
@@ -119,20 +176,19 @@ class PXBIReadWriter(BaseRW):
             getattr(material, rw_method_name)()
         self.bytestream.seek(self.bone_pointers_pointer + self.offset)
     
-    def rw_bone_matrix_pointers(self, rw_operator):
+    def rw_bone_matrix_pointers(self, rw_record_operator):
         self.assert_file_pointer_now_at(self.bone_pointers_pointer + self.offset)
-        rw_operator("skeleton_name_pointer", 'I', endianness='>')
-        rw_operator("bone_count", 'I', endianness='>')
-        rw_operator("bone_matrices_pointer", 'I', endianness='>')
-        rw_operator("joint_count", 'I', endianness='>')
+        rw_record_operator(self.bone_matrix_pointers_schema)
         
     def rw_bone_matrices(self, rw_operator):
         if self.bone_matrices_pointer != 0:
             self.assert_file_pointer_now_at(self.bone_matrices_pointer + self.offset - 4)
+            self.assert_fits_in_file("bone_count", self.bone_count, 72)
             rw_operator("bone_data", "IIffffffffffffffff"*self.bone_count, endianness='>')
         
     def rw_joints(self, rw_operator):
         rw_operator("joint_list_name", "I", endianness='>')
+        self.assert_fits_in_file("joint_count", self.joint_count, 64)
         rw_operator("joint_data", "hhhhhhhhhhIIfffffffff"*self.joint_count, endianness='>')
         
     def rw_texture_pointers(self, rw_operator):
@@ -141,38 +197,56 @@ class PXBIReadWriter(BaseRW):
         rw_operator("unknown_texture_pointer", "I", endianness='>')  # 16306496
         if self.unknown_texture_pointer != 0:
             self.assert_file_pointer_now_at(self.unknown_texture_pointer + self.offset)
-            print(self.bytestream.read(64))
+            print(bytes(self.bytestream.read(64)))
 
 
         self.assert_file_pointer_now_at(self.texture_pointers_pointer + self.offset)
-        rw_operator("texture_pointers", "I"*self.texture_count, endianness='>')  # Points to the texture pointer info
+        self.assert_fits_in_file("texture_count", self.texture_count, 20)
+        rw_operator("texture_pointers", "I"*self.texture_count, endianness='>', force_1d=True)  # Points to the texture pointer info
         rw_operator("texture_pointer_info", "IIII"*self.texture_count, endianness='>') # File number, filepath, size, offset
 
-    def rw_strings(self, rw_operator):
-        # Just skip the strings
+    def rw_strings(self, rw_operator_raw):
+        # Read the whole string region in one go; 'interpret_data' indexes it
         self.assert_file_pointer_now_at(self.file_mesh_names_pointer + self.offset)
-        self.bytestream.seek(self.pointer_list_pointer + self.offset)
+        self.assert_fits_in_file("string region size", self.pointer_list_pointer - self.file_mesh_names_pointer, 1)
+        rw_operator_raw("string_data", self.pointer_list_pointer - self.file_mesh_names_pointer)
         
     def rw_pointer_list(self, rw_operator):
         self.bytestream.seek(self.pointer_list_pointer + self.offset)
         num_to_read = (self.pointer_list_size - self.offset) // 4
+        self.assert_fits_in_file("pointer_list_size", num_to_read, 4)
         rw_operator("pointer_list", 'I'*num_to_read, endianness='>')
         
     def rw_textures_header(self, rw_operator):
         self.bytestream.seek(self.textures_pointer)
+        self.assert_fits_in_file("texture_count", self.texture_count, 8)
         rw_operator("num_textures_2", 'I', endianness='>')
         rw_operator("textures_header", 'I'*2*self.texture_count, endianness='>')  # This is a repeat of 'texture_pointer_info'
 
     def rw_textures(self, rw_operator_raw):
         """
         This needs to be changed to be read-write agnostic too if files are to be writable in the future, I'm just lazy
+
+        If the bytestream is a MappedReader, the texture binaries are memoryviews of the mapped file rather than copies.
         """
         for size, rel_ptr in zip(self.textures_header[::2], self.textures_header[1::2]):
             ptr = rel_ptr + self.textures_pointer
             self.assert_file_pointer_now_at(ptr)
+            self.assert_fits_in_file("texture size", size, 1)
             self.texture_binary.append(self.bytestream.read(size))
 
+    def read_texture(self, index):
+        """
+        Reads a single texture binary, e.g. one skipped by a lazy read.
+        """
+        size, rel_ptr = self.textures_header[2*index:2*index + 2]
+        self.bytestream.seek(rel_ptr + self.textures_pointer)
+        self.assert_fits_in_file("texture size", size, 1)
+        return self.bytestream.read(size)
+
     def check_eof(self):
+        if self.validation != 'strict':
+            return
         self.assert_file_pointer_now_at(self.end_of_file_pointer + self.textures_pointer)
         # If we're in read-mode, get next byte, which should not exist
         eof = b''
@@ -188,133 +262,426 @@ class PXBIReadWriter(BaseRW):
         Takes the raw data read from a file and turns it into something that is more human-readable.
         Should be the inverse of 'reinterpret_data', which should be called before writing the file.
         """
-        bone_matrix_data = []
-        if len(self.bone_data):
-            for chunk in chunks(self.bone_data, 18):
-                ptr_1 = chunk[0]
-                if ptr_1 != 0:
-                    name_1 = read_string_inplace(self.bytestream, ptr_1 + self.offset)
-                else:
-                    name_1 = ''
-                idx = chunk[1]  # Parent idx?
-    
-                matrix = [chunk[2:6], chunk[6:10], chunk[10:14], chunk[14:18]]
-                bone_matrix_data.append([name_1, idx, matrix])
-        self.bone_data = bone_matrix_data
-        self.joint_data = list(chunks(self.joint_data, 21))
-        self.joint_names = [read_string_inplace(self.bytestream, data[10]+self.offset) for data in self.joint_data]
-        
-        for file_ptr, name_ptr in zip(self.texture_pointer_info[::4], self.texture_pointer_info[1::4]):
-            self.texture_names.append((read_string_inplace(self.bytestream, file_ptr+self.offset),
-                                       read_string_inplace(self.bytestream, name_ptr+self.offset)))
+        with Profiling.stage('interpret.strings'):
+            self.strings = build_string_table(self.string_data, self.file_mesh_names_pointer)
+        with Profiling.stage('interpret.meshes'):
+            for mesh in self.meshes:
+                mesh.interpret_data(self.lookup_string)
+        with Profiling.stage('interpret.materials'):
+            for material in self.materials:
+                material.interpret_data(self.lookup_string)
+
+        with Profiling.stage('interpret.skeleton'):
+            bone_matrix_data = []
+            self.bone_name_pointers = list(self.bone_data[0::18])
+            if len(self.bone_data):
+                for chunk in chunks(self.bone_data, 18):
+                    ptr_1 = chunk[0]
+                    if ptr_1 != 0:
+                        name_1 = self.lookup_string(ptr_1)
+                    else:
+                        name_1 = ''
+                    idx = chunk[1]  # Parent idx?
+        
+                    matrix = [chunk[2:6], chunk[6:10], chunk[10:14], chunk[14:18]]
+                    bone_matrix_data.append([name_1, idx, matrix])
+            self.bone_data = bone_matrix_data
+            self.joint_data = list(chunks(self.joint_data, 21))
+            self.joint_names = [self.lookup_string(data[10]) for data in self.joint_data]
+        
+        with Profiling.stage('interpret.textures'):
+            for file_ptr, name_ptr in zip(self.texture_pointer_info[::4], self.texture_pointer_info[1::4]):
+                self.texture_names.append((self.lookup_string(file_ptr), self.lookup_string(name_ptr)))
+
+    def pointer_fields(self):
+        """
+        Returns the position (relative to 'offset') and kind of every pointer field that 'plan_layout' places, in the
+        order they appear in the file. The kind is the name of the field and whether it holds a null pointer, since a
+        pointer list need not relocate null pointers.
+        """
+        fields = []
+
+        def add(position, name, value):
+            fields.append((position, (name, value == 0)))
+
+        for name in self.header_pointer_fields:
+            add(self.header_schema.offset_of(name) - self.offset, name, getattr(self, name))
+
+        for idx, (mesh, ptr) in enumerate(zip(self.meshes, self.mesh_pointers)):
+            add(self.mesh_pointers_pointer + 4*idx, "mesh_pointers", ptr)
+            for name in ("name_pointer", "vertices_pointer", "triangles_pointer"):
+                add(ptr + mesh.header_schema.offset_of(name), "mesh." + name, getattr(mesh, name))
+
+        for idx, (material, ptr) in enumerate(zip(self.materials, self.material_pointers)):
+            add(self.material_pointers_pointer + 4*idx, "material_pointers", ptr)
+            for name in ("name_pointer", "texture_assignment_pointer"):
+                add(ptr + material.schema.offset_of(name), "material." + name, getattr(material, name))
+            for texture_idx, texture_ptr in enumerate(material.texture_pointers):
+                add(material.texture_assignment_pointer + 4*texture_idx, "material.texture_pointers", texture_ptr)
+
+        for name in ("skeleton_name_pointer", "bone_matrices_pointer"):
+            add(self.bone_pointers_pointer + self.bone_matrix_pointers_schema.offset_of(name), name, getattr(self, name))
+        position = self.bone_pointers_pointer + self.bone_matrix_pointers_schema.size
+        for name_pointer in self.bone_name_pointers:
+            add(position, "bone.name_pointer", name_pointer)
+            position += 72
+        add(position, "joint_list_name", self.joint_list_name)
+        position += 4
+        for joint in self.joint_data:
+            add(position + 20, "joint.name_pointer", joint[10])
+            position += 64
+
+        add(self.padding_pointer + 4, "unknown_texture_pointer", self.unknown_texture_pointer)
+        for idx, ptr in enumerate(self.texture_pointers):
+            add(self.texture_pointers_pointer + 4*idx, "texture_pointers", ptr)
+            add(ptr, "texture.file_pointer", self.texture_pointer_info[4*idx])
+            add(ptr + 4, "texture.name_pointer", self.texture_pointer_info[4*idx + 1])
+        return sorted(fields)
+
+    def relocated_pointer_kinds(self, fields):
+        """
+        Works out which kinds of field in 'fields' (see 'pointer_fields') the pointer list holds.
+
+        Returns
+        ------
+        The set of kinds, or None if the pointer list holds anything other than every field of those kinds in file
+        order, in which case it cannot be rebuilt for a different layout.
+        """
+        kinds = dict(fields)
+        if not all(position in kinds for position in self.pointer_list):
+            return None
+        relocated = {kinds[position] for position in self.pointer_list}
+        if [position for position, kind in fields if kind in relocated] != list(self.pointer_list):
+            return None
+        return relocated
+
+    def lookup_string(self, pointer):
+        """
+        Returns the string at 'pointer' (relative to 'offset'). Strings that do not start in the string region are read
+        from the file and cached.
+        """
+        string = self.strings.get(pointer)
+        if string is None:
+            string = read_string_inplace(self.bytestream, pointer + self.offset)
+            self.strings[pointer] = string
+        return string
+
+    def write(self, F):
+        """
+        Writes the file to 'F', a file opened in 'write-binary' (wb) mode, with a single call. 'F' must not be the file
+        that was read, since that is still read from while packing if any of it was read lazily. See 'pack'.
+        """
+        data = self.pack()
+        with Profiling.stage('write.file'):
+            F.write(data)
+
+    def pack(self):
+        """
+        Lays the file out with 'plan_layout', then packs every part of it into a single preallocated bytearray.
+
+        The object must have been read in full, i.e. with every section. Mesh and texture data skipped by a lazy read
+        is copied across from the bytestream without being decoded.
+
+        Returns
+        ------
+        The file as a bytearray.
+        """
+        assert self.sections == all_sections, f"Only files read with every section can be written, not {self.sections}."
+        with Profiling.stage('write.payloads'):
+            # These must be fetched before 'plan_layout' moves the pointers to them
+            mesh_payloads = [mesh.reinterpret_data() for mesh in self.meshes]
+            texture_binary = self.texture_binary if len(self.texture_binary) else \
+                [self.read_texture(idx) for idx in range(self.texture_count)]
+        with Profiling.stage('write.layout'):
+            size = self.plan_layout([len(texture) for texture in texture_binary])
+
+        with Profiling.stage('write.pack'):
+            buffer = bytearray(size)
+            self.header_schema.pack_into(buffer, 0, [getattr(self, name) for name in self.header_schema.names])
+
+            pack_pointers(buffer, self.mesh_pointers_pointer + self.offset, self.mesh_pointers)
+            for mesh, ptr, (vertex_data, triangles) in zip(self.meshes, self.mesh_pointers, mesh_payloads):
+                mesh.pack_into(buffer, ptr + self.offset, vertex_data, triangles)
+
+            pack_pointers(buffer, self.material_pointers_pointer + self.offset, self.material_pointers)
+            for material, ptr in zip(self.materials, self.material_pointers):
+                material.pack_into(buffer, ptr + self.offset)
+
+            position = self.bone_pointers_pointer + self.offset
+            self.bone_matrix_pointers_schema.pack_into(buffer, position,
+                                                       [getattr(self, name) for name in self.bone_matrix_pointers_schema.names])
+            position += self.bone_matrix_pointers_schema.size
+            bone_values = []
+            for name_pointer, (name, idx, matrix) in zip(self.bone_name_pointers, self.bone_data):
+                bone_values.append(name_pointer)
+                bone_values.append(idx)
+                for row in matrix:
+                    bone_values.extend(row)
+            struct.pack_into(">" + "IIffffffffffffffff"*self.bone_count, buffer, position, *bone_values)
+            position += 72*self.bone_count
+            struct.pack_into(">I", buffer, position, self.joint_list_name)
+            struct.pack_into(">" + "hhhhhhhhhhIIfffffffff"*self.joint_count, buffer, position + 4,
+                             *[value for joint in self.joint_data for value in joint])
+
+            struct.pack_into(">II", buffer, self.padding_pointer + self.offset, self.unknown_0x00, self.unknown_texture_pointer)
+            pack_pointers(buffer, self.texture_pointers_pointer + self.offset, self.texture_pointers)
+            struct.pack_into(">" + "IIII"*self.texture_count, buffer, self.texture_pointers[0] + self.offset if self.texture_count else 0,
+                             *self.texture_pointer_info)
+
+            position = self.file_mesh_names_pointer + self.offset
+            buffer[position:position + len(self.string_data)] = self.string_data
+            pack_pointers(buffer, self.pointer_list_pointer + self.offset, self.pointer_list)
+
+            struct.pack_into(">I" + "I"*2*self.texture_count, buffer, self.textures_pointer, self.num_textures_2,
+                             *self.textures_header)
+            for texture, rel_ptr in zip(texture_binary, self.textures_header[1::2]):
+                position = rel_ptr + self.textures_pointer
+                buffer[position:position + len(texture)] = texture
+        return buffer
+
+    def plan_layout(self, texture_sizes):
+        """
+        Works out where every part of the file goes when it is written, given the sizes of the texture binaries, and
+        updates every pointer and count to match. Afterwards, the object holds the same values as if the file it
+        describes had been read, so a file that is read and written without changes comes out byte-for-byte the same.
+
+        The string region is kept as it was read, with any names that it does not already hold appended, so pointers
+        into it whose purpose is not known can still be moved along with it. Other values whose meaning is not known
+        are written as they were read.
+
+        The pointer list is rebuilt from the kinds of pointer field it held when it was read (see 'pointer_fields'),
+        so that it covers every such field in the new layout. If the list that was read could not be matched to the
+        fields, it is kept as it was, which is only possible if every field is still where it was.
+
+        Returns
+        ------
+        The size of the file in bytes.
+
+        Raises
+        ------
+        ValueError -- if the pointer list could not be matched to the fields when it was read, and the fields have
+                      moved since
+        """
+        assert self.unknown_texture_pointer == 0, "Files with an unknown texture pointer cannot be written yet."
+        strings = StringRegionPlanner(self.string_data, self.file_mesh_names_pointer, self.strings)
+        mesh_names = [strings.locate(mesh.name_pointer, mesh.name) for mesh in self.meshes]
+        material_names = [strings.locate(material.name_pointer, material.name) for material in self.materials]
+        bone_names = [strings.locate(ptr, name) for ptr, (name, _, _) in zip(self.bone_name_pointers, self.bone_data)]
+        joint_names = [strings.locate(joint[10], name) for joint, name in zip(self.joint_data, self.joint_names)]
+        texture_names = [(strings.locate(file_ptr, file_name), strings.locate(name_ptr, texture_name))
+                         for file_ptr, name_ptr, (file_name, texture_name)
+                         in zip(self.texture_pointer_info[::4], self.texture_pointer_info[1::4], self.texture_names)]
+
+        position = self.header_schema.size
+        self.mesh_count = len(self.meshes)
+        self.mesh_pointers_pointer = position - self.offset
+        position += 4*self.mesh_count
+        self.mesh_pointers = []
+        for mesh in self.meshes:
+            self.mesh_pointers.append(position - self.offset)
+            position = mesh.plan_layout(position)
+
+        self.material_count = len(self.materials)
+        self.material_pointers_pointer = position - self.offset
+        position += 4*self.material_count
+        self.material_pointers = []
+        for material in self.materials:
+            self.material_pointers.append(position - self.offset)
+            position = material.plan_layout(position)
+
+        self.bone_count = len(self.bone_data)
+        self.joint_count = len(self.joint_data)
+        self.bone_pointers_pointer = position - self.offset
+        position += self.bone_matrix_pointers_schema.size
+        # This points to the second field of the first bone
+        self.bone_matrices_pointer = position - self.offset + 4 if self.bone_count else 0
+        position += 72*self.bone_count + 4 + 64*self.joint_count
+
+        self.texture_count = len(self.texture_names)
+        self.padding_pointer = position - self.offset
+        position += 8
+        self.texture_pointers_pointer = position - self.offset
+        position += 4*self.texture_count
+        self.texture_pointers = [position - self.offset + 16*idx for idx in range(self.texture_count)]
+        position += 16*self.texture_count
+
+        # Texture offsets are relative to the start of the texture region, rather than 'offset'
+        self.num_textures_2 = self.texture_count
+        texture_offset = 4 + 8*self.texture_count
+        self.textures_header = []
+        for size in texture_sizes:
+            self.textures_header.extend((size, texture_offset))
+            texture_offset += size
+
+        string_region_size = align(len(strings.data), 4)
+        strings.move_to(position - self.offset)
+        position += string_region_size
+
+        # Now that the string region is in place, point everything at it
+        for mesh, name_pointer in zip(self.meshes, mesh_names):
+            mesh.name_pointer = strings.pointer(name_pointer)
+        for material, name_pointer in zip(self.materials, material_names):
+            material.name_pointer = strings.pointer(name_pointer)
+        self.bone_name_pointers = [strings.pointer(name_pointer) for name_pointer in bone_names]
+        self.joint_data = [joint[:10] + (strings.pointer(name_pointer),) + tuple(joint[11:])
+                           for joint, name_pointer in zip(self.joint_data, joint_names)]
+        texture_pointer_info = []
+        for (file_ptr, name_ptr), size, offset in zip(texture_names, self.textures_header[::2], self.textures_header[1::2]):
+            texture_pointer_info.extend((strings.pointer(file_ptr), strings.pointer(name_ptr), size, offset))
+        self.texture_pointer_info = texture_pointer_info
+        self.skeleton_name_pointer = strings.relocate(self.skeleton_name_pointer)
+        self.joint_list_name = strings.relocate(self.joint_list_name)
+        self.materials_bones_names_pointer = strings.relocate(self.materials_bones_names_pointer)
+        self.file_mesh_names_pointer = strings.base
+        self.string_data = bytes(strings.data) + b'\x00'*(string_region_size - len(strings.data))
+        self.strings = strings.table()
+
+        fields = self.pointer_fields()
+        if self.relocated_pointers is not None:
+            self.pointer_list = [field_position for field_position, kind in fields if kind in self.relocated_pointers]
+        elif fields != self.read_pointer_fields:
+            raise ValueError("The pointer list that was read does not match the pointer fields of the file, so it "
+                             "cannot be rebuilt for a file whose layout has changed.")
+        self.pointer_list_pointer = position - self.offset
+        self.pointer_list_size = self.offset + 4*len(self.pointer_list)
+        position += 4*len(self.pointer_list)
+
+        self.textures_pointer = align(position, TEXTURE_ALIGNMENT)
+        self.end_of_file_pointer = texture_offset
+        position = self.textures_pointer + texture_offset
+        self.contents_size = position - self.offset
+        return position
             
 class MeshReadWrite(BaseRW):
+    header_schema = RecordSchema((("name_pointer", "I"),
+                                  ("unknown_bytecount_1", "I"),
+                                  ("some_id", "I"),  # Material ID?
+                                  ("unknown_bytecount_2", "I"),
+                                  ("bytes_per_vertex", "I"),
+
+                                  ("vertex_count", "I"),
+                                  ("vertices_pointer", "I"),  # Meshes ptr - 64
+                                  ("triangle_count", "I"),
+                                  ("triangles_pointer", "I")), endianness='>')  # Triangles ptr - 64
+
     def __init__(self, bytestream):
         super().__init__(bytestream)
         self.name = None
         self.offset = 64
+        self.payload_loaded = False
+        self.raw_vertex_data = None
         
     def read(self):
-        self.read_write(self.read_buffer, self.read_ascii, self.cleanup_ragged_chunk_read)
-        self.interpret_data()
+        # 'interpret_data' is called by PXBIReadWriter once the string table has been read
+        self.read_write(self.read_buffer, self.read_raw, self.read_record, self.cleanup_ragged_chunk_read)
+        self.payload_loaded = True
+
+    def read_header(self):
+        self.rw_header(self.read_record)
+
+    def read_payload(self):
+        """
+        Reads and interprets the vertex and triangle data of a mesh for which only 'read_header' was called.
+        """
+        with Profiling.stage('read.mesh_payloads'):
+            self.bytestream.seek(self.vertices_pointer + self.offset)
+            self.rw_vertex_data(self.read_raw)
+            self.bytestream.seek(self.triangles_pointer + self.offset)
+            self.rw_triangles(self.read_raw)
+            self.payload_loaded = True
+        with Profiling.stage('interpret.mesh_payloads'):
+            self.interpret_payload()
     
-    def read_write(self, rw_operator, rw_ascii_operator, cleanup_chunk_operator):
-        self.rw_header(rw_operator, rw_ascii_operator)
-        self.rw_vertex_data(rw_operator)
-        self.rw_triangles(rw_operator)
+    def read_write(self, rw_operator, rw_operator_raw, rw_record_operator, cleanup_chunk_operator):
+        self.rw_header(rw_record_operator)
+        self.rw_vertex_data(rw_operator_raw)
+        self.rw_triangles(rw_operator_raw)
         cleanup_chunk_operator(self.bytestream.tell() + self.offset, 4)
         
-    def rw_header(self, rw_operator, rw_ascii_operator):
-        rw_operator("name_pointer", "I", endianness=">")
-        rw_operator("unknown_bytecount_1", "I", endianness=">")
-        rw_operator("some_id", "I", endianness=">")  # Material ID?
-        rw_operator("unknown_bytecount_2", "I", endianness=">")
-        rw_operator("bytes_per_vertex", "I", endianness=">")
-        
-        rw_operator("vertex_count", "I", endianness=">")
-        rw_operator("vertices_pointer", "I", endianness=">") # Meshes ptr - 64
-        rw_operator("triangle_count", "I", endianness=">")
-        rw_operator("triangles_pointer", "I", endianness=">") # Triangles ptr - 64
+    def rw_header(self, rw_record_operator):
+        rw_record_operator(self.header_schema)
         
-    def rw_vertex_data(self, rw_operator):
-        rw_operator("vertex_data", 'f'*(self.vertex_count*(self.bytes_per_vertex//4)), endianness='>')
+    def rw_vertex_data(self, rw_operator_raw):
+        # Kept as raw big-endian bytes here; 'interpret_data' splits them into columns in bulk
+        self.assert_fits_in_file("vertex_count", self.vertex_count, self.bytes_per_vertex)
+        rw_operator_raw("vertex_data", self.vertex_count*self.bytes_per_vertex)
         
-    def rw_triangles(self, rw_operator):
-        rw_operator("triangles", self.triangle_count*'H', endianness='>')
+    def rw_triangles(self, rw_operator_raw):
+        # 'triangle_count' is actually the number of indices
+        self.assert_fits_in_file("triangle_count", self.triangle_count, 2)
+        rw_operator_raw("triangles", self.triangle_count*2)
         
-    def interpret_data(self):
-        self.name = read_string_inplace(self.bytestream, self.name_pointer + self.offset)     
-        first_vertex = self.vertex_data[:self.bytes_per_vertex//4]
-        
-        assert self.bytes_per_vertex in [56, 72, 80, 88, 104], f"Unregonised vertex format: {self.bytes_per_vertex} bytes per vertex."
-        interpreted_vertex_data = []
-        
-        
-        if self.bytes_per_vertex == 56:
-            for chunk in chunks(self.vertex_data, self.bytes_per_vertex//4):
-                vertex = {}
-                vertex['Position'] = chunk[0:3]
-                vertex['Normal'] = chunk[3:6]
-                vertex['UV'] = chunk[12:14]
-                interpreted_vertex_data.append(vertex)
-                
-        if self.bytes_per_vertex == 72:
-            for chunk in chunks(self.vertex_data, self.bytes_per_vertex//4):
-                vertex = {}
-                vertex['Position'] = chunk[0:3]
-                vertex['Normal'] = chunk[3:6]
-                interpreted_vertex_data.append(vertex)
-                
-        elif self.bytes_per_vertex == 80:
-            for chunk in chunks(self.vertex_data, self.bytes_per_vertex//4):
-                vertex = {}
-                vertex['Position'] = chunk[0:3]
-                vertex['Normal'] = chunk[3:6]
-                vertex['UV'] = chunk[18:20]
-                #vertex['Tangent'] = chunk[8:11]
-                #vertex['Binormal'] = chunk[11:14]
-                #vertex['Weights'] = chunk[14:18]
-                #vertex['BoneIndices'] = chunk[18:22]
-                interpreted_vertex_data.append(vertex)
-        elif self.bytes_per_vertex == 88:
-            for chunk in chunks(self.vertex_data, self.bytes_per_vertex//4):
-                vertex = {}
-                vertex['Position'] = chunk[0:3]
-                vertex['Normal'] = chunk[3:6]
-                vertex['UV'] = chunk[6:8]
-                vertex['Tangent'] = chunk[8:11]
-                vertex['Binormal'] = chunk[11:14]
-                vertex['Weights'] = chunk[14:18]
-                vertex['BoneIndices'] = chunk[18:22]
-                interpreted_vertex_data.append(vertex)
-        elif self.bytes_per_vertex == 104:
-            for chunk in chunks(self.vertex_data, self.bytes_per_vertex//4):
-                vertex = {}
-                vertex['Position'] = chunk[0:3]
-                vertex['Normal'] = chunk[3:6]
-                vertex['UV'] = chunk[6:8]
-                vertex['Tangent'] = chunk[8:11]
-                vertex['Binormal'] = chunk[11:14]
-                vertex['Weights'] = chunk[14:18]
-                vertex['BoneIndices'] = chunk[18:22]
-                vertex['Color'] = chunk[22:26]
-                interpreted_vertex_data.append(vertex)
-        self.vertex_data = interpreted_vertex_data
-        self.triangles = list(chunks(self.triangles, 3))
+    def interpret_data(self, lookup_string):
+        self.name = lookup_string(self.name_pointer)
+        assert self.bytes_per_vertex in vertex_layouts, f"Unregonised vertex format: {self.bytes_per_vertex} bytes per vertex."
+        if self.payload_loaded:
+            self.interpret_payload()
+
+    def interpret_payload(self):
+        """
+        Replaces the raw vertex bytes with a dict of per-attribute columns, as laid out in VertexLayout.vertex_layouts, and
+        the raw triangle bytes with a flat array('H') of vertex indices, three per triangle.
+        """
+        self.raw_vertex_data = self.vertex_data
+        self.vertex_data = decode_vertex_columns(self.vertex_data, self.bytes_per_vertex, self.vertex_count)
+        self.triangles = decode_indices(self.triangles, self.triangle_count)
+        Profiling.count('vertices', self.vertex_count)
+        Profiling.count('triangles', self.triangle_count // 3)
         
     def reinterpret_data(self):
-        self.triangles = self.flatten_list(self.triangles)
-        vertex_data = []
-        for vertex in self.vertex_data:
-            vertex_data.extend(vertex['Position'])
-            vertex_data.extend(vertex['Normal'])
-            vertex_data.extend(vertex['UV'])
-            vertex_data.extend(vertex['Tangent'])
-            vertex_data.extend(vertex['Binormal'])
-            vertex_data.extend(vertex['Weights'])
-            vertex_data.extend(vertex['BoneIndices'])
+        """
+        The inverse of 'interpret_payload': encodes the vertex columns and triangle indices, and updates the vertex and
+        index counts to match them. The columns themselves are left as they are. If the payload was never loaded, the
+        raw bytes are read from the bytestream instead.
+
+        Returns
+        ------
+        The vertex data and the triangle indices as big-endian bytes.
+        """
+        if not self.payload_loaded:
+            self.bytestream.seek(self.vertices_pointer + self.offset)
+            vertex_data = bytes(self.bytestream.read(self.vertex_count*self.bytes_per_vertex))
+            self.bytestream.seek(self.triangles_pointer + self.offset)
+            return vertex_data, bytes(self.bytestream.read(self.triangle_count*2))
+
+        vertex_count = len(flatten_column(self.vertex_data['Position'])) // 3
+        # Components that are not decoded are carried over from the original data, as long as the vertices still match
+        base = self.raw_vertex_data if vertex_count == self.vertex_count else None
+        self.vertex_count = vertex_count
+        self.triangle_count = len(self.triangles)
+        return (encode_vertex_columns(self.vertex_data, self.bytes_per_vertex, self.vertex_count, base),
+                encode_indices(self.triangles))
+
+    def plan_layout(self, position):
+        """
+        Places the mesh at 'position', with the vertices and then the triangles straight after its header.
+
+        Returns
+        ------
+        The position after the mesh, padded to a multiple of 4 bytes.
+        """
+        self.vertices_pointer = position + self.header_schema.size - self.offset
+        self.triangles_pointer = self.vertices_pointer + self.vertex_count*self.bytes_per_vertex
+        return align(self.triangles_pointer + self.offset + self.triangle_count*2, 4)
+
+    def pack_into(self, buffer, position, vertex_data, triangles):
+        self.header_schema.pack_into(buffer, position, [getattr(self, name) for name in self.header_schema.names])
+        position = self.vertices_pointer + self.offset
+        buffer[position:position + len(vertex_data)] = vertex_data
+        position = self.triangles_pointer + self.offset
+        buffer[position:position + len(triangles)] = triangles
             
 class MaterialReadWrite(BaseRW):
+    schema = RecordSchema((("name_pointer", "I"),
+                           ("unknown_0x04", "I"),
+                           ("unknown_0x08", "I"),
+                           ("padding_0x0A", "I", 0),
+
+                           ("unknown_floats_1", "8f"),
+                           ("texture_count", "I"),
+                           ("texture_assignment_pointer", "I"),
+                           ("unknown_floats_2", "43f")), endianness='>')
+
     def __init__(self, bytestream):
         super().__init__(bytestream)
         self.offset = 64
@@ -335,23 +702,16 @@ class MaterialReadWrite(BaseRW):
 
     def prepare_read_operation(self):
         self.assigned_textures = [TextureReadWrite(self.bytestream) for _ in range(self.texture_count)]
+        for texture in self.assigned_textures:
+            texture.validation = self.validation
 
     def read(self):
-        self.read_write(self.read_buffer, self.prepare_read_operation, "read")
-        self.interpret_data()
+        # 'interpret_data' is called by PXBIReadWriter once the string table has been read
+        self.read_write(self.read_buffer, self.read_record, self.prepare_read_operation, "read")
 
-    def read_write(self, rw_operator, preparation_op, rw_method_name):
-        rw_operator("name_pointer", 'I', endianness='>')      
-        rw_operator("unknown_0x04", 'I', endianness='>')       
-        rw_operator("unknown_0x08", 'I', endianness='>')       
-        rw_operator("padding_0x0A", 'I', endianness='>') 
-        self.assert_is_zero("padding_0x0A")
-
-        rw_operator("unknown_floats_1", 'f'*8, endianness='>')   
-        rw_operator("texture_count", 'I', endianness='>')      
-        rw_operator("texture_assignment_pointer", 'I', endianness='>')     
-        rw_operator("unknown_floats_1", 'f'*43, endianness='>')
-        
+    def read_write(self, rw_operator, rw_record_operator, preparation_op, rw_method_name):
+        rw_record_operator(self.schema)
+        self.assert_fits_in_file("texture_count", self.texture_count, 4 + TextureReadWrite.schema.size)
         
         if self.texture_assignment_pointer:
             self.assert_file_pointer_now_at(self.texture_assignment_pointer + self.offset)  
@@ -362,8 +722,30 @@ class MaterialReadWrite(BaseRW):
             self.assert_file_pointer_now_at(ptr + self.offset)
             getattr(texture_reader, rw_method_name)()
             
-    def interpret_data(self):
-        self.name = read_string_inplace(self.bytestream, self.name_pointer + self.offset)
+    def interpret_data(self, lookup_string):
+        self.name = lookup_string(self.name_pointer)
+
+    def plan_layout(self, position):
+        """
+        Places the material at 'position', followed by the pointers to its texture assignments and the assignments.
+
+        Returns
+        ------
+        The position after the material.
+        """
+        self.texture_count = len(self.assigned_textures)
+        position += self.schema.size
+        self.texture_assignment_pointer = position - self.offset if self.texture_count else 0
+        position += 4*self.texture_count
+        self.texture_pointers = [position - self.offset + TextureReadWrite.schema.size*idx for idx in range(self.texture_count)]
+        return position + TextureReadWrite.schema.size*self.texture_count
+
+    def pack_into(self, buffer, position):
+        self.schema.pack_into(buffer, position, [getattr(self, name) for name in self.schema.names])
+        if self.texture_count:
+            pack_pointers(buffer, self.texture_assignment_pointer + self.offset, self.texture_pointers)
+        for ptr, texture in zip(self.texture_pointers, self.assigned_textures):
+            texture.pack_into(buffer, ptr + self.offset)
         
 texture_roles = {0: 'diffuse',
                  1: 'bumpmap',
@@ -374,27 +756,41 @@ texture_roles = {0: 'diffuse',
                  6: 'specular'} # ???
         
 class TextureReadWrite(BaseRW):
+    schema = RecordSchema((("padding_0x00", "I", 0),
+                           ("padding_0x04", "I", 0),
+                           ("role", "I"),
+                           ("tex_idx", "I")), endianness='>')
+
     def __init__(self, bytestream):
         super().__init__(bytestream)
         self.padding_0x00 = None
         self.padding_0x04 = None
         self.role = None
+        self.role_id = None
         self.tex_idx = None
         
     def read(self):
-        self.read_write(self.read_buffer)
+        self.read_write(self.read_record)
         self.interpret_data()
         
-    def read_write(self, rw_operator):
-        rw_operator("padding_0x00", "I", endianness='>')
-        rw_operator("padding_0x04", "I", endianness='>')
-        rw_operator("role", "I", endianness='>')
-        rw_operator("tex_idx", "I", endianness='>')
-        self.assert_is_zero("padding_0x00")
-        self.assert_is_zero("padding_0x04")
+    def read_write(self, rw_record_operator):
+        rw_record_operator(self.schema)
         
     def interpret_data(self):
+        # Several ids share a role name, so the id is kept for writing
+        self.role_id = self.role
         self.role = texture_roles[self.role]
+
+    def reinterpret_data(self):
+        """
+        Returns the role id to write, which is the id that was read unless the role has been changed since.
+        """
+        if texture_roles.get(self.role_id) == self.role:
+            return self.role_id
+        return next(role_id for role_id, role in texture_roles.items() if role == self.role)
+
+    def pack_into(self, buffer, position):
+        self.schema.pack_into(buffer, position, (self.padding_0x00, self.padding_0x04, self.reinterpret_data(), self.tex_idx))
         
 def read_string_inplace(bytestream, pos):
     orig_pos = bytestream.tell()
@@ -404,13 +800,109 @@ def read_string_inplace(bytestream, pos):
     return res
     
 
-def read_string(bytestream):
-    b = None
-    res = b''
-    while b != b'\x00':
-        b = bytestream.read(1)
-        res += b
-    return res[:-1].decode('ascii')
+def read_string(bytestream, chunksize=64):
+    start = bytestream.tell()
+    res = bytearray()
+    while True:
+        chunk = bytes(bytestream.read(chunksize))
+        end = chunk.find(b'\x00')
+        if end != -1 or not len(chunk):
+            res += chunk[:end] if end != -1 else chunk
+            break
+        res += chunk
+    bytestream.seek(start + len(res) + 1)
+    return res.decode('ascii')
+
+
+def build_string_table(data, base):
+    """
+    Splits a block of null-terminated strings into a dict mapping the pointer to each string to the decoded string.
+
+    Inputs
+    ------
+    data -- a bytes-like object holding consecutive null-terminated ASCII strings
+    base -- the pointer to the start of 'data'
+    """
+    table = {}
+    position = base
+    # The final item is either empty or unterminated, so is dropped
+    for string in bytes(data).split(b'\x00')[:-1]:
+        table[position] = string.decode('ascii')
+        position += len(string) + 1
+    return table
+
+
+class StringRegionPlanner:
+    """
+    Lays out the string region of a file that is being written. The region that was read is kept as it is, and any
+    strings that it does not hold are appended to it. Strings are located by their offset from the start of the region
+    until 'move_to' places the region in the file.
+
+    Inputs
+    ------
+    data -- the string region as read
+    base -- the pointer to the start of 'data' in the file that was read
+    strings -- a dict mapping pointers in the file that was read to the strings found there
+    """
+    def __init__(self, data, base, strings):
+        self.data = bytearray(bytes(data).rstrip(b'\x00'))
+        if len(self.data):
+            self.data += b'\x00'
+        self.old_base = base
+        self.old_size = len(self.data)
+        self.old_strings = strings
+        self.offsets = {}
+        for offset, string in build_string_table(self.data, 0).items():
+            self.offsets.setdefault(string, offset)
+        self.base = None
+
+    def locate(self, pointer, string):
+        """
+        Returns the offset of 'string' in the region, or None if 'pointer' is null and the string has not been set
+        since. The string stays where 'pointer' pointed to in the region that was read, if it is still there.
+        """
+        if pointer == 0 and string in ('', self.old_strings.get(0)):
+            return None
+        if self.old_base <= pointer < self.old_base + self.old_size and self.old_strings.get(pointer) == string:
+            return pointer - self.old_base
+        if string not in self.offsets:
+            self.offsets[string] = len(self.data)
+            self.data += string.encode('ascii') + b'\x00'
+        return self.offsets[string]
+
+    def move_to(self, base):
+        self.base = base
+
+    def pointer(self, offset):
+        return 0 if offset is None else self.base + offset
+
+    def relocate(self, pointer):
+        """
+        Moves a pointer into the region that was read to the same place in the new region. Other pointers are returned
+        as they are.
+        """
+        if self.old_base <= pointer < self.old_base + self.old_size:
+            return pointer - self.old_base + self.base
+        return pointer
+
+    def table(self):
+        """
+        Returns the string lookup table for the new region, including any strings that were looked up part-way through
+        the region that was read.
+        """
+        table = build_string_table(self.data, self.base)
+        for pointer, string in self.old_strings.items():
+            if self.old_base <= pointer < self.old_base + self.old_size:
+                table.setdefault(self.relocate(pointer), string)
+        return table
+
+
+def pack_pointers(buffer, position, pointers):
+    struct.pack_into(">" + "I"*len(pointers), buffer, position, *pointers)
+
+
+def align(position, alignment):
+    return (position + alignment - 1) // alignment * alignment
 
 
 def chunks(lst, n):
@@ -1,31 +1,291 @@
+import argparse
+import cProfile
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
+import Profiling
+from ArchiveSource import ArchiveMember, find_archive_members, is_archive
+from BaseRW import validation_levels
 from ColladaConvert import PXBItoCollada
+from ConversionManifest import ConversionManifest, hash_file
+from GLBConvert import PXBItoGLB
+from InputFiles import find_bin_files
+from PXBIInterface import source_name
+from TextureStore import link_modes
 
-if __name__ == "__main__":
-    if len(sys.argv) == 0:
-        print("Insufficient input parameters.")
-        print("Usage: ")
-        print("    PXBItoCollada.exe <folder>")
-        print("    PXBItoCollada.exe <file>")
-    else:
-        input_arg = sys.argv[1]
-        if os.path.isdir(input_arg):
-            for file in os.listdir(input_arg):
-                if os.path.splitext(file)[-1] != '.bin':
-                    continue
-                print(f"Converting {file}...")
-                filepath = os.path.join(input_arg, file)
-                output_dir = os.path.join("out", os.path.splitext(file)[0])
-                os.makedirs(output_dir, exist_ok=True)
-                try:
-                    PXBItoCollada(filepath, output_dir)
-                except Exception as e:
-                    print(f"Conversion failed with the following error: {e}")
-        elif os.path.isfile(input_arg):
-            output_dir = os.path.splitext(input_arg)[0]
-            os.makedirs(output_dir, exist_ok=True)
-            PXBItoCollada(input_arg, output_dir)
+converters = {'dae': PXBItoCollada,
+              'glb': PXBItoGLB}
+
+
+def archive_output_path(member_name):
+    """
+    Returns the output folder, relative to the output root, for a member of an archive. Absolute paths and '..' are
+    dropped, so that a member cannot be written outside the output root.
+    """
+    parts = [part for part in os.path.splitext(member_name)[0].split('/')
+             if part not in ('', '.', '..') and not part.endswith(':')]
+    return os.path.join(*parts) if len(parts) else "model"
+
+
+def convert_file(filepath, output_dir, output_format, options, validation='strict', profile=False, cprofile=False):
+    """
+    Converts a single file, given its path or an ArchiveMember. This runs in the worker processes, so must not raise,
+    and anything to be printed about the file is returned rather than printed, so that it can be reported in order.
+
+    'options' are passed on to the converter for 'output_format' as keyword arguments, along with 'validation', which
+    is kept apart since it does not change what is written. If 'profile' is set, the time
+    spent in each stage of the conversion is recorded (see Profiling.py); if 'cprofile' is also set, the conversion is
+    run under cProfile and the statistics are dumped next to the outputs as '<name>.prof'.
+
+    Returns
+    ------
+    A tuple of the formatted traceback if the conversion failed (otherwise None), the paths of the files written, the
+    SHA-256 of the input file, the profiling report as a dict (or None if 'profile' is not set), and a list of lines
+    to print about the file: the warnings issued, then the vertex cache report if the meshes were optimized.
+    """
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        error, written, sha256, report, notes = run_conversion(filepath, output_dir, output_format, options,
+                                                               validation, profile, cprofile)
+    return error, written, sha256, report, [f"Warning: {warning.message}" for warning in caught] + notes
+
+
+def run_conversion(filepath, output_dir, output_format, options, validation, profile, cprofile):
+    """
+    The body of 'convert_file', without the handling of warnings.
+    """
+    try:
+        if isinstance(filepath, ArchiveMember):
+            # Read once, for both the hash and the conversion
+            source = filepath.open()
+            sha256 = hashlib.sha256(source.getbuffer()).hexdigest()
+        else:
+            source = filepath
+            sha256 = hash_file(filepath)
+        os.makedirs(output_dir, exist_ok=True)
+
+        # The conversion is profiled even if no report was asked for, since the vertex cache report is read from the
+        # profile's counters
+        report = {"file": str(filepath), "format": output_format}
+        with Profiling.profiling(Profiling.Profile()) as file_profile:
+            start = time.perf_counter()
+            if profile and cprofile:
+                profiler = cProfile.Profile()
+                written = profiler.runcall(converters[output_format], source, output_dir, validation=validation,
+                                           **options)
+                report["cprofile"] = os.path.join(output_dir, os.path.splitext(source_name(source))[0] + '.prof')
+                profiler.dump_stats(report["cprofile"])
+            else:
+                written = converters[output_format](source, output_dir, validation=validation, **options)
+            report["seconds"] = time.perf_counter() - start
+        notes = cache_report(file_profile.counters)
+        if not profile:
+            return None, written, sha256, None, notes
+        file_profile.count('bytes_written', sum(os.path.getsize(path) for path in written))
+        report.update(file_profile.to_dict())
+    except Exception:
+        return traceback.format_exc(), [], None, None, []
+    return None, written, sha256, report, notes
+
+
+def cache_report(counters):
+    """
+    Returns a list holding the line reporting the vertex cache ACMR before and after the meshes were optimized, given
+    the counters of the conversion's profile, or an empty list if they were not optimized.
+    """
+    if 'optimized_triangles' not in counters:
+        return []
+    triangle_count = max(counters['optimized_triangles'], 1)
+    return [f"Vertex cache ACMR {counters['cache_misses_before'] / triangle_count:.3f} -> "
+            f"{counters['cache_misses_after'] / triangle_count:.3f}"]
+
+
+def convert_files(jobs, n_workers, output_format, options, manifest, validation='strict', profile_file=None,
+                  cprofile=False):
+    """
+    Converts each (filepath, output_dir) pair in 'jobs'. Conversions are started in the given order, and progress is
+    reported in that same order regardless of which worker finishes first. Each result is recorded in 'manifest'.
+
+    If 'profile_file' is given, each successful conversion is profiled and its report is written to it as a line of
+    JSON.
+
+    Returns
+    ------
+    A list of (filepath, traceback) tuples for the conversions that failed.
+    """
+    profile = profile_file is not None
+    if n_workers == 1:
+        results = (convert_file(*job, output_format, options, validation, profile, cprofile) for job in jobs)
+        return record_results(jobs, results, output_format, options, manifest, profile_file)
+
+    with ProcessPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(convert_file, *job, output_format, options, validation, profile, cprofile)
+                   for job in jobs]
+        return record_results(jobs, worker_results(futures), output_format, options, manifest, profile_file)
+
+
+def worker_results(futures):
+    """
+    Yields the result of each future in turn. If a worker process died rather than returning a result, as when it is
+    killed for running out of memory, the error is yielded as a failed conversion of that file, and every file still
+    queued on the broken pool fails the same way.
+    """
+    for future in futures:
+        try:
+            yield future.result()
+        except Exception:
+            yield traceback.format_exc(), [], None, None, []
+
+
+def record_results(jobs, results, output_format, options, manifest, profile_file):
+    """
+    Reports the result of each job of 'convert_files' and records it in 'manifest'.
+
+    Returns
+    ------
+    A list of (filepath, traceback) tuples for the conversions that failed.
+    """
+    failures = []
+    for i, ((filepath, _), (error, written, sha256, report, notes)) in enumerate(zip(jobs, results)):
+        if error is None:
+            print(f"[{i + 1}/{len(jobs)}] Converted {filepath}")
+            manifest.record(filepath, sha256, output_format, options, written)
+            if report is not None:
+                profile_file.write(json.dumps(report) + '\n')
+                profile_file.flush()
         else:
-            print(f"'{input_arg}' was not recognised as a file or directory.")
+            print(f"[{i + 1}/{len(jobs)}] FAILED {filepath}")
+            manifest.forget(filepath, output_format)
+            failures.append((filepath, error))
+        for note in notes:
+            print(f"    {note}")
+    return failures
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Convert PXBI (.bin) models to COLLADA or binary glTF.")
+    parser.add_argument("input", help="a .bin file, a folder to search recursively for .bin files, or a zip or tar "
+                                      "archive to convert the .bin files in")
+    parser.add_argument("--format", choices=sorted(converters), default='dae',
+                        help="output format: COLLADA (dae) or binary glTF (glb) (default: dae)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of files to convert in parallel; 0 uses every CPU (default: 1)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="only convert files whose name or relative path matches this pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="skip files whose name or relative path matches this pattern (repeatable)")
+    parser.add_argument("--minify", action="store_true",
+                        help="write the .dae files without indentation or newlines (dae only)")
+    parser.add_argument("--precision", type=int, metavar="DIGITS",
+                        help="significant digits for positions, normals, tangents, binormals and matrices "
+                             "(dae only; default: exact)")
+    parser.add_argument("--uv-precision", type=int, metavar="DIGITS",
+                        help="significant digits for UVs, vertex colours and skin weights (dae only; default: exact)")
+    parser.add_argument("--shared-indices", action="store_true",
+                        help="index every vertex attribute of a triangle with a single shared index, which makes the "
+                             "triangle lists several times smaller (dae only)")
+    parser.add_argument("--optimize-meshes", action="store_true",
+                        help="reorder the triangles and vertices of each mesh for the GPU's vertex cache, and print "
+                             "the average cache miss ratio (ACMR) before and after")
+    parser.add_argument("--texture-store", metavar="FOLDER",
+                        help="write each distinct texture once to this shared folder, rather than once per model")
+    parser.add_argument("--texture-link", choices=link_modes, default='relative',
+                        help="how models refer to textures in the --texture-store folder: by relative path, or through "
+                             "hardlinks or symlinks in their own texture folders (default: relative)")
+    parser.add_argument("--force", action="store_true",
+                        help="convert every input, even if its outputs are recorded as up to date")
+    parser.add_argument("--verify", action="store_true",
+                        help="re-hash every input and check every recorded output before deciding what to convert")
+    parser.add_argument("--validation", choices=validation_levels, default='strict',
+                        help="how thoroughly to check the input files: every assumption about their layout (strict), "
+                             "only that counts and pointers stay within the file (fast), or not at all (off) "
+                             "(default: strict)")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="append a line of JSON per converted file to this file, with the time spent in each stage "
+                             "of the conversion and counts of the bytes, vertices and triangles processed")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="with --profile, also run each conversion under cProfile and save the statistics next to "
+                             "its outputs as <name>.prof")
+    args = parser.parse_args(argv)
+
+    precision = {}
+    if args.precision is not None:
+        precision.update({key: args.precision for key in ('Position', 'Normal', 'Tangent', 'Binormal', 'Matrix')})
+    if args.uv_precision is not None:
+        precision.update({key: args.uv_precision for key in ('UV', 'Color', 'Weights')})
+    if args.format == 'dae':
+        options = {"minify": args.minify, "precision": precision, "shared_indices": args.shared_indices}
+    else:
+        options = {}
+    if args.optimize_meshes:
+        options["optimize_meshes"] = True
+    if args.texture_store is not None:
+        options.update({"texture_store": os.path.abspath(args.texture_store), "texture_link": args.texture_link})
+
+    input_arg = args.input
+    if os.path.isdir(input_arg):
+        found = find_bin_files(input_arg, args.include, args.exclude)
+        # Largest files first, so that the slowest conversions do not end up as a long tail on a single worker
+        found.sort(key=lambda item: (-item[2], item[1]))
+        output_root = "out"
+        jobs = [(filepath, os.path.join(output_root, os.path.splitext(relpath)[0])) for filepath, relpath, _ in found]
+    elif is_archive(input_arg):
+        found = find_archive_members(input_arg, args.include, args.exclude)
+        found.sort(key=lambda item: (-item[2], item[1]))
+        # Each archive gets its own folder, named with its extension, so that archives holding the same paths (such as
+        # a dump split across 'a.zip' and 'a.tar.gz') do not overwrite each other's outputs
+        output_root = os.path.join("out", os.path.basename(os.path.normpath(input_arg)))
+        jobs = [(member, os.path.join(output_root, archive_output_path(relpath))) for member, relpath, _ in found]
+    elif os.path.isfile(input_arg):
+        output_root = os.path.splitext(input_arg)[0]
+        jobs = [(input_arg, output_root)]
+    else:
+        print(f"'{input_arg}' was not recognised as a file, directory or archive.")
+        return 1
+
+    # Skip any input whose outputs are recorded as up to date
+    manifest = ConversionManifest(output_root)
+    if not args.force:
+        stale_jobs = []
+        for job in jobs:
+            reason = manifest.check(job[0], args.format, options, args.verify)
+            if reason is not None:
+                if args.verify:
+                    print(f"{job[0]}: {reason}")
+                stale_jobs.append(job)
+        if len(stale_jobs) != len(jobs):
+            print(f"Skipping {len(jobs) - len(stale_jobs)} up-to-date files.")
+        jobs = stale_jobs
+
+    n_workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    profile_file = None if args.profile is None else open(args.profile, 'a')
+    try:
+        failures = convert_files(jobs, min(n_workers, max(len(jobs), 1)), args.format, options, manifest,
+                                 args.validation, profile_file, args.cprofile)
+    finally:
+        manifest.save()
+        if profile_file is not None:
+            profile_file.close()
+
+    print(f"Converted {len(jobs) - len(failures)} of {len(jobs)} files.")
+    if len(failures):
+        print(f"{len(failures)} conversions failed:")
+        for filepath, error in failures:
+            print()
+            print(f"{filepath}:")
+            print(error)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # Required for the process pool in PyInstaller builds
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,120 @@
+import argparse
+import collections
+import sys
+import threading
+from contextlib import contextmanager
+
+# The ParseTrace that BaseRW reports every value it reads to, or None if tracing is disabled
+current = None
+
+
+def truncate_value(value, max_items=8):
+    """
+    Returns a short description of a value read from a file: at most 'max_items' values of a sequence, and at most
+    4 * 'max_items' bytes of raw data, along with the full length of anything that was cut short.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value[:4 * max_items])
+        description = data.hex()
+        if len(value) > len(data):
+            description += f"... ({len(value)} bytes)"
+        return description
+    if isinstance(value, (tuple, list)):
+        description = ", ".join(repr(item) for item in value[:max_items])
+        if len(value) > max_items:
+            description += f", ... ({len(value)} values)"
+        return f"({description})"
+    return repr(value)
+
+
+class ParseTrace:
+    """
+    Records the name, file offset, format and value of everything read by a BaseRW, while it is the 'current' trace.
+
+    Inputs
+    ------
+    filepath -- if given, each record is written to this file as a line of text as soon as it is made. Otherwise the
+                records are kept in 'entries'.
+    capacity -- the number of records kept in 'entries', after which the oldest are dropped, or None to keep every
+                record. Default: 10000.
+    max_items -- the number of values of an array, or four times the number of bytes of raw data, shown in each record
+    """
+    def __init__(self, filepath=None, capacity=10000, max_items=8):
+        self.max_items = max_items
+        self.entries = collections.deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.file = None if filepath is None else open(filepath, 'w')
+
+    def record(self, owner, name, offset, dtype, value):
+        if len(dtype) > 2 * self.max_items:
+            dtype = f"{dtype[:2 * self.max_items]}... ({len(dtype)} fields)"
+        entry = (offset, f"{owner}.{name}", dtype, truncate_value(value, self.max_items))
+        with self.lock:
+            if self.file is None:
+                self.entries.append(entry)
+            else:
+                self.file.write(format_entry(entry) + '\n')
+
+    def lines(self):
+        return [format_entry(entry) for entry in self.entries]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def format_entry(entry):
+    offset, name, dtype, value = entry
+    offset = "?" if offset is None else f"0x{offset:08X}"
+    return f"{offset:>10} {name:<48} {dtype:<16} {value}"
+
+
+@contextmanager
+def tracing(trace):
+    """
+    Makes 'trace' the current trace for the duration of the context.
+    """
+    global current
+    previous = current
+    current = trace
+    try:
+        yield trace
+    finally:
+        current = previous
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Print every value read from a PXBI (.bin) file, with its offset.")
+    parser.add_argument("input", help="the .bin file to read")
+    parser.add_argument("--output", metavar="FILE", help="write the trace to this file, rather than printing it")
+    parser.add_argument("--last", type=int, metavar="N", default=None,
+                        help="only print the last N values read; useful to see what was read just before an error")
+    parser.add_argument("--max-items", type=int, default=8,
+                        help="the number of values of each array to show (default: 8)")
+    args = parser.parse_args(argv)
+
+    # Imported here so that BaseRW can import this module. When this file is run as a script, it is not the module
+    # that BaseRW looks for the current trace in, so the trace is set through that module instead
+    import ParseTrace as trace_module
+    from PXBIInterface import PXBIInterface
+
+    trace = trace_module.ParseTrace(args.output, capacity=args.last, max_items=args.max_items)
+    error = None
+    try:
+        with trace_module.tracing(trace):
+            PXBIInterface.from_file(args.input)
+    except Exception as e:
+        error = e
+    finally:
+        trace.close()
+    for line in trace.lines():
+        print(line)
+    if error is not None:
+        print(f"Reading stopped with {type(error).__name__}: {error}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
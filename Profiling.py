@@ -0,0 +1,89 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# The Profile that 'stage' and 'count' record into, or None if profiling is disabled
+current = None
+
+
+class Profile:
+    """
+    Accumulates the time spent in each named stage and the totals of named counters, e.g. for the conversion of one
+    file. Stages may run on several threads at once, so their times can overlap.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+
+class TimedStage:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_stage = NullStage()
+
+
+def stage(name):
+    """
+    Returns a context manager that adds the time spent in its body to the stage 'name' of the current profile. When
+    profiling is disabled, a shared context manager that does nothing is returned.
+    """
+    if current is None:
+        return null_stage
+    return TimedStage(current, name)
+
+
+def count(name, amount=1):
+    """
+    Adds 'amount' to the counter 'name' of the current profile, if profiling is enabled.
+    """
+    if current is not None:
+        current.count(name, amount)
+
+
+@contextmanager
+def profiling(profile):
+    """
+    Makes 'profile' the current profile for the duration of the context.
+    """
+    global current
+    previous = current
+    current = profile
+    try:
+        yield profile
+    finally:
+        current = previous
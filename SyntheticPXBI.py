@@ -0,0 +1,306 @@
+import argparse
+import math
+import os
+import random
+import struct
+import sys
+
+from VertexLayout import vertex_layouts
+
+# All pointers in a PXBI file, other than those into the texture region, are relative to this offset
+POINTER_OFFSET = 64
+HEADER_SIZE = 0x8C
+
+# GTF format bytes, as understood by PXBIInterface.convert_gtf_to_dds
+gtf_codecs = {'DXT1': 0x86,
+              'DXT5': 0x88,
+              'A8R8G8B8': 0x85,
+              'DXT1_linear': 0xA6}
+
+# Mesh (bytes per vertex, vertex count, triangle count), bone count, texture (width, height, codec, mipmap count) and
+# material count of typical small, medium and large models, and of a model with one mesh as large as a mesh can be
+corpus_presets = {'small': {"meshes": ((56, 200, 300), (88, 500, 800)),
+                            "bone_count": 20,
+                            "textures": ((64, 64, 'DXT1', 3),),
+                            "material_count": 1},
+                  'medium': {"meshes": ((56, 400, 600), (80, 300, 400), (88, 3000, 5000), (104, 1500, 2500)),
+                             "bone_count": 80,
+                             "textures": ((256, 256, 'DXT1', 5), (256, 256, 'DXT5', 5), (64, 64, 'A8R8G8B8', 1)),
+                             "material_count": 3},
+                  'large': {"meshes": ((72, 1000, 1500), (88, 15000, 25000), (88, 10000, 16000), (104, 8000, 12000)),
+                            "bone_count": 150,
+                            "textures": ((512, 512, 'DXT1', 6), (512, 512, 'DXT5', 6), (256, 256, 'DXT5', 5),
+                                         (128, 128, 'A8R8G8B8', 1)),
+                            "material_count": 4},
+                  'huge': {"meshes": ((88, 65024, 129030),),
+                           "bone_count": 150,
+                           "textures": ((64, 64, 'DXT1', 3),),
+                           "material_count": 1}}
+
+
+def align(position, alignment):
+    return (position + alignment - 1) // alignment * alignment
+
+
+def texture_body_size(width, height, codec, mipmap_count):
+    size = 0
+    for _ in range(mipmap_count):
+        if codec in (gtf_codecs['DXT1'], gtf_codecs['DXT1_linear']):
+            size += max(1, width // 4) * max(1, height // 4) * 8
+        elif codec == gtf_codecs['DXT5']:
+            size += max(1, width // 4) * max(1, height // 4) * 16
+        else:
+            size += width * height * 4
+        width, height = max(1, width // 2), max(1, height // 2)
+    return size
+
+
+def generate_gtf(width, height, codec, mipmap_count, rng):
+    """
+    Returns a GTF file holding a single texture of random data, padded to a multiple of 128 bytes.
+    """
+    body = bytes(rng.getrandbits(8) for _ in range(texture_body_size(width, height, codec, mipmap_count)))
+    pitch = 0 if codec != gtf_codecs['A8R8G8B8'] else width * 4
+    header = struct.pack('>IIIIII', 0x01050000, len(body), 1, 0, 128, len(body))
+    header += struct.pack('>BBBBIHHHBBII', codec, mipmap_count, 2, 0, 0xAAE4, width, height, 1, 0, 0, pitch, 0)
+    header += b'\x00' * (128 - len(header))
+    return header + body + b'\x00' * (align(len(body), 128) - len(body))
+
+
+def generate_vertices(bytes_per_vertex, vertex_count, bone_count, rng):
+    """
+    Returns random vertex data for the given vertex layout. Normals, tangents and binormals are unit length, UVs and
+    colours lie within [0, 1], the skin weights of each vertex sum to 1, and bone indices are valid.
+    """
+    stride = bytes_per_vertex // 4
+    values = [rng.uniform(-1., 1.) for _ in range(vertex_count * stride)]
+    for name, offset, size in vertex_layouts[bytes_per_vertex]:
+        for vertex in range(vertex_count):
+            start = vertex * stride + offset
+            if name in ('Normal', 'Tangent', 'Binormal'):
+                length = math.sqrt(sum(value * value for value in values[start:start + size])) or 1.
+                values[start:start + size] = [value / length for value in values[start:start + size]]
+            elif name in ('UV', 'Color'):
+                values[start:start + size] = [rng.random() for _ in range(size)]
+            elif name == 'Weights':
+                weights = [rng.random() for _ in range(size)]
+                total = sum(weights)
+                values[start:start + size] = [weight / total for weight in weights]
+            elif name == 'BoneIndices':
+                values[start:start + size] = [float(rng.randrange(max(bone_count, 1))) for _ in range(size)]
+    return struct.pack(f'>{len(values)}f', *values)
+
+
+def bone_matrix(idx):
+    """
+    Returns a rigid transform, row-by-row with the translation in the final column, that differs for each bone.
+    """
+    angle = 0.1 * idx
+    c, s = math.cos(angle), math.sin(angle)
+    return [c, -s, 0., 0.1 * idx,
+            s, c, 0., 0.2,
+            0., 0., 1., -0.3 * idx,
+            0., 0., 0., 1.]
+
+
+def generate_pxbi(meshes=((88, 300, 400),), bone_count=10, joint_count=None, textures=((64, 64, 'DXT1', 3),),
+                  material_count=1, seed=0):
+    """
+    Generates a PXBI file of random data, laid out as PXBIReader expects.
+
+    Inputs
+    ------
+    meshes -- a (bytes per vertex, vertex count, triangle count) tuple for each mesh. The bytes per vertex must be a key
+              of VertexLayout.vertex_layouts.
+    bone_count -- the number of bones
+    joint_count -- the number of joints; at least 'bone_count', which is the default. Each bone uses the joint with the
+                   same index, and each joint has a random earlier joint as its parent.
+    textures -- a (width, height, codec, mipmap count) tuple for each texture. The codec is a key or value of
+                'gtf_codecs'.
+    material_count -- the number of materials. Each is assigned up to two of the textures, and the meshes use the
+                      materials in turn.
+    seed -- the seed for the random data
+
+    Returns
+    ------
+    The file as bytes.
+    """
+    joint_count = bone_count if joint_count is None else joint_count
+    assert joint_count >= bone_count, f"There must be at least as many joints as bones, not {joint_count} < {bone_count}."
+    for bytes_per_vertex, _, _ in meshes:
+        assert bytes_per_vertex in vertex_layouts, f"Unrecognised vertex format: {bytes_per_vertex} bytes per vertex."
+    rng = random.Random(seed)
+    textures = [(width, height, gtf_codecs.get(codec, codec), mipmap_count)
+                for width, height, codec, mipmap_count in textures]
+
+    # The pointer list holds the position of every pointer that is not null, relative to POINTER_OFFSET
+    pointer_positions = []
+
+    def add_pointers(position, count=1):
+        pointer_positions.extend(range(position - POINTER_OFFSET, position - POINTER_OFFSET + 4 * count, 4))
+
+    # Strings are written after the texture pointer info, so anything that points to one is fixed up once the position
+    # of the string region is known
+    strings = bytearray()
+    string_pointers = {}
+    string_fixups = []
+
+    def refer_to_string(position, string):
+        if string not in string_pointers:
+            string_pointers[string] = len(strings)
+            strings.extend(string.encode('ascii') + b'\x00')
+        string_fixups.append((position, string))
+        add_pointers(position)
+
+    data = bytearray(HEADER_SIZE)
+    # always_52, padding_pointer, texture_pointers_pointer, always_68, material_pointers_pointer, bone_pointers_pointer
+    # and mesh_pointers_pointer
+    for position in (0x44, 0x4C, 0x54, 0x74, 0x7C, 0x80, 0x88):
+        add_pointers(position)
+
+    # Meshes
+    mesh_pointers_pointer = len(data) - POINTER_OFFSET
+    add_pointers(len(data), len(meshes))
+    data += b'\x00' * (4 * len(meshes))
+    mesh_pointers = []
+    for idx, (bytes_per_vertex, vertex_count, triangle_count) in enumerate(meshes):
+        mesh_pointers.append(len(data) - POINTER_OFFSET)
+        refer_to_string(len(data), f"mesh_{idx}")
+        vertices_pointer = len(data) + 36 - POINTER_OFFSET
+        add_pointers(len(data) + 24)
+        add_pointers(len(data) + 32)
+        triangles_pointer = vertices_pointer + vertex_count * bytes_per_vertex
+        data += struct.pack('>9I', 0, 0, idx % max(material_count, 1), 0, bytes_per_vertex, vertex_count,
+                            vertices_pointer, triangle_count * 3, triangles_pointer)
+        data += generate_vertices(bytes_per_vertex, vertex_count, bone_count, rng)
+        data += struct.pack(f'>{triangle_count * 3}H', *(rng.randrange(vertex_count) for _ in range(triangle_count * 3)))
+        data += b'\x00' * (align(len(data), 4) - len(data))
+    struct.pack_into(f'>{len(meshes)}I', data, mesh_pointers_pointer + POINTER_OFFSET, *mesh_pointers)
+
+    # Materials
+    material_pointers_pointer = len(data) - POINTER_OFFSET
+    add_pointers(len(data), material_count)
+    data += b'\x00' * (4 * material_count)
+    material_pointers = []
+    for idx in range(material_count):
+        material_pointers.append(len(data) - POINTER_OFFSET)
+        refer_to_string(len(data), f"material_{idx}")
+        assigned_textures = min(2, len(textures))
+        assignment_pointer = len(data) + 228 - POINTER_OFFSET if assigned_textures else 0
+        if assigned_textures:
+            add_pointers(len(data) + 52)
+            add_pointers(len(data) + 228, assigned_textures)
+        data += struct.pack('>4I8f2I43f', 0, 1, 2, 0, *[1.] * 8, assigned_textures, assignment_pointer, *[0.5] * 43)
+        texture_pointers_position = len(data)
+        data += b'\x00' * (4 * assigned_textures)
+        texture_pointers = []
+        for role in range(assigned_textures):
+            texture_pointers.append(len(data) - POINTER_OFFSET)
+            data += struct.pack('>4I', 0, 0, role, (idx + role) % len(textures))
+        struct.pack_into(f'>{assigned_textures}I', data, texture_pointers_position, *texture_pointers)
+    struct.pack_into(f'>{material_count}I', data, material_pointers_pointer + POINTER_OFFSET, *material_pointers)
+
+    # Bones and joints
+    bone_pointers_pointer = len(data) - POINTER_OFFSET
+    refer_to_string(len(data), "skeleton")
+    bone_matrices_pointer = len(data) + 16 + 4 - POINTER_OFFSET if bone_count else 0
+    if bone_count:
+        add_pointers(len(data) + 8)
+    data += struct.pack('>4I', 0, bone_count, bone_matrices_pointer, joint_count)
+    for idx in range(bone_count):
+        refer_to_string(len(data), f"bone_{idx}")
+        data += struct.pack('>2I16f', 0, idx, *bone_matrix(idx))
+    refer_to_string(len(data), "joints")
+    data += struct.pack('>I', 0)
+    for idx in range(joint_count):
+        refer_to_string(len(data) + 20, f"joint_{idx}")
+        parent = rng.randrange(idx) if idx else -1
+        data += struct.pack('>10h2I9f', 0, 0, 0, parent, 0, 0, 0, 0, 0, 0, 0, 0, *[0.] * 9)
+
+    # Texture pointers
+    padding_pointer = len(data) - POINTER_OFFSET
+    data += struct.pack('>2I', 0, 0)
+    texture_pointers_pointer = len(data) - POINTER_OFFSET
+    texture_info_position = len(data) + 4 * len(textures)
+    add_pointers(len(data), len(textures))
+    data += b'\x00' * (20 * len(textures))
+    gtfs = [generate_gtf(*texture, rng) for texture in textures]
+    texture_offsets = []
+    offset = 4 + 8 * len(textures)
+    for gtf in gtfs:
+        texture_offsets.append(offset)
+        offset += len(gtf)
+    for idx, gtf in enumerate(gtfs):
+        position = texture_info_position + 16 * idx
+        struct.pack_into('>I', data, texture_pointers_pointer + POINTER_OFFSET + 4 * idx, position - POINTER_OFFSET)
+        struct.pack_into('>2I', data, position + 8, len(gtf), texture_offsets[idx])
+        refer_to_string(position, f"file_{idx}")
+        refer_to_string(position + 4, f"./textures/tex_{idx}.dds")
+
+    # Strings
+    strings_pointer = len(data) - POINTER_OFFSET
+    for position, string in string_fixups:
+        struct.pack_into('>I', data, position, strings_pointer + string_pointers[string])
+    data += strings
+    data += b'\x00' * (align(len(data), 4) - len(data))
+
+    # Pointer list
+    pointer_list_pointer = len(data) - POINTER_OFFSET
+    pointer_list = sorted(pointer_positions)
+    data += struct.pack(f'>{len(pointer_list)}I', *pointer_list)
+    pointer_list_size = POINTER_OFFSET + 4 * len(pointer_list)
+
+    # Textures; unlike everything else, these are positioned relative to the start of the texture region
+    textures_pointer = align(len(data), 128)
+    data += b'\x00' * (textures_pointer - len(data))
+    data += struct.pack('>I', len(gtfs))
+    for offset, gtf in zip(texture_offsets, gtfs):
+        data += struct.pack('>2I', len(gtf), offset)
+    for gtf in gtfs:
+        data += gtf
+    end_of_file_pointer = len(data) - textures_pointer
+
+    struct.pack_into('>4sII4s', data, 0x00, b'PXBI', len(data) - POINTER_OFFSET, 1, b'PXBI')
+    struct.pack_into('>8I', data, 0x10, POINTER_OFFSET, strings_pointer, strings_pointer, 0,
+                     pointer_list_pointer, pointer_list_size, textures_pointer, end_of_file_pointer)
+    struct.pack_into('>8I', data, 0x40, 3, 52, 0, padding_pointer, len(textures), texture_pointers_pointer, 0, 0)
+    struct.pack_into('>7I', data, 0x70, 0, 68, material_count, material_pointers_pointer,
+                     bone_pointers_pointer, len(meshes), mesh_pointers_pointer)
+    return bytes(data)
+
+
+def generate_corpus(directory, count, preset='medium', seed=0):
+    """
+    Writes 'count' synthetic PXBI files built from one of the 'corpus_presets' to 'directory'. Each file uses a
+    different seed, derived from 'seed'.
+
+    Returns
+    ------
+    A list of the paths of the files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    filepaths = []
+    for idx in range(count):
+        filepath = os.path.join(directory, f"chr{idx:03d}_{preset}.bin")
+        with open(filepath, 'wb') as F:
+            F.write(generate_pxbi(**corpus_presets[preset], seed=seed + idx))
+        filepaths.append(filepath)
+    return filepaths
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Write synthetic PXBI (.bin) files of random data.")
+    parser.add_argument("output", help="the folder to write the files to")
+    parser.add_argument("-n", "--count", type=int, default=10, help="the number of files to write (default: 10)")
+    parser.add_argument("--preset", choices=sorted(corpus_presets), default='medium',
+                        help="the size of the models (default: medium)")
+    parser.add_argument("--seed", type=int, default=0, help="the seed for the random data (default: 0)")
+    args = parser.parse_args(argv)
+
+    filepaths = generate_corpus(args.output, args.count, args.preset, args.seed)
+    print(f"Wrote {len(filepaths)} files to {args.output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
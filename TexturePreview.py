@@ -0,0 +1,437 @@
+import argparse
+import os
+import struct
+import sys
+import time
+import traceback
+import warnings
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from GTFReader import SwizzleWarning, read_gtf
+from InputFiles import find_bin_files
+from PXBIInterface import PXBIInterface
+from TextureStore import write_atomically
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+PREVIEW_DIRECTORY = "previews"
+
+
+###########
+# MIPMAPS #
+###########
+def select_mipmap_level(texture, max_size):
+    """
+    Returns the index of the largest mipmap level of a GTFTextureReadWrite whose width and height are both at most
+    'max_size', or of the smallest level if none are. A 'max_size' of None selects the largest level.
+    """
+    levels = max(texture.mipmap_count, 1)
+    if max_size is None:
+        return 0
+    for level in range(levels):
+        if max(texture.width >> level, texture.height >> level, 1) <= max_size:
+            return level
+    return levels - 1
+
+
+def decode_gtf(gtf_data, level=0):
+    """
+    Decodes one mipmap level of the first texture of a GTF file (the first face of a cube map) to 8-bit RGBA.
+
+    Inputs
+    ------
+    gtf_data -- a bytes-like object holding the GTF file
+    level -- the mipmap level to decode, where 0 is the largest. Smaller levels are cheaper to decode.
+
+    Returns
+    ------
+    The width and height of the level, and its texels as RGBA bytes, row-by-row from the top.
+
+    Raises
+    ------
+    GTFReader.SwizzleWarning, as an error, if the texture is swizzled and cannot be unswizzled.
+    """
+    texture = read_gtf(gtf_data).textures[0]
+    surface = texture.surfaces()[level]
+    _, _, width, height, _, _ = surface
+    with warnings.catch_warnings():
+        # A preview of texels left in their swizzled order would only be noise, so fail instead
+        warnings.simplefilter('error', SwizzleWarning)
+        texels = texture.read_surface(gtf_data, surface)
+    return width, height, texel_decoders[texture.format_name](texels, width, height)
+
+
+#####################
+# BLOCK COMPRESSION #
+#####################
+def decode_dxt1(data, width, height):
+    return decode_blocks(data, width, height, 'DXT1')
+
+
+def decode_dxt3(data, width, height):
+    return decode_blocks(data, width, height, 'DXT3')
+
+
+def decode_dxt5(data, width, height):
+    return decode_blocks(data, width, height, 'DXT5')
+
+
+def decode_blocks(data, width, height, format_name):
+    """
+    Decodes DXT1, DXT3 or DXT5 blocks covering a 'width' by 'height' image to RGBA bytes. With NumPy, every block is
+    decoded at once; without it, block by block.
+    """
+    if np is not None:
+        return decode_blocks_numpy(data, width, height, format_name)
+    return decode_blocks_python(data, width, height, format_name)
+
+
+def decode_blocks_numpy(data, width, height, format_name):
+    blocks_wide = (width + 3) // 4
+    blocks_high = (height + 3) // 4
+    block_bytes = 8 if format_name == 'DXT1' else 16
+    blocks = np.frombuffer(data, dtype=np.uint8, count=blocks_wide * blocks_high * block_bytes)
+    blocks = blocks.reshape(-1, block_bytes)
+
+    texels = decode_colour_blocks(blocks[:, -8:], format_name == 'DXT1')
+    if format_name == 'DXT3':
+        texels[:, :, 3] = decode_explicit_alpha_blocks(blocks[:, :8])
+    elif format_name == 'DXT5':
+        texels[:, :, 3] = decode_interpolated_alpha_blocks(blocks[:, :8])
+
+    # (block row, block column, texel row, texel column, channel) -> (row, column, channel)
+    image = texels.reshape(blocks_high, blocks_wide, 4, 4, 4).transpose(0, 2, 1, 3, 4)
+    image = image.reshape(blocks_high * 4, blocks_wide * 4, 4)[:height, :width]
+    return image.tobytes()
+
+
+# The shifts that move each texel's index, in row-by-row order, to the bottom of a block's index bits
+colour_index_shifts = tuple(range(0, 32, 2))
+explicit_alpha_shifts = tuple(range(0, 64, 4))
+interpolated_alpha_shifts = tuple(range(0, 48, 3))
+
+
+def little_endian_integers(columns):
+    """
+    Combines a (block count, byte count) array of bytes into one little-endian integer per block.
+    """
+    result = np.zeros(len(columns), dtype=np.uint64)
+    for idx in range(columns.shape[1]):
+        result |= columns[:, idx].astype(np.uint64) << np.uint64(8 * idx)
+    return result
+
+
+def expand_565(colours):
+    red = (colours >> 11) & 0x1F
+    green = (colours >> 5) & 0x3F
+    blue = colours & 0x1F
+    return np.stack([(red << 3) | (red >> 2), (green << 2) | (green >> 4), (blue << 3) | (blue >> 2)], axis=-1)
+
+
+def decode_colour_blocks(blocks, allow_transparency):
+    """
+    Decodes the 8-byte colour part of every block to a (block count, 16, 4) array of RGBA texels. DXT1 blocks whose
+    first colour is not greater than their second have three colours and transparent black, if 'allow_transparency'
+    is set; DXT3 and DXT5 blocks always have four colours.
+    """
+    first = little_endian_integers(blocks[:, 0:2]).astype(np.int32)
+    second = little_endian_integers(blocks[:, 2:4]).astype(np.int32)
+    rgb_0 = expand_565(first)
+    rgb_1 = expand_565(second)
+    four_colours = first > second if allow_transparency else np.ones(len(blocks), dtype=bool)
+    four_colours_rgb = four_colours[:, None]
+
+    palette = np.full((len(blocks), 4, 4), 255, dtype=np.int32)
+    palette[:, 0, :3] = rgb_0
+    palette[:, 1, :3] = rgb_1
+    palette[:, 2, :3] = np.where(four_colours_rgb, (2 * rgb_0 + rgb_1) // 3, (rgb_0 + rgb_1) // 2)
+    palette[:, 3, :3] = np.where(four_colours_rgb, (rgb_0 + 2 * rgb_1) // 3, 0)
+    palette[:, 3, 3] = np.where(four_colours, 255, 0)
+
+    bits = little_endian_integers(blocks[:, 4:8])
+    indices = (bits[:, None] >> np.array(colour_index_shifts, dtype=np.uint64)) & np.uint64(3)
+    return palette.astype(np.uint8)[np.arange(len(blocks))[:, None], indices.astype(np.intp)]
+
+
+def decode_explicit_alpha_blocks(blocks):
+    bits = little_endian_integers(blocks)
+    alphas = (bits[:, None] >> np.array(explicit_alpha_shifts, dtype=np.uint64)) & np.uint64(0xF)
+    return (alphas * np.uint64(17)).astype(np.uint8)
+
+
+def decode_interpolated_alpha_blocks(blocks):
+    first = blocks[:, 0].astype(np.int32)[:, None]
+    second = blocks[:, 1].astype(np.int32)[:, None]
+    weights = np.arange(1, 7, dtype=np.int32)[None, :]
+    eight_alphas = ((7 - weights) * first + weights * second) // 7
+    six_alphas = ((5 - weights[:, :4]) * first + weights[:, :4] * second) // 5
+    six_alphas = np.hstack([six_alphas, np.zeros_like(first), np.full_like(first, 255)])
+
+    palette = np.empty((len(blocks), 8), dtype=np.int32)
+    palette[:, :1] = first
+    palette[:, 1:2] = second
+    palette[:, 2:] = np.where(first > second, eight_alphas, six_alphas)
+
+    bits = little_endian_integers(blocks[:, 2:8])
+    indices = (bits[:, None] >> np.array(interpolated_alpha_shifts, dtype=np.uint64)) & np.uint64(7)
+    return palette.astype(np.uint8)[np.arange(len(blocks))[:, None], indices.astype(np.intp)]
+
+
+def expand_565_python(colour):
+    red, green, blue = (colour >> 11) & 0x1F, (colour >> 5) & 0x3F, colour & 0x1F
+    return (red << 3) | (red >> 2), (green << 2) | (green >> 4), (blue << 3) | (blue >> 2)
+
+
+def decode_blocks_python(data, width, height, format_name):
+    blocks_wide = (width + 3) // 4
+    blocks_high = (height + 3) // 4
+    block_bytes = 8 if format_name == 'DXT1' else 16
+    row_bytes = blocks_wide * 16
+    image = bytearray(row_bytes * blocks_high * 4)
+    for block in range(blocks_wide * blocks_high):
+        position = block * block_bytes
+        first, second, bits = struct.unpack_from('<HHI', data, position + block_bytes - 8)
+        rgb_0 = expand_565_python(first)
+        rgb_1 = expand_565_python(second)
+        if first > second or format_name != 'DXT1':
+            palette = (rgb_0 + (255,), rgb_1 + (255,),
+                       tuple((2 * a + b) // 3 for a, b in zip(rgb_0, rgb_1)) + (255,),
+                       tuple((a + 2 * b) // 3 for a, b in zip(rgb_0, rgb_1)) + (255,))
+        else:
+            palette = (rgb_0 + (255,), rgb_1 + (255,),
+                       tuple((a + b) // 2 for a, b in zip(rgb_0, rgb_1)) + (255,), (0, 0, 0, 0))
+        texels = bytearray(b''.join(bytes(palette[(bits >> shift) & 3]) for shift in colour_index_shifts))
+        if format_name == 'DXT3':
+            alpha_bits, = struct.unpack_from('<Q', data, position)
+            texels[3::4] = bytes(((alpha_bits >> shift) & 0xF) * 17 for shift in explicit_alpha_shifts)
+        elif format_name == 'DXT5':
+            alpha_0, alpha_1 = data[position], data[position + 1]
+            if alpha_0 > alpha_1:
+                alphas = [alpha_0, alpha_1] + [((7 - i) * alpha_0 + i * alpha_1) // 7 for i in range(1, 7)]
+            else:
+                alphas = [alpha_0, alpha_1] + [((5 - i) * alpha_0 + i * alpha_1) // 5 for i in range(1, 5)] + [0, 255]
+            alpha_bits = int.from_bytes(bytes(data[position + 2:position + 8]), 'little')
+            texels[3::4] = bytes(alphas[(alpha_bits >> shift) & 7] for shift in interpolated_alpha_shifts)
+
+        block_row, block_column = divmod(block, blocks_wide)
+        start = block_row * 4 * row_bytes + block_column * 16
+        for row in range(4):
+            image[start + row * row_bytes:start + row * row_bytes + 16] = texels[row * 16:row * 16 + 16]
+
+    if blocks_wide * 4 == width and blocks_high * 4 == height:
+        return bytes(image)
+    return b''.join(image[row * row_bytes:row * row_bytes + width * 4] for row in range(height))
+
+
+################
+# UNCOMPRESSED #
+################
+def decode_a8r8g8b8(data, width, height):
+    # GTFTextureReadWrite.read_surface has already made the texels little-endian, i.e. BGRA
+    rgba = bytearray(data)
+    rgba[0::4] = data[2::4]
+    rgba[2::4] = data[0::4]
+    return bytes(rgba)
+
+
+def decode_b8(data, width, height):
+    rgba = bytearray(b'\xFF' * (width * height * 4))
+    for channel in range(3):
+        rgba[channel::4] = data
+    return bytes(rgba)
+
+
+# The (shift, bit count) of the red, green, blue and alpha channels of each 16-bit format, or None for a channel the
+# format does not store
+packed_16_channels = {'A1R5G5B5': ((10, 5), (5, 5), (0, 5), (15, 1)),
+                      'A4R4G4B4': ((8, 4), (4, 4), (0, 4), (12, 4)),
+                      'R5G6B5': ((11, 5), (5, 6), (0, 5), None)}
+
+
+def channel_expansion(bits):
+    """
+    Returns the 8-bit value of each value of a 'bits'-bit channel, so that 0 maps to 0 and the largest to 255.
+    """
+    largest = (1 << bits) - 1
+    return bytes((value * 255 + largest // 2) // largest for value in range(largest + 1))
+
+
+def decode_packed_16(data, width, height, format_name):
+    """
+    Decodes 16-bit texels, which GTFTextureReadWrite.read_surface has already made little-endian, to RGBA bytes.
+    Channels the format does not store are opaque.
+    """
+    count = width * height
+    rgba = bytearray(b'\xFF' * (count * 4))
+    if np is not None:
+        texels = np.frombuffer(data, dtype='<u2', count=count)
+    else:
+        texels = array('H', bytes(data[:count * 2]))
+        if sys.byteorder == 'big':
+            texels.byteswap()
+    for channel, field in enumerate(packed_16_channels[format_name]):
+        if field is None:
+            continue
+        shift, bits = field
+        expansion = channel_expansion(bits)
+        mask = (1 << bits) - 1
+        if np is not None:
+            rgba[channel::4] = np.frombuffer(expansion, dtype=np.uint8)[(texels >> shift) & mask].tobytes()
+        else:
+            rgba[channel::4] = bytes([expansion[texel >> shift & mask] for texel in texels])
+    return bytes(rgba)
+
+
+def decode_a1r5g5b5(data, width, height):
+    return decode_packed_16(data, width, height, 'A1R5G5B5')
+
+
+def decode_a4r4g4b4(data, width, height):
+    return decode_packed_16(data, width, height, 'A4R4G4B4')
+
+
+def decode_r5g6b5(data, width, height):
+    return decode_packed_16(data, width, height, 'R5G6B5')
+
+
+# Maps the format names in GTFReader.texture_formats to functions that decode texels of that format to RGBA bytes
+texel_decoders = {'DXT1': decode_dxt1,
+                  'DXT3': decode_dxt3,
+                  'DXT5': decode_dxt5,
+                  'A8R8G8B8': decode_a8r8g8b8,
+                  'A1R5G5B5': decode_a1r5g5b5,
+                  'A4R4G4B4': decode_a4r4g4b4,
+                  'R5G6B5': decode_r5g6b5,
+                  'B8': decode_b8}
+
+
+#######
+# PNG #
+#######
+def png_chunk(chunk_type, data):
+    return b''.join([struct.pack('>I', len(data)), chunk_type, data,
+                     struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)))])
+
+
+def encode_png(width, height, rgba, compression=6):
+    """
+    Encodes RGBA bytes, row-by-row from the top, as an 8-bit RGBA PNG file.
+    """
+    stride = width * 4
+    # Each row is preceded by its filter type, which is always 0 (none)
+    scanlines = b''.join(b'\x00' + rgba[row * stride:(row + 1) * stride] for row in range(height))
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+                     png_chunk(b'IDAT', zlib.compress(scanlines, compression)),
+                     png_chunk(b'IEND', b'')])
+
+
+############
+# PREVIEWS #
+############
+def write_previews(filepath, output_directory, max_size=None, level=None):
+    """
+    Writes a PNG preview of every texture of a PXBI file to 'output_directory', at the path the converter would write
+    its DDS file to. Only the headers of the file and the textures are read.
+
+    Inputs
+    ------
+    filepath -- the path of the PXBI file
+    output_directory -- the folder to write the previews to
+    max_size -- the largest width or height a preview may have; the largest mipmap level that fits is used. Default:
+                the largest level.
+    level -- if given, this mipmap level is used instead, or the smallest level if the texture has fewer
+
+    Returns
+    ------
+    The file path, the number of previews written, and a list of (texture name, error) tuples for the textures that
+    could not be decoded.
+    """
+    pi = PXBIInterface.from_file(filepath, sections=('textures',), lazy=True)
+    written = 0
+    failures = []
+    for idx, (_, texture_name) in enumerate(pi.texture_names):
+        try:
+            gtf_data = pi.texture_data_raw[idx]
+            texture = read_gtf(gtf_data).textures[0]
+            if level is None:
+                chosen_level = select_mipmap_level(texture, max_size)
+            else:
+                chosen_level = min(level, max(texture.mipmap_count, 1) - 1)
+            width, height, rgba = decode_gtf(gtf_data, chosen_level)
+            png_filepath = os.path.splitext(os.path.normpath(os.path.join(output_directory, texture_name[2:])))[0]
+            png_filepath += '.png'
+            os.makedirs(os.path.split(png_filepath)[0], exist_ok=True)
+            write_atomically(png_filepath, encode_png(width, height, rgba))
+            written += 1
+        except Exception as e:
+            failures.append((texture_name, f"{type(e).__name__}: {e}"))
+    return filepath, written, failures
+
+
+def write_previews_job(job):
+    filepath, output_directory, max_size, level = job
+    try:
+        return write_previews(filepath, output_directory, max_size, level)
+    except Exception:
+        return filepath, 0, [(None, traceback.format_exc())]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Write PNG previews of the textures of PXBI (.bin) files.")
+    parser.add_argument("input", help="a .bin file, or a folder to search recursively for .bin files")
+    parser.add_argument("--output", default=PREVIEW_DIRECTORY,
+                        help=f"the folder to write the previews to (default: {PREVIEW_DIRECTORY})")
+    parser.add_argument("--max-size", type=int, default=128,
+                        help="use the largest mipmap level no wider or taller than this, so that small previews are "
+                             "quick to make; 0 uses the full-size texture (default: 128)")
+    parser.add_argument("--level", type=int, default=None,
+                        help="use this mipmap level, where 0 is the full-size texture, instead of --max-size")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of files to process in parallel; 0 uses every CPU (default: 1)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="only process files whose name or relative path matches this pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="skip files whose name or relative path matches this pattern (repeatable)")
+    args = parser.parse_args(argv)
+
+    max_size = args.max_size if args.max_size > 0 else None
+    if os.path.isdir(args.input):
+        jobs = [(filepath, os.path.join(args.output, os.path.splitext(relpath)[0]), max_size, args.level)
+                for filepath, relpath, _ in find_bin_files(args.input, args.include, args.exclude)]
+    elif os.path.isfile(args.input):
+        jobs = [(args.input, os.path.join(args.output, os.path.splitext(os.path.split(args.input)[-1])[0]),
+                 max_size, args.level)]
+    else:
+        print(f"'{args.input}' was not recognised as a file or directory.")
+        return 1
+
+    start = time.perf_counter()
+    n_workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    if n_workers == 1 or len(jobs) < 2:
+        results = list(map(write_previews_job, jobs))
+    else:
+        with ProcessPoolExecutor(n_workers) as executor:
+            results = list(executor.map(write_previews_job, jobs, chunksize=4))
+
+    written = sum(count for _, count, _ in results)
+    failures = [(filepath, name, error) for filepath, _, errors in results for name, error in errors]
+    print(f"Wrote {written} previews from {len(jobs)} files in {time.perf_counter() - start:.2f} s.")
+    if len(failures):
+        print(f"{len(failures)} textures or files could not be previewed:")
+        for filepath, name, error in failures:
+            print()
+            print(f"{filepath}" + ("" if name is None else f" ({name})") + ":")
+            print(error)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import shutil
+import threading
+
+from PXBIInterface import convert_gtf_to_dds
+
+link_modes = ('relative', 'hardlink', 'symlink')
+
+
+def temporary_path(filepath):
+    # Unique to this process and thread, so that concurrent writers of the same file never share a temporary file
+    return f"{filepath}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def write_atomically(filepath, data):
+    """
+    Writes 'data' to a temporary file next to 'filepath' and then moves it into place, so that other processes never
+    see a partially-written file.
+    """
+    temp_path = temporary_path(filepath)
+    try:
+        with open(temp_path, 'wb') as F:
+            F.write(data)
+        os.replace(temp_path, filepath)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def link_file(source, destination, link_mode):
+    """
+    Creates a hardlink or symlink to 'source' at 'destination', replacing anything already there. Falls back to a copy
+    if the link cannot be made, e.g. for a hardlink across drives or a symlink without the required privileges.
+    """
+    temp_path = temporary_path(destination)
+    try:
+        if link_mode == 'hardlink':
+            os.link(source, temp_path)
+        else:
+            os.symlink(os.path.relpath(source, os.path.split(destination)[0]), temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+class TextureStore:
+    """
+    A folder of textures shared between models, in which each texture is stored once under the SHA-256 of its raw GTF
+    data, as both '<hash>.gtf' and '<hash>.dds'. Textures are spread across sub-folders named after the first two
+    characters of their hash.
+
+    'link_mode' determines how a model refers to the stored files:
+    'relative' -- the model references the stored .dds directly by its path relative to the model
+    'hardlink' -- hardlinks to the stored files are made at the model's usual texture paths
+    'symlink'  -- as 'hardlink', but with symlinks
+
+    Files are only ever added to the store by moving a complete file into place, so the same store may be used by
+    several processes and threads at once.
+    """
+    def __init__(self, root, link_mode='relative'):
+        assert link_mode in link_modes, f"Unknown texture link mode '{link_mode}'."
+        self.root = root
+        self.link_mode = link_mode
+        self.known_hashes = set()
+
+    @staticmethod
+    def hash(gtf_data):
+        return hashlib.sha256(gtf_data).hexdigest()
+
+    def stored_paths(self, digest):
+        """
+        Returns the paths of the .gtf and .dds files stored for the texture with the hash 'digest'.
+        """
+        directory = os.path.join(self.root, digest[:2])
+        return os.path.join(directory, digest + '.gtf'), os.path.join(directory, digest + '.dds')
+
+    def store(self, gtf_data, digest=None):
+        """
+        Adds a texture to the store, unless it is already present. 'digest' may be given if the hash of 'gtf_data' is
+        already known.
+
+        Returns
+        ------
+        The paths of the stored .gtf and .dds files.
+        """
+        digest = self.hash(gtf_data) if digest is None else digest
+        gtf_filepath, dds_filepath = self.stored_paths(digest)
+        if digest not in self.known_hashes:
+            if not (os.path.isfile(gtf_filepath) and os.path.isfile(dds_filepath)):
+                os.makedirs(os.path.split(gtf_filepath)[0], exist_ok=True)
+                write_atomically(gtf_filepath, gtf_data)
+                write_atomically(dds_filepath, convert_gtf_to_dds(gtf_data))
+            self.known_hashes.add(digest)
+        return gtf_filepath, dds_filepath
+
+    def place(self, gtf_data, gtf_filepath, dds_filepath, digest=None):
+        """
+        Adds a texture to the store and makes it available to a model that would otherwise write it to 'gtf_filepath'
+        and 'dds_filepath'. In the 'hardlink' and 'symlink' modes, the folders of those paths must already exist.
+
+        Returns
+        ------
+        The path of the .dds file the model should reference, and a list of the paths the model depends on.
+        """
+        stored_gtf_filepath, stored_dds_filepath = self.store(gtf_data, digest)
+        if self.link_mode == 'relative':
+            return stored_dds_filepath, [stored_gtf_filepath, stored_dds_filepath]
+
+        link_file(stored_gtf_filepath, gtf_filepath, self.link_mode)
+        link_file(stored_dds_filepath, dds_filepath, self.link_mode)
+        return dds_filepath, [gtf_filepath, dds_filepath]
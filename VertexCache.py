@@ -0,0 +1,229 @@
+import operator
+from array import array
+from itertools import accumulate
+
+import Profiling
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# The number of vertices in the FIFO post-transform cache that triangles are ordered for, and that ACMR is measured
+# with
+VERTEX_CACHE_SIZE = 16
+
+
+def vertex_triangles(indices, vertex_count):
+    """
+    Returns the triangles that use each vertex, as a flat list of triangle numbers and the offset of each vertex's
+    triangles in it, with one more offset at the end; and the number of triangles that use each vertex. A degenerate
+    triangle is listed once per corner that uses the vertex.
+    """
+    if np is not None:
+        flat = np.asarray(indices, dtype=np.intp)
+        counts = np.bincount(flat, minlength=vertex_count)
+        triangles = np.argsort(flat, kind='stable') // 3
+        return triangles.tolist(), [0] + np.cumsum(counts).tolist(), counts.tolist()
+
+    counts = [0] * vertex_count
+    for vertex in indices:
+        counts[vertex] += 1
+    triangles = [corner // 3 for corner in sorted(range(len(indices)), key=indices.__getitem__)]
+    return triangles, [0] + list(accumulate(counts)), counts
+
+
+def optimize_vertex_cache(indices, vertex_count, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Reorders triangles so that consecutive triangles share vertices, using the Tipsify algorithm from Sander, Nehab
+    and Barczak's "Fast Triangle Reordering for Vertex Locality and Reduced Overdraw". The triangles around one vertex
+    are emitted as a fan, and the next fan is picked from the vertices of that fan: the one with triangles left that
+    has been in a simulated FIFO cache longest without being evicted by its own triangles. The cache is the same one
+    'count_cache_misses' measures with.
+
+    When no vertex of the last fan has triangles left, the next fan is the most recently used vertex that still has
+    triangles, which is likely to be in the cache still, and failing that the first such vertex by index. This stands
+    in for scoring every remaining triangle, which would make the cost quadratic; as it is, every triangle and vertex
+    is visited a fixed number of times, so the cost is linear in the number of triangles.
+
+    Inputs
+    ------
+    indices -- a flat sequence of three vertex indices per triangle
+    vertex_count -- the number of vertices the indices refer to
+    cache_size -- the number of vertices in the simulated cache
+
+    Returns
+    ------
+    The reordered indices, as an array of the same type as 'indices' if it is an array, otherwise an array('I'). The
+    vertices of each triangle keep their order, so triangles keep their winding.
+    """
+    triangle_count = len(indices) // 3
+    typecode = indices.typecode if isinstance(indices, array) else 'I'
+    if triangle_count == 0:
+        return array(typecode, indices)
+
+    adjacent, offsets, live = vertex_triangles(indices, vertex_count)
+    triangles = list(zip(indices[0::3], indices[1::3], indices[2::3]))
+    emitted = bytearray(triangle_count)
+    # A vertex is in the cache if fewer than 'cache_size' misses have happened since it was last loaded
+    loaded_at = [-cache_size] * vertex_count
+    misses = 0
+    dead_ends = []
+    next_vertex = 0
+
+    result = array(typecode)
+    fan = 0
+    while fan >= 0:
+        candidates = []
+        for triangle in adjacent[offsets[fan]:offsets[fan + 1]]:
+            if emitted[triangle]:
+                continue
+            emitted[triangle] = 1
+            corners = triangles[triangle]
+            result.extend(corners)
+            for vertex in corners:
+                live[vertex] -= 1
+                if misses - loaded_at[vertex] >= cache_size:
+                    loaded_at[vertex] = misses
+                    misses += 1
+            candidates.extend(corners)
+        dead_ends.extend(candidates)
+
+        # Prefer the vertex that has been cached longest, unless emitting its triangles would push it out of the cache
+        fan = -1
+        best_age = -1
+        for vertex in candidates:
+            if live[vertex]:
+                age = misses - loaded_at[vertex]
+                if age + 2 * live[vertex] > cache_size:
+                    age = 0
+                if age > best_age:
+                    best_age = age
+                    fan = vertex
+        if fan < 0:
+            while dead_ends:
+                vertex = dead_ends.pop()
+                if live[vertex]:
+                    fan = vertex
+                    break
+            else:
+                while next_vertex < vertex_count and not live[next_vertex]:
+                    next_vertex += 1
+                if next_vertex < vertex_count:
+                    fan = next_vertex
+    return result
+
+
+def optimize_vertex_fetch(indices, vertex_count):
+    """
+    Renumbers the vertices in the order the triangles first use them, so that vertex data is read sequentially.
+    Vertices no triangle uses are kept, after the rest.
+
+    Returns
+    ------
+    The renumbered indices, as an array of the same type as 'indices' if it is an array, otherwise an array('I'), and
+    the old index of each vertex in its new order.
+    """
+    typecode = indices.typecode if isinstance(indices, array) else 'I'
+    if np is not None:
+        flat = np.asarray(indices, dtype=np.intp)
+        used, first_use = np.unique(flat, return_index=True)
+        order = used[np.argsort(first_use, kind='stable')]
+        unused = np.setdiff1d(np.arange(vertex_count, dtype=np.intp), used, assume_unique=True)
+        order = np.concatenate([order, unused])
+        remap = np.empty(vertex_count, dtype=np.intp)
+        remap[order] = np.arange(vertex_count, dtype=np.intp)
+        return array(typecode, remap[flat].astype(np.dtype(typecode)).tobytes()), order.tolist()
+
+    remap = [-1] * vertex_count
+    order = []
+    for vertex in indices:
+        if remap[vertex] < 0:
+            remap[vertex] = len(order)
+            order.append(vertex)
+    for vertex in range(vertex_count):
+        if remap[vertex] < 0:
+            remap[vertex] = len(order)
+            order.append(vertex)
+    return array(typecode, map(remap.__getitem__, indices)), order
+
+
+def reorder_columns(columns, attribute_sizes, order):
+    """
+    Reorders the vertices in each column of a mesh's 'vertices' (see VertexLayout.decode_vertex_columns), so that the
+    vertex at position i is the vertex that was at position 'order[i]'. Every attribute is moved, including the skin
+    weights and bone indices, so that they stay with their vertices.
+    """
+    reordered = {}
+    for name, column in columns.items():
+        if np is not None and isinstance(column, np.ndarray):
+            reordered[name] = column[np.asarray(order, dtype=np.intp)]
+            continue
+        size = attribute_sizes[name]
+        if len(order) * size == 0:
+            reordered[name] = array(column.typecode)
+            continue
+        positions = [vertex * size + component for vertex in order for component in range(size)]
+        values = operator.itemgetter(*positions)(column)
+        reordered[name] = array(column.typecode, values if len(positions) > 1 else (values,))
+    return reordered
+
+
+def count_cache_misses(indices, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Returns the number of vertices a FIFO post-transform cache of 'cache_size' vertices would have to transform to
+    draw the triangles in 'indices'. Divided by the number of triangles, this gives the average cache miss ratio
+    (ACMR), which ranges from 3 for no reuse at all down to about 0.5 for a well-ordered regular mesh.
+    """
+    if not len(indices):
+        return 0
+    # A vertex is in the cache if fewer than 'cache_size' misses have happened since it was last loaded
+    loaded_at = [-cache_size] * (max(indices) + 1)
+    misses = 0
+    for vertex in indices:
+        if misses - loaded_at[vertex] >= cache_size:
+            loaded_at[vertex] = misses
+            misses += 1
+    return misses
+
+
+def optimize_mesh(mesh, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Reorders the triangles of a PXBIInterface.MeshInterface for the vertex cache with 'optimize_vertex_cache', then
+    renumbers its vertices in the order they are used with 'optimize_vertex_fetch'.
+
+    Returns
+    ------
+    The number of triangles, and the number of cache misses before and after; see 'count_cache_misses'.
+    """
+    indices = mesh.triangle_indices
+    misses_before = count_cache_misses(indices, cache_size)
+    indices = optimize_vertex_cache(indices, mesh.vertex_count, cache_size)
+    indices, order = optimize_vertex_fetch(indices, mesh.vertex_count)
+    mesh.vertices = reorder_columns(mesh.vertices, mesh.vertex_attribute_sizes, order)
+    mesh.triangle_indices = indices
+    return len(indices) // 3, misses_before, count_cache_misses(indices, cache_size)
+
+
+def optimize_meshes(pi, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Runs 'optimize_mesh' on every mesh of a PXBIInterface, before it is exported.
+
+    Returns
+    ------
+    The ACMR of all the meshes together, before and after.
+    """
+    triangle_count = misses_before = misses_after = 0
+    with Profiling.stage('optimize.meshes'):
+        for mesh in pi.meshes:
+            triangles, before, after = optimize_mesh(mesh, cache_size)
+            triangle_count += triangles
+            misses_before += before
+            misses_after += after
+    Profiling.count('optimized_triangles', triangle_count)
+    Profiling.count('cache_misses_before', misses_before)
+    Profiling.count('cache_misses_after', misses_after)
+    if triangle_count == 0:
+        return 0., 0.
+    return misses_before / triangle_count, misses_after / triangle_count
@@ -0,0 +1,158 @@
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Maps 'bytes_per_vertex' to the attributes stored in each vertex. Each attribute is described by its name, the offset
+# of its first component in floats from the start of the vertex, and its number of float components.
+vertex_layouts = {56:  (('Position', 0, 3),
+                        ('Normal', 3, 3),
+                        ('UV', 12, 2)),
+                  72:  (('Position', 0, 3),
+                        ('Normal', 3, 3)),
+                  80:  (('Position', 0, 3),
+                        ('Normal', 3, 3),
+                        ('UV', 18, 2)),  # The remaining 80-byte attributes have not been identified yet
+                  88:  (('Position', 0, 3),
+                        ('Normal', 3, 3),
+                        ('UV', 6, 2),
+                        ('Tangent', 8, 3),
+                        ('Binormal', 11, 3),
+                        ('Weights', 14, 4),
+                        ('BoneIndices', 18, 4)),
+                  104: (('Position', 0, 3),
+                        ('Normal', 3, 3),
+                        ('UV', 6, 2),
+                        ('Tangent', 8, 3),
+                        ('Binormal', 11, 3),
+                        ('Weights', 14, 4),
+                        ('BoneIndices', 18, 4),
+                        ('Color', 22, 4))}
+
+
+def attribute_sizes(bytes_per_vertex):
+    return {name: size for name, _, size in vertex_layouts[bytes_per_vertex]}
+
+
+def decode_vertex_columns(data, bytes_per_vertex, vertex_count):
+    """
+    Splits a block of interleaved, big-endian float vertex data into one column per attribute.
+
+    Columns come in one of two shapes, depending on whether NumPy is available, and code that uses them should accept
+    both: 'flatten_column' gives the components of every vertex in sequence for either shape, and
+    'check_vertex_columns' checks that both shapes hold the same values.
+
+    Inputs
+    ------
+    data -- a bytes-like object holding 'vertex_count' vertices of 'bytes_per_vertex' bytes each
+    bytes_per_vertex -- a key of 'vertex_layouts'
+    vertex_count -- the number of vertices in 'data'
+
+    Returns
+    ------
+    A dict mapping attribute names to columns. If NumPy is available each column is a (vertex_count, size) view of
+    'data'; otherwise each column is a flat array('f') holding the components of every vertex in sequence.
+    """
+    if np is not None:
+        stride = bytes_per_vertex // 4
+        interleaved = np.frombuffer(data, dtype='>f4', count=vertex_count * stride).reshape(vertex_count, stride)
+        return {name: interleaved[:, offset:offset + size] for name, offset, size in vertex_layouts[bytes_per_vertex]}
+    return decode_vertex_columns_python(data, bytes_per_vertex, vertex_count)
+
+
+def decode_vertex_columns_python(data, bytes_per_vertex, vertex_count):
+    """
+    The pure-Python path of 'decode_vertex_columns', which returns flat array('f') columns.
+    """
+    stride = bytes_per_vertex // 4
+    interleaved = array('f')
+    interleaved.frombytes(data[:vertex_count * bytes_per_vertex])
+    if sys.byteorder == 'little':
+        interleaved.byteswap()
+
+    columns = {}
+    for name, offset, size in vertex_layouts[bytes_per_vertex]:
+        column = array('f', [0.]) * (vertex_count * size)
+        for component in range(size):
+            column[component::size] = interleaved[offset + component::stride]
+        columns[name] = column
+    return columns
+
+
+def check_vertex_columns(data, bytes_per_vertex, vertex_count):
+    """
+    Decodes a block of vertex data with both the NumPy and the pure-Python path of 'decode_vertex_columns', and raises
+    a ValueError if any column differs between them once flattened. Does nothing if NumPy is not available.
+    """
+    if np is None:
+        return
+    columns = decode_vertex_columns(data, bytes_per_vertex, vertex_count)
+    for name, column in decode_vertex_columns_python(data, bytes_per_vertex, vertex_count).items():
+        # Compared as bytes, so that NaNs in unidentified data compare equal
+        if flatten_column(columns[name]).astype('=f4').tobytes() != column.tobytes():
+            raise ValueError(f"The NumPy and pure-Python vertex decoders disagree on the '{name}' column.")
+
+
+def encode_vertex_columns(columns, bytes_per_vertex, vertex_count, base=None):
+    """
+    The inverse of 'decode_vertex_columns'. Components not covered by the vertex layout are copied from 'base', the
+    vertex data that the columns were decoded from, if it is given, and are otherwise written as zero.
+    """
+    stride = bytes_per_vertex // 4
+    if np is not None:
+        if base is None:
+            interleaved = np.zeros((vertex_count, stride), dtype='>f4')
+        else:
+            interleaved = np.frombuffer(base, dtype='>f4', count=vertex_count * stride).reshape(vertex_count, stride).copy()
+        for name, offset, size in vertex_layouts[bytes_per_vertex]:
+            interleaved[:, offset:offset + size] = np.reshape(columns[name], (vertex_count, size))
+        return interleaved.tobytes()
+
+    if base is None:
+        interleaved = array('f', [0.]) * (vertex_count * stride)
+    else:
+        interleaved = array('f')
+        interleaved.frombytes(base[:vertex_count * bytes_per_vertex])
+        if sys.byteorder == 'little':
+            interleaved.byteswap()
+    for name, offset, size in vertex_layouts[bytes_per_vertex]:
+        column = flatten_column(columns[name])
+        for component in range(size):
+            interleaved[offset + component::stride] = array('f', column[component::size])
+    if sys.byteorder == 'little':
+        interleaved.byteswap()
+    return interleaved.tobytes()
+
+
+def decode_indices(data, count):
+    """
+    Returns 'count' big-endian uint16 indices from the start of 'data' as an array('H').
+    """
+    indices = array('H')
+    indices.frombytes(data[:count * 2])
+    if sys.byteorder == 'little':
+        indices.byteswap()
+    return indices
+
+
+def encode_indices(indices):
+    """
+    The inverse of 'decode_indices'.
+    """
+    indices = array('H', indices)
+    if sys.byteorder == 'little':
+        indices.byteswap()
+    return indices.tobytes()
+
+
+def flatten_column(column):
+    """
+    Returns the components of every vertex in a column as a single flat sequence.
+    """
+    if np is not None and isinstance(column, np.ndarray):
+        return column.reshape(-1)
+    return column